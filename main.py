@@ -1,31 +1,279 @@
 import argparse
+import concurrent.futures
+import contextlib
 import logging
+import os
 import pathlib
+import sys
 
 import moodle
-from moodle.utility import get_directories, test_environment
+from moodle.cluster import count_work
+from moodle.daemon import Client, parse_address
+from moodle.journal import JOURNAL_FILENAME, Journal
+from moodle.logs import log_context, parse_levels, setup_logging
+from moodle.metrics import PROGRESS, MetricsServer, TextfileWriter
+from moodle.scanner import Manifest
+from moodle.utility import get_config
 
-FORMAT = "%(asctime)s :: %(levelname)s :: [%(module)s.%(funcName)s.%(lineno)d] :: %(message)s"
-formatter = logging.Formatter(FORMAT)
+# modules driving the browser (and selenium) are imported only by actions
+# that use them, so that --help and --dry-run start fast
 
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.INFO)
+logger = logging.getLogger()
 
-file_handler = logging.FileHandler("main.log")
-file_handler.setLevel(logging.INFO)
+# arguments of the actions a daemon can run, sent with its jobs
+DAEMON_ARGS = ("upload_all", "upload_module", "sync", "module", "start_slide", "load_only_slide")
 
-file_debug_handler = logging.FileHandler("main.debug.log")
-file_debug_handler.setLevel(logging.DEBUG)
 
-# set formatters and add handlers to main logger
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+def dry_run(manifest: Manifest, load_only_slide: bool = False) -> bool:
+    """Log modules found in manifest with their slides and questions,
+    and return False if some of them cannot be uploaded"""
+    valid = True
+    for entry in manifest.modules():
+        problems = entry.problems(load_only_slide=load_only_slide)
+        if problems:
+            valid = False
+            logger.error(f"Invalid module {entry.path}: {', '.join(problems)}")
+            continue
+
+        questions = 0
+        if entry.json and not load_only_slide:
+            questions, _ = count_work(entry.json)
+        logger.info(
+            f"Module {entry.path}: {len(entry.slides)} slides, {questions} questions"
+        )
+    return valid
+
+
+def open_sessions(config: dict, count: int) -> list:
+    """Start `count` more logged in browsers, concurrently"""
+    from moodle.automator import Automator
+
+    with concurrent.futures.ThreadPoolExecutor(count, thread_name_prefix="session") as executor:
+        futures = [executor.submit(Automator, config=config) for _ in range(count)]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    sessions = [future.result() for future in futures if future.exception() is None]
+    if errors:
+        for session in sessions:
+            session.close()
+        raise errors[0]
+    logger.info(f"{count} more sessions ready")
+    return sessions
+
+
+def run(automator: "moodle.Automator", args: argparse.Namespace, manifest: Manifest):
+    """Execute the action selected from command line"""
+    sessions = []
+    if args.parallel > 1 and (args.upload_all or args.upload_module):
+        sessions = open_sessions(automator.config, args.parallel - 1)
+    try:
+        run_action(automator, args, manifest, sessions)
+    finally:
+        for session in sessions:
+            session.close()
+
+
+def run_action(
+    automator: "moodle.Automator",
+    args: argparse.Namespace,
+    manifest: Manifest,
+    sessions: list,
+):
+    from moodle.batch import module_work
+    from moodle.cleanup import Cleaner
+    from moodle.sync import LessonSync
+    from moodle.watch import Watcher
+
+    path = pathlib.Path(args.path)
+    load_only_slide = args.load_only_slide
+
+    def populate(module, directory, **kwargs):
+        if sessions:
+            from moodle.parallel import ParallelPopulator
+
+            ParallelPopulator(module, [automator] + sessions).populate(directory, **kwargs)
+        else:
+            module.populate(directory, **kwargs)
+
+    if args.upload_all:
+        # return directories inside path
+        uf_directories = manifest.children(path)
+
+        # whole work is known, so that ETA covers every module
+        work = [
+            module_work(mod_dir, load_only_slide)
+            for uf_dir in uf_directories
+            for mod_dir in manifest.children(uf_dir.path)
+        ]
+        PROGRESS.plan(sum(w[0] for w in work), sum(w[1] for w in work))
+
+        for uf_dir in uf_directories:
+            logger.info(f"UF directory: {uf_dir.path}")
+            # create section with name of uf directory
+            section = automator.create_section(uf_dir.path.name)
+
+            # for every dir inside uf
+            for mod_dir in manifest.children(uf_dir.path):
+                logger.info(f"MOD directory: {mod_dir.path}")
+                with log_context(module=mod_dir.path.name):
+                    # create module
+                    module = automator.create_module(mod_dir.path.name, section=section)
+                    # and populate it
+                    populate(
+                        module, mod_dir.path, load_only_slide=load_only_slide, manifest=manifest
+                    )
+    elif args.upload_module:
+        # if module is specified, try to get it from page
+        if args.module:
+            module_id = int(args.module)
+            logger.info(f"Module id specified: {module_id}, will try to get it")
+            module = automator.get_module(module_id=module_id)
+            logger.info(f"Module found: {module}")
+        # otherwise create a module inside last section, and populate it
+        else:
+            logger.info(
+                "Module id not specified, so I will create a module inside last section"
+            )
+            last_section = automator.get_last_section()
+            logger.info(f"Last section: {last_section}")
+            module = automator.create_module(path.name, last_section)
+            logger.info(f"Module created: {module}")
+        start_slide = int(args.start_slide) if args.start_slide else None
+        populate(
+            module,
+            path,
+            start=start_slide,
+            load_only_slide=load_only_slide,
+            manifest=manifest,
+        )
+        logger.info("Module populated with slides!")
+    elif args.sync:
+        module = automator.get_module(module_id=int(args.module))
+        logger.info(f"Module found: {module}")
+        LessonSync(module).run(path, load_only_slide=load_only_slide)
+    elif args.cleanup:
+        cleaner = Cleaner(automator)
+        if args.from_slide is not None:
+            module = automator.get_module(module_id=int(args.module))
+            cleaner.truncate_lesson(module, args.from_slide)
+        else:
+            cleaner.delete_created(Journal(args.journal), run=args.run)
+    elif args.watch:
+        module = None
+        if args.module:
+            module = automator.get_module(module_id=int(args.module))
+            logger.info(f"Module found: {module}")
+        watcher = Watcher(
+            automator,
+            path,
+            module=module,
+            debounce=args.debounce,
+            load_only_slide=load_only_slide,
+        )
+        watcher.run()
 
-handlers = (stream_handler, file_handler, file_debug_handler)
 
-for handler in handlers:
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+def run_batch(args: argparse.Namespace):
+    """Upload every course of a batch file"""
+    from moodle.batch import BatchRunner, SessionPool, load_batch
+
+    workers, jobs = load_batch(args.batch)
+    workers = args.workers or workers
+    if args.load_only_slide:
+        for job in jobs:
+            job.load_only_slide = True
+
+    logger.info(f"Batch of {len(jobs)} courses with {workers} workers")
+    pool = SessionPool(journal=Journal(args.journal))
+    with offline(*(job.config for job in jobs)):
+        if not BatchRunner(jobs, workers=workers, pool=pool).run():
+            raise SystemExit(1)
+
+
+def offline(*configs: dict):
+    """Waits of model code skipped when every config is of the in-memory site"""
+    if not configs or any(config["selenium"]["engine"] != "fake" for config in configs):
+        return contextlib.nullcontext()
+    from moodle.fake import without_waits
+
+    # nothing to wait for, an offline run measures this tool only
+    logger.info("Running against an in-memory site (development only), without waits")
+    return without_waits()
+
+
+def use_daemon(args: argparse.Namespace, **kwargs) -> bool:
+    """Whether the action can be sent to a daemon, if one is running"""
+    if args.no_daemon or kwargs:
+        return False
+    if not (args.upload_all or args.upload_module or args.sync):
+        return False
+    # journal and log levels are the ones the daemon was started with
+    if args.journal != JOURNAL_FILENAME or args.log_level:
+        return False
+    # options measuring or changing this process and its browsers
+    return not (args.parallel > 1 or args.count_commands or args.network_report or args.profile)
+
+
+def send_job(args: argparse.Namespace) -> bool:
+    """Run the action on a daemon, if running, and return whether it did"""
+    job = dict(
+        action="run",
+        config=os.path.abspath(args.config),
+        args=dict(
+            path=os.path.abspath(args.path),
+            **{name: getattr(args, name) for name in DAEMON_ARGS},
+        ),
+        verbose=args.verbose,
+    )
+    outcome = Client(args.daemon_address).send(job, output=print_log)
+    if outcome is None:
+        logger.debug(f"No daemon on {args.daemon_address}, running here")
+        return False
+
+    if not outcome["ok"]:
+        logger.error(f"Job failed on daemon (run {outcome['run']}): {outcome['error']}")
+        raise SystemExit(1)
+    logger.info(f"Job done on daemon (run {outcome['run']})")
+    return True
+
+
+def print_log(line: str):
+    # records of the daemon, already formatted
+    print(line, file=sys.stderr, flush=True)
+
+
+def stop_daemon(args: argparse.Namespace):
+    if Client(args.daemon_address).send(dict(action="stop")) is None:
+        logger.error(f"No daemon running on {args.daemon_address}")
+        raise SystemExit(1)
+    logger.info("Daemon stopping, after its running jobs")
+
+
+def serve(args: argparse.Namespace, config: dict, path: pathlib.Path, **kwargs):
+    """Keep logged in browsers and run jobs of other runs, until stopped"""
+    from moodle.daemon import Daemon
+
+    journal = Journal(args.journal)
+    daemon = Daemon(
+        run_job,
+        lambda: start_automator(config, kwargs, journal),
+        address=args.daemon_address,
+        sessions=args.sessions,
+    )
+    daemon.serve()
+
+
+def run_job(automator: "moodle.Automator", job: dict):
+    """Run an upload or sync job sent to the daemon"""
+    args = argparse.Namespace(cleanup=False, watch=False, **job["args"])
+    manifest = Manifest(pathlib.Path(args.path))
+    manifest.scan()
+    if (args.upload_all or args.upload_module) and not validate(manifest, args):
+        msg = f"Invalid modules found in {args.path}"
+        logger.error(msg)
+        raise ValueError(msg)
+    # progress metrics are the ones of the jobs running
+    with PROGRESS.job():
+        run_action(automator, args, manifest, [])
 
 
 def main(**kwargs):
@@ -48,6 +296,49 @@ def main(**kwargs):
         "--upload-module", action="store_true", help="Upload slides for selected module"
     )
 
+    group.add_argument(
+        "--sync",
+        action="store_true",
+        help="Update an existing module (--module) with changed slides only",
+    )
+    group.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Scan and validate path, without uploading anything",
+    )
+    group.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and sync modules whose slides or json change",
+    )
+    group.add_argument(
+        "--cleanup",
+        action="store_true",
+        help="Delete sections and modules created by last run (or --run), or"
+        " with --module and --from-slide the pages of a lesson from that slide",
+    )
+    group.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Upload all courses listed in a json batch file",
+    )
+    group.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep logged in browsers running, serving upload and sync actions of"
+        " other runs (sent to it while it runs, unless --no-daemon)",
+    )
+    group.add_argument(
+        "--stop-daemon",
+        action="store_true",
+        help="Stop the running daemon, once its jobs are done",
+    )
+
+    parser.add_argument(
+        "--config",
+        default="moodle.cfg",
+        help="Path of the configuration file. Defaults to moodle.cfg",
+    )
     parser.add_argument(
         "-m",
         "--module",
@@ -56,10 +347,115 @@ def main(**kwargs):
     parser.add_argument(
         "--start-slide", type=int, help="Specify the first slide to upload"
     )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=5.0,
+        help="Seconds without changes before syncing, in watch mode",
+    )
+    parser.add_argument(
+        "--run", help="Run id whose sections and modules --cleanup deletes"
+    )
+    parser.add_argument(
+        "--from-slide",
+        type=int,
+        help="With --cleanup and --module, delete lesson pages from this slide",
+    )
+    parser.add_argument(
+        "--journal",
+        default=JOURNAL_FILENAME,
+        help=f"File recording sections and modules created. Defaults to {JOURNAL_FILENAME}",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Browsers populating modules in batch mode, overrides batch file",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Browsers populating each lesson together, split at cluster boundaries",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Logged in browsers kept by --daemon, running jobs concurrently",
+    )
+    parser.add_argument(
+        "--daemon-address",
+        metavar="ADDRESS",
+        help="Unix socket path, or localhost port, of the daemon."
+        " Defaults to a socket in temp directory (a port on Windows)",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Upload or sync with a browser of this run, even if a daemon is running",
+    )
     parser.add_argument(
         "-v", "--verbose", help="Increase verbosity", action="store_true"
     )
 
+    parser.add_argument(
+        "--count-commands",
+        action="store_true",
+        help="Log WebDriver commands issued by every operation at the end",
+    )
+    parser.add_argument(
+        "--network-report",
+        action="store_true",
+        help="Log server, transfer and client idle time of every operation at the end",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Sample Python stacks of the run, writing them to FILE for flamegraph.pl"
+        " and a summary of top functions to FILE.txt",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=5.0,
+        help="Milliseconds between samples of --profile",
+    )
+    parser.add_argument(
+        "--json-logs",
+        action="store_true",
+        help="Write log files as json lines, with run/module/slide fields",
+    )
+    parser.add_argument(
+        "--log-level",
+        action="append",
+        metavar="LOGGER=LEVEL",
+        help="Set level of a logger (e.g. selenium=DEBUG), can be repeated",
+    )
+    parser.add_argument(
+        "--log-max-mb",
+        type=int,
+        default=50,
+        help="Rotate log files when they reach this size, in MB",
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        help="Write progress metrics, in Prometheus text format, to this file",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve progress metrics on this local port",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=15.0,
+        help="Seconds between writes of --metrics-file",
+    )
+
     parser.add_argument(
         "--load-only-slide",
         action="store_true",
@@ -69,58 +465,166 @@ def main(**kwargs):
     # parse command line args
     args = parser.parse_args()
 
-    # increase verbosity
-    if args.verbose:
-        stream_handler.setLevel(logging.DEBUG)
+    if args.sync and not args.module:
+        parser.error("--sync requires --module")
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.sessions < 1:
+        parser.error("--sessions must be at least 1")
+    if args.from_slide is not None and not (args.cleanup and args.module):
+        parser.error("--from-slide requires --cleanup and --module")
+    if args.network_report and args.parallel > 1:
+        # network of helper sessions is not recorded
+        parser.error("--network-report cannot be used with --parallel")
+
+    try:
+        levels = parse_levels(args.log_level)
+        args.daemon_address = parse_address(args.daemon_address)
+    except ValueError as e:
+        parser.error(str(e))
+
+    listener = setup_logging(
+        verbose=args.verbose,
+        json_logs=args.json_logs,
+        max_bytes=args.log_max_mb * 2 ** 20,
+        levels=levels,
+    )
+    exporters = []
+    try:
+        if args.metrics_file:
+            exporters.append(TextfileWriter(args.metrics_file, args.metrics_interval).start())
+        if args.metrics_port:
+            exporters.append(MetricsServer(args.metrics_port).start())
+
+        if args.profile:
+            profile(args, **kwargs)
+        else:
+            execute(args, **kwargs)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+        listener.stop()
+
+
+def profile(args: argparse.Namespace, **kwargs):
+    """Execute under the sampling profiler, writing its stacks and summary"""
+    from moodle.profiler import SamplingProfiler
+
+    profiler = SamplingProfiler(args.profile_interval / 1000)
+    try:
+        with profiler:
+            execute(args, **kwargs)
+    finally:
+        profiler.write_collapsed(args.profile)
+        summary = profiler.summary()
+        with open(f"{args.profile}.txt", "w", encoding="utf-8") as f:
+            f.write(summary + "\n")
+        logger.info(f"Profile written to {args.profile}:\n{summary}")
+
+
+def execute(args: argparse.Namespace, **kwargs):
+    if args.batch:
+        return run_batch(args)
+    if args.stop_daemon:
+        return stop_daemon(args)
 
     # get root path
     path = pathlib.Path(args.path)
     logger.info(f"Slides will be parsed from {path}")
 
-    # test if env is correctly set
-    test_environment(**kwargs)
+    load_only_slide = args.load_only_slide
+
+    if args.dry_run:
+        # index data tree, listing again only what changed since last run
+        manifest = Manifest(path)
+        manifest.scan()
+        if not dry_run(manifest, load_only_slide=load_only_slide):
+            raise SystemExit(1)
+        return
+
+    # warm browsers of a running daemon start the action right away
+    if use_daemon(args, **kwargs) and send_job(args):
+        return
+
+    config = get_config(args.config)
+    if args.network_report:
+        kwargs["performance_log"] = True
+
+    action = serve if args.daemon else start_and_run
+    with offline(config):
+        return action(args, config, path, **kwargs)
 
-    # create an automator object
-    automator = moodle.Automator()
 
+def start_and_run(args: argparse.Namespace, config: dict, path: pathlib.Path, **kwargs):
     load_only_slide = args.load_only_slide
+
+    # browser start, login and edit mode run while the data tree is scanned
+    # and validated: a broken environment fails here, when its result is taken
+    executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="prewarm")
+    future = executor.submit(start_automator, config, kwargs, Journal(args.journal))
+    executor.shutdown(wait=False)
+    try:
+        manifest = Manifest(path)
+        manifest.scan()
+        if (args.upload_all or args.upload_module) and not validate(manifest, args):
+            raise SystemExit(1)
+
+        automator = future.result()
+    except BaseException:
+        future.add_done_callback(close_automator)
+        raise
+
     logger.info(f"Load only slide: {load_only_slide}")
 
-    if args.upload_all:
-        # return directories inside path
-        uf_directories = get_directories(root=args.path)
+    from moodle.instrument import CommandCounter
+    from moodle.network import NetworkRecorder
 
-        for uf_dir in uf_directories:
-            logger.info(f"UF directory: {uf_dir}")
-            # create section with name of uf directory
-            section = automator.create_section(uf_dir.name)
+    # browser is quitted even on errors
+    with automator:
+        counter = CommandCounter().attach(automator.driver) if args.count_commands else None
+        recorder = NetworkRecorder().attach(automator.driver) if args.network_report else None
+        try:
+            run(automator, args, manifest)
+        finally:
+            if counter is not None:
+                counter.detach()
+                logger.info(f"WebDriver commands:\n{counter.report()}")
+            if recorder is not None:
+                recorder.detach()
+                logger.info(f"Network time by step, per call:\n{recorder.report()}")
 
-            # for every dir inside uf
-            for mod_dir in get_directories(uf_dir):
-                logger.info(f"MOD directory: {mod_dir}")
-                # create module
-                module = automator.create_module(mod_dir.name, section=section)
-                # and populate it
-                module.populate(mod_dir, load_only_slide=load_only_slide)
-    elif args.upload_module:
-        # if module is specified, try to get it from page
-        if args.module:
-            module_id = int(args.module)
-            logger.info(f"Module id specified: {module_id}, will try to get it")
-            module = automator.get_module(module_id=module_id)
-            logger.info(f"Module found: {module}")
-        # otherwise create a module inside last section, and populate it
-        else:
-            logger.info(
-                "Module id not specified, so I will create a module inside last section"
-            )
-            last_section = automator.get_last_section()
-            logger.info(f"Last section: {last_section}")
-            module = automator.create_module(path.name, last_section)
-            logger.info(f"Module created: {module}")
-        start_slide = int(args.start_slide) if args.start_slide else None
-        module.populate(args.path, start=start_slide, load_only_slide=load_only_slide)
-        logger.info("Module populated with slides!")
+
+def start_automator(config: dict, driver_kwargs: dict, journal: Journal) -> "moodle.Automator":
+    automator = moodle.Automator(config=config, driver_kwargs=driver_kwargs, journal=journal)
+    logger.info("Browser ready")
+    return automator
+
+
+def close_automator(future: concurrent.futures.Future):
+    # automator started for nothing, e.g. data tree is not valid
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def validate(manifest: Manifest, args: argparse.Namespace) -> bool:
+    """Check modules about to be uploaded, before the first slide is"""
+    path = pathlib.Path(args.path)
+    if args.upload_module:
+        entries = [manifest[path]]
+    else:
+        entries = [
+            mod_dir
+            for uf_dir in manifest.children(path)
+            for mod_dir in manifest.children(uf_dir.path)
+        ]
+
+    valid = True
+    for entry in entries:
+        problems = entry.problems(load_only_slide=args.load_only_slide)
+        if problems:
+            valid = False
+            logger.error(f"Invalid module {entry.path}: {', '.join(problems)}")
+    return valid
 
 
 if __name__ == "__main__":
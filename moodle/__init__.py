@@ -1,5 +1,12 @@
-from moodle.automator import Automator
-
 __all__ = ["Automator"]
 
 version = "0.1"
+
+
+def __getattr__(name):
+    # Automator needs selenium, so it's imported only when actually used
+    if name == "Automator":
+        from moodle.automator import Automator
+
+        return Automator
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
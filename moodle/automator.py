@@ -1,70 +1,160 @@
 import logging
+from typing import TYPE_CHECKING, Optional
 
 from selenium.common.exceptions import WebDriverException
 
+from moodle.driver import ManagedDriver
 from moodle.model import Module, Section
 from moodle.pages import LoginPage, ToggleEditPage
-from moodle.utility import config, get_driver
+from moodle.structure import CourseStructure
+from moodle.utility import default_config, get_driver
 import time
 
+if TYPE_CHECKING:
+    from moodle.journal import Journal
+
 logger = logging.getLogger(__name__)
 
 
 class Automator:
-    def __init__(self, *, wait_s: int = 3):
+    def __init__(
+        self,
+        *,
+        wait_s: int = 3,
+        config: dict = None,
+        driver_kwargs: dict = None,
+        journal: "Journal" = None,
+    ):
         if wait_s <= 0:
             msg = "Implicit wait must be positive!"
             logger.error(msg)
             raise ValueError(msg)
 
-        driver = get_driver()
-        driver.implicitly_wait(wait_s)
-        self.driver = driver
+        self.config = config = config or default_config()
+        self._structure: Optional[CourseStructure] = None
+        # records what is created, for cleanup
+        self.journal = journal
+        driver_kwargs = driver_kwargs or {}
+        self.driver = ManagedDriver(
+            lambda: get_driver(self.config, **driver_kwargs),
+            config=config,
+            wait_s=wait_s,
+            recycle_pages=config["selenium"]["recycle_pages"],
+            max_memory_mb=config["selenium"]["max_memory_mb"],
+        )
 
-        # execute login on moodle platform
-        self.login()
+        try:
+            # execute login on moodle platform
+            self.login()
 
-        time.sleep(1)
-        # enable course edit
-        self.enable_edit()
+            time.sleep(1)
+            # enable course edit
+            self.enable_edit()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """Quit the browser, can be called more than once"""
+        driver = getattr(self, "driver", None)
+        if driver is not None:
+            driver.quit()
+
+    def use_config(self, config: dict):
+        """Work on another course of the same site, keeping this session"""
+        if config["site"]["login"] != self.config["site"]["login"]:
+            msg = "Cannot switch session to a course of another site!"
+            logger.error(msg)
+            raise ValueError(msg)
+        if config["credentials"] != self.config["credentials"]:
+            msg = "Cannot switch session to a course of another user!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.config = config
+        self.driver.config = config
+        self._structure = None
+        self.enable_edit()
+
+    def resume(self):
+        """Make a session idle for a while usable again: start a new browser
+        if the old one is gone, and login again if Moodle session expired"""
         try:
+            self.driver.current_url
+        except WebDriverException as e:
+            logger.warning(f"Browser is gone ({e}), starting a new one")
             self.driver.quit()
-        except WebDriverException:
-            pass
-        finally:
-            logger.info("Selenium driver quitted")
+            self.driver.start()
+        self.login()
 
     def login(self):
-        LoginPage(self.driver).complete()
+        LoginPage(self.driver, self.config).complete()
 
     def go_to_course(self):
-        self.driver.get(config["site"]["course"])
+        self.driver.get(self.config["site"]["course"])
 
     def enable_edit(self):
-        ToggleEditPage(self.driver).complete()
+        ToggleEditPage(self.driver, self.config).complete()
         logger.info("Edit course enabled")
 
+    @property
+    def structure(self) -> CourseStructure:
+        """Sections and activities of course, read once and then kept updated"""
+        if self._structure is None:
+            if self.driver.current_url != self.config["site"]["course"]:
+                self.go_to_course()
+            self._structure = CourseStructure.read(self.driver)
+        return self._structure
+
+    def refresh_structure(self) -> CourseStructure:
+        """Read course structure again, e.g. after changes made by others"""
+        self._structure = None
+        return self.structure
+
     def get_last_section(self) -> Section:
         """Get last Section element"""
-        li = self.driver.find_elements_by_css_selector(Section.css_selector)[-1]
-        name = li.find_element_by_css_selector("div.content > h3").text.strip()
-        section = Section(self.driver, name)
-        section.dom_id = li.get_attribute("id")
+        info = self.structure.last_section
+        if info is None:
+            msg = "Cannot find any section in course!"
+            logger.error(msg)
+            raise ValueError(msg)
+        section = Section(self.driver, info.name, config=self.config)
+        section.dom_id = info.dom_id
         return section
 
     def get_module(self, module_id: int) -> Module:
         """Get Module element from its id"""
-        module_dom_id = f"module-{module_id}"
-        try:
-            element = self.driver.find_element_by_id(module_dom_id)
-        except WebDriverException:
-            msg = f"Cannot find element with ID '{module_dom_id}'!"
+        info = self.structure.activity(module_id)
+        if info is None:
+            # maybe created after the snapshot
+            info = self.refresh_structure().activity(module_id)
+        if info is None:
+            msg = f"Cannot find element with ID 'module-{module_id}'!"
+            raise ValueError(msg)
+        module = Module(driver=self.driver, name=info.name, config=self.config)
+        module.dom_id = info.dom_id
+        return module
+
+    def find_module(self, name: str) -> Module:
+        """Get Module element from its name on course page"""
+        info = self.structure.find_activity(name)
+        if info is None:
+            info = self.refresh_structure().find_activity(name)
+        if info is None:
+            msg = f"Cannot find module with name '{name}'!"
             raise ValueError(msg)
-        name = element.find_element_by_class_name("instancename").text
-        module = Module(driver=self.driver, name=name)
-        module.dom_id = module_dom_id
+
+        module = Module(driver=self.driver, name=name, config=self.config)
+        module.dom_id = info.dom_id
         return module
 
     def create_section(self, name: str) -> Section:
@@ -72,8 +162,12 @@ class Automator:
         # ensure we're on course page
         self.go_to_course()
 
-        section = Section(self.driver, name)
+        # read before creating, so that the new section is indexed once
+        structure = self.structure
+        section = Section(self.driver, name, config=self.config)
         section.create()
+        structure.add_section(section.dom_id, name)
+        self._record("section", section)
         return section
 
     def create_module(self, name: str, section: Section) -> Module:
@@ -81,6 +175,15 @@ class Automator:
         # ensure we're on course page
         self.go_to_course()
 
-        module = Module(self.driver, name, section)
+        structure = self.structure
+        module = Module(self.driver, name, section, config=self.config)
         module.create()
+        if structure.section(section.dom_id) is None:
+            structure.add_section(section.dom_id, section.name)
+        structure.add_activity(section.dom_id, module.dom_id, name)
+        self._record("module", module)
         return module
+
+    def _record(self, kind: str, element):
+        if self.journal is not None:
+            self.journal.record(kind, self.config["site"]["course"], element.dom_id, element.name)
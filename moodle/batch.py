@@ -0,0 +1,359 @@
+"""Upload of many courses in one run.
+
+A batch file lists courses and their data roots:
+
+    {
+        "workers": 2,
+        "config": "moodle.cfg",
+        "jobs": [
+            {"course": 101, "path": "data/course-a"},
+            {"course": 102, "path": "data/course-b", "load_only_slide": true}
+        ]
+    }
+
+Sections and modules of every course are created first, in directory order,
+then modules are populated by `workers` browsers, the most expensive first
+(longest processing time scheduling), so that no big module is left running
+alone at the end. Logged in browsers are shared by jobs on the same site."""
+import collections
+import copy
+import heapq
+import json
+import logging
+import pathlib
+import queue
+import threading
+import urllib.parse
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from moodle.cluster import count_work
+from moodle.logs import log_context
+from moodle.metrics import PROGRESS
+from moodle.scanner import DirectoryEntry, Manifest
+from moodle.utility import get_config
+
+logger = logging.getLogger(__name__)
+
+# rough seconds taken by each step, measured on a remote hub
+SLIDE_COST = 25.0
+QUESTION_COST = 20.0
+CLUSTER_COST = 5.0
+MODULE_COST = 30.0
+SECTION_COST = 10.0
+
+
+def module_work(entry: DirectoryEntry, load_only_slide: bool = False) -> Tuple[int, int, int]:
+    """Slides, questions and clusters to upload from a module directory"""
+    if load_only_slide or not entry.json:
+        return len(entry.slides), 0, 0
+    questions, clusters = count_work(entry.json)
+    return len(entry.slides), questions, clusters
+
+
+def work_cost(slides: int, questions: int, clusters: int) -> float:
+    return slides * SLIDE_COST + questions * QUESTION_COST + clusters * CLUSTER_COST
+
+
+def estimate_cost(entry: DirectoryEntry, load_only_slide: bool = False) -> float:
+    """Seconds expected to populate a module directory"""
+    return work_cost(*module_work(entry, load_only_slide))
+
+
+def lpt_makespan(costs: Iterable[float], workers: int) -> float:
+    """Makespan of costs assigned longest first, each to the least loaded worker"""
+    loads = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return max(loads)
+
+
+def session_key(config: dict) -> tuple:
+    """Site and user of a configuration: a session serves courses sharing them"""
+    credentials = config["credentials"]
+    return config["site"]["login"], credentials["username"], credentials["password"]
+
+
+def course_config(config: dict, course_id: int) -> dict:
+    """Copy of a configuration pointing to another course of the same site"""
+    config = copy.deepcopy(config)
+    url = urllib.parse.urlsplit(config["site"]["course"])
+    query = dict(urllib.parse.parse_qsl(url.query))
+    query["id"] = str(course_id)
+    config["site"]["course"] = url._replace(query=urllib.parse.urlencode(query)).geturl()
+    return config
+
+
+class Job:
+    """A course to upload, from a data root"""
+
+    def __init__(self, course: int, path: pathlib.Path, config: dict, load_only_slide=False):
+        self.course = course
+        self.path = pathlib.Path(path)
+        self.config = config
+        self.load_only_slide = load_only_slide
+
+        self.manifest = Manifest(self.path)
+        # sections created in course, by uf directory
+        self.sections: Dict[str, str] = {}
+
+    def __repr__(self):
+        return f"Job(course={self.course}, path={self.path})"
+
+    @property
+    def site(self) -> str:
+        return self.config["site"]["login"]
+
+    def scan(self):
+        self.manifest.scan()
+
+    def units(self) -> Dict[DirectoryEntry, List[DirectoryEntry]]:
+        """Module directories of every uf directory"""
+        return {
+            uf_dir: self.manifest.children(uf_dir.path)
+            for uf_dir in self.manifest.children(self.path)
+        }
+
+    def modules(self) -> List[DirectoryEntry]:
+        """Module directories of every uf directory, the ones uploaded. Slides
+        found elsewhere in the data root are logged and left out"""
+        modules = [
+            mod_dir
+            for mod_dirs in self.units().values()
+            for mod_dir in mod_dirs
+            if mod_dir.is_module
+        ]
+        paths = {entry.path for entry in modules}
+        for entry in self.manifest.modules():
+            if entry.path not in paths:
+                logger.warning(
+                    f"Slides of {entry.path} skipped, not in a <uf>/<module> directory"
+                    f" of {self.path}"
+                )
+        return modules
+
+
+class Task:
+    """A module of a job to populate"""
+
+    def __init__(self, job: Job, entry: DirectoryEntry):
+        self.job = job
+        self.entry = entry
+        self.slides, self.questions, clusters = module_work(entry, job.load_only_slide)
+        self.cost = work_cost(self.slides, self.questions, clusters)
+        # dom id of module, once created
+        self.dom_id: Optional[str] = None
+
+    def __repr__(self):
+        return f"Task({self.entry.path}, cost={self.cost:.0f}s)"
+
+    @property
+    def name(self) -> str:
+        return self.entry.path.name
+
+
+def load_batch(batch_fp) -> tuple:
+    """Read a batch file, returning number of workers and jobs"""
+    with open(batch_fp, "r", encoding="utf-8") as f:
+        batch = json.load(f)
+
+    base = pathlib.Path(batch_fp).parent
+    configs = {}
+    jobs = []
+    for obj in batch.get("jobs", []):
+        if "course" not in obj or "path" not in obj:
+            msg = f"Every job of {batch_fp} needs course and path: {obj}"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        cfg_fp = obj.get("config", batch.get("config", "moodle.cfg"))
+        if cfg_fp not in configs:
+            configs[cfg_fp] = get_config(cfg_fp)
+
+        jobs.append(
+            Job(
+                course=int(obj["course"]),
+                path=base / obj["path"],
+                config=course_config(configs[cfg_fp], obj["course"]),
+                load_only_slide=obj.get("load_only_slide", False),
+            )
+        )
+
+    if not jobs:
+        msg = f"No jobs found in {batch_fp}!"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    return int(batch.get("workers", 1)), jobs
+
+
+class SessionPool:
+    """Logged in Automators, reused by jobs on the same site and user"""
+
+    def __init__(self, factory: Callable = None, journal=None):
+        if factory is None:
+            from moodle.automator import Automator
+
+            factory = lambda config: Automator(config=config, journal=journal)  # noqa: E731
+
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.idle: Dict[tuple, list] = collections.defaultdict(list)
+        self.sessions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def acquire(self, config: dict):
+        """Return an Automator working on course of config"""
+        with self.lock:
+            idle = self.idle[session_key(config)]
+            automator = idle.pop() if idle else None
+
+        if automator is None:
+            automator = self.factory(config)
+            with self.lock:
+                self.sessions.append(automator)
+            logger.info(f"New session for {config['site']['login']}")
+        elif automator.config["site"]["course"] != config["site"]["course"]:
+            automator.use_config(config)
+        return automator
+
+    def release(self, automator):
+        with self.lock:
+            self.idle[session_key(automator.config)].append(automator)
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+            self.idle.clear()
+        for automator in sessions:
+            automator.close()
+
+
+class BatchRunner:
+    def __init__(self, jobs: List[Job], workers: int = 1, pool: SessionPool = None):
+        if workers <= 0:
+            msg = "Number of workers must be positive!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.jobs = jobs
+        self.workers = workers
+        self.pool = pool or SessionPool()
+        self.errors: List[tuple] = []
+        self._tasks: List[Task] = []
+
+    def tasks(self) -> List[Task]:
+        """Modules of every job, most expensive first"""
+        tasks = []
+        for job in self.jobs:
+            tasks.extend(Task(job, entry) for entry in job.modules())
+        return sorted(tasks, key=lambda task: task.cost, reverse=True)
+
+    def run(self) -> bool:
+        """Upload every job, return False if some module failed"""
+        for job in self.jobs:
+            job.scan()
+
+        self._tasks = tasks = self.tasks()
+        costs = [task.cost for task in tasks]
+        PROGRESS.plan(
+            sum(task.slides for task in tasks), sum(task.questions for task in tasks)
+        )
+        logger.info(
+            f"{len(tasks)} modules in {len(self.jobs)} courses, estimated"
+            f" {sum(costs) / 60:.0f} min serially,"
+            f" {lpt_makespan(costs, self.workers) / 60:.0f} min with {self.workers} workers"
+        )
+
+        try:
+            # structure of courses first, one course per worker
+            setup_costs = {
+                job: sum(MODULE_COST for task in tasks if task.job is job)
+                + len(job.units()) * SECTION_COST
+                for job in self.jobs
+            }
+            jobs = sorted(self.jobs, key=setup_costs.get, reverse=True)
+            self._parallel(jobs, lambda job: job.config, self._create_structure)
+
+            # then modules, longest first
+            tasks = [task for task in tasks if task.dom_id is not None]
+            self._parallel(tasks, lambda task: task.job.config, self._populate)
+        finally:
+            self.pool.close()
+
+        for item, error in self.errors:
+            logger.error(f"{item} failed: {error}")
+        return not self.errors
+
+    def _parallel(self, items: list, config_of: Callable, work: Callable):
+        """Run work(automator, item) over items, in order, with workers threads"""
+        todo: queue.Queue = queue.Queue()
+        for item in items:
+            todo.put(item)
+
+        def worker():
+            automator = None
+            try:
+                while True:
+                    try:
+                        item = todo.get_nowait()
+                    except queue.Empty:
+                        return
+                    config = config_of(item)
+                    try:
+                        if automator is not None and automator.config is not config:
+                            if session_key(automator.config) == session_key(config):
+                                automator.use_config(config)
+                            else:
+                                self.pool.release(automator)
+                                automator = None
+                        if automator is None:
+                            automator = self.pool.acquire(config)
+                        work(automator, item)
+                    except Exception as e:
+                        logger.exception(f"Error on {item}")
+                        self.errors.append((item, e))
+            finally:
+                if automator is not None:
+                    self.pool.release(automator)
+
+        threads = [
+            threading.Thread(target=worker, name=f"batch-{i}", daemon=True)
+            for i in range(min(self.workers, len(items)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _create_structure(self, automator, job: Job):
+        """Create sections and modules of a job, in directory order"""
+        tasks = {task.entry.path: task for task in self._tasks if task.job is job}
+        with log_context(course=job.course):
+            for uf_dir, mod_dirs in job.units().items():
+                mod_dirs = [entry for entry in mod_dirs if entry.path in tasks]
+                if not mod_dirs:
+                    continue
+                logger.info(f"UF directory: {uf_dir.path}")
+                section = automator.create_section(uf_dir.path.name)
+                job.sections[uf_dir.path.name] = section.dom_id
+                for mod_dir in mod_dirs:
+                    module = automator.create_module(mod_dir.path.name, section=section)
+                    tasks[mod_dir.path].dom_id = module.dom_id
+
+    def _populate(self, automator, task: Task):
+        from moodle.model import Module
+
+        with log_context(course=task.job.course, module=task.name):
+            logger.info(f"Populating {task}")
+            module = Module(automator.driver, task.name, config=automator.config)
+            module.dom_id = task.dom_id
+            module.populate(
+                task.entry.path,
+                load_only_slide=task.job.load_only_slide,
+                manifest=task.job.manifest,
+            )
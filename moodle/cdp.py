@@ -0,0 +1,870 @@
+"""Chrome driven over the DevTools protocol, without chromedriver.
+
+Every selenium command goes through chromedriver (locally, or a hub and a
+node), which translates it to DevTools protocol messages and polls the page
+for elements and navigations. This engine launches Chrome itself and talks to
+it over a websocket:
+
+- `Connection` and `Page` are an asyncio API: commands are matched to their
+  replies by id, and waits are on events (a navigation completes on
+  Page.loadEventFired, a lookup waits on a MutationObserver in the page).
+  A click or a key navigates if it requested a navigation while it was
+  dispatched: events come before the reply of the command causing them.
+- `CDPDriver` and `CDPElement` are a synchronous facade with the part of the
+  selenium WebDriver API used by moodle.model and moodle.pages (Select works
+  on them too), running the asyncio loop in a thread.
+
+Selected with `engine = cdp` in [selenium] section of configuration, for a
+local browser only. Needs the optional websockets package."""
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Any, Callable, Dict, List, Optional
+
+from selenium.common.exceptions import (
+    JavascriptException,
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+
+from moodle.network import PerformanceLog
+from moodle.utility import default_config, get_options
+
+try:
+    import websockets
+except ImportError:  # optional, needed only by the cdp engine
+    websockets = None
+
+logger = logging.getLogger(__name__)
+
+# seconds for chrome to start listening, and for a page to load
+START_TIMEOUT_S = 30
+LOAD_TIMEOUT_S = 300
+
+# executables searched in PATH when no chrome is configured
+CHROME_NAMES = ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser", "chrome")
+
+# keys sent as key events, the rest of the text is inserted as is
+SPECIAL_KEYS = {
+    Keys.BACKSPACE: dict(key="Backspace", code="Backspace", windowsVirtualKeyCode=8),
+    Keys.TAB: dict(key="Tab", code="Tab", windowsVirtualKeyCode=9),
+    Keys.ENTER: dict(key="Enter", code="Enter", windowsVirtualKeyCode=13, text="\r"),
+    Keys.RETURN: dict(key="Enter", code="Enter", windowsVirtualKeyCode=13, text="\r"),
+    Keys.ESCAPE: dict(key="Escape", code="Escape", windowsVirtualKeyCode=27),
+    Keys.DELETE: dict(key="Delete", code="Delete", windowsVirtualKeyCode=46),
+}
+
+# in-page helper: elements cross the protocol as keys of a registry, valid
+# for the document that created them (like WebElement ids of chromedriver)
+HELPER_SCRIPT = """
+(function () {
+    if (!window.__cdp) {
+        window.__cdp = {
+            token: Math.random().toString(36).slice(2),
+            nodes: [],
+            wrap: function (value) {
+                if (value instanceof Node) {
+                    var i = this.nodes.indexOf(value);
+                    if (i < 0) {
+                        i = this.nodes.push(value) - 1;
+                    }
+                    return {__node: this.token + ":" + i};
+                }
+                if (Array.isArray(value) || value instanceof NodeList
+                        || value instanceof HTMLCollection) {
+                    return Array.prototype.map.call(value, this.wrap, this);
+                }
+                if (value && typeof value === "object") {
+                    var out = {};
+                    for (var key in value) {
+                        out[key] = this.wrap(value[key]);
+                    }
+                    return out;
+                }
+                return value === undefined ? null : value;
+            },
+            unwrap: function (value) {
+                if (Array.isArray(value)) {
+                    return value.map(this.unwrap, this);
+                }
+                if (value && typeof value === "object") {
+                    if (value.__node) {
+                        var parts = value.__node.split(":");
+                        var node = this.nodes[parseInt(parts[1])];
+                        if (parts[0] !== this.token || !node || !node.isConnected) {
+                            throw new Error("stale element reference");
+                        }
+                        return node;
+                    }
+                    var out = {};
+                    for (var key in value) {
+                        out[key] = this.unwrap(value[key]);
+                    }
+                    return out;
+                }
+                return value;
+            },
+            call: function (fn, args, async) {
+                var self = this;
+                args = this.unwrap(args);
+                if (!async) {
+                    return this.wrap(fn.apply(window, args));
+                }
+                return new Promise(function (resolve) {
+                    fn.apply(window, args.concat([function (result) {
+                        resolve(self.wrap(result));
+                    }]));
+                });
+            },
+        };
+    }
+    return window.__cdp;
+})()"""
+
+# elements matching a locator, waiting at most arguments[4] ms for them
+FIND_SCRIPT = """
+var using = arguments[0], value = arguments[1], parent = arguments[2] || document;
+var multiple = arguments[3], wait = arguments[4];
+var callback = arguments[arguments.length - 1];
+function query() {
+    switch (using) {
+    case "xpath":
+        var snapshot = document.evaluate(
+            value, parent, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null
+        );
+        var nodes = [];
+        for (var i = 0; i < snapshot.snapshotLength; i++) {
+            nodes.push(snapshot.snapshotItem(i));
+        }
+        return nodes;
+    case "id":
+        return parent.querySelectorAll("#" + CSS.escape(value));
+    case "class name":
+        return parent.querySelectorAll("." + CSS.escape(value));
+    case "name":
+        return parent.querySelectorAll("[name='" + CSS.escape(value) + "']");
+    case "tag name":
+        return parent.getElementsByTagName(value);
+    case "link text":
+        return Array.prototype.filter.call(parent.querySelectorAll("a"), function (a) {
+            return a.innerText.trim() === value;
+        });
+    default:
+        return parent.querySelectorAll(value);
+    }
+}
+function result(nodes) {
+    nodes = Array.prototype.slice.call(nodes);
+    return multiple ? nodes : nodes.slice(0, 1);
+}
+var found = query();
+if (found.length || !wait) {
+    callback(result(found));
+} else {
+    var observer = new MutationObserver(function () {
+        var found = query();
+        if (found.length) {
+            observer.disconnect();
+            clearTimeout(timer);
+            callback(result(found));
+        }
+    });
+    var timer = setTimeout(function () {
+        observer.disconnect();
+        callback([]);
+    }, wait);
+    observer.observe(document, {childList: true, subtree: true, attributes: true});
+}
+"""
+
+ELEMENT_SCRIPTS = {
+    "text": "return arguments[0].innerText.trim();",
+    "tag_name": "return arguments[0].tagName.toLowerCase();",
+    "is_selected": "return !!(arguments[0].selected || arguments[0].checked);",
+    # property if any (as selenium does), otherwise attribute
+    "get_attribute": """
+        var el = arguments[0], value = el[arguments[1]];
+        if (value === undefined || value === null || typeof value === "object") {
+            value = el.getAttribute(arguments[1]);
+        }
+        if (typeof value === "boolean") {
+            return value ? "true" : null;
+        }
+        return value === null ? null : String(value);
+    """,
+    "clear": """
+        var el = arguments[0];
+        if (el.isContentEditable) {
+            el.innerHTML = "";
+        } else {
+            el.value = "";
+        }
+        el.dispatchEvent(new Event("input", {bubbles: true}));
+        el.dispatchEvent(new Event("change", {bubbles: true}));
+    """,
+    # focus with the caret at the end, so that text is appended
+    "focus": """
+        var el = arguments[0];
+        el.scrollIntoView({block: "center"});
+        el.focus();
+        if (el.isContentEditable) {
+            var range = document.createRange();
+            range.selectNodeContents(el);
+            range.collapse(false);
+            var selection = window.getSelection();
+            selection.removeAllRanges();
+            selection.addRange(range);
+        } else if (typeof el.value === "string" && el.setSelectionRange) {
+            try {
+                el.setSelectionRange(el.value.length, el.value.length);
+            } catch (e) {}
+        }
+        return el.tagName.toLowerCase() === "input" && el.type === "file";
+    """,
+    # center of the element in viewport, or null for options (not clickable)
+    "click_point": """
+        var el = arguments[0];
+        if (el.tagName.toLowerCase() === "option") {
+            return null;
+        }
+        el.scrollIntoView({block: "center", inline: "center"});
+        var rect = el.getBoundingClientRect();
+        return [rect.left + rect.width / 2, rect.top + rect.height / 2];
+    """,
+    "select_option": """
+        var option = arguments[0], select = option.closest("select");
+        option.selected = true;
+        if (select) {
+            select.dispatchEvent(new Event("input", {bubbles: true}));
+            select.dispatchEvent(new Event("change", {bubbles: true}));
+        }
+    """,
+    "submit": """
+        var el = arguments[0], form = el.tagName.toLowerCase() === "form" ? el : el.form;
+        if (!form) {
+            throw new Error("element is not in a form");
+        }
+        form.submit();
+    """,
+}
+
+
+def find_chrome(config: dict) -> str:
+    chrome = config["selenium"].get("chrome")
+    if chrome:
+        return chrome
+    for name in CHROME_NAMES:
+        path = shutil.which(name)
+        if path:
+            return path
+    msg = f"Cannot find chrome in PATH ({', '.join(CHROME_NAMES)}), set chrome in config!"
+    logger.error(msg)
+    raise WebDriverException(msg)
+
+
+class Connection:
+    """Websocket to a DevTools target: commands are matched to their replies
+    by id, events are dispatched to waiters and listeners"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.ids = itertools.count(1)
+        self.pending: Dict[int, asyncio.Future] = {}
+        # one-shot waiters of an event, with their filter
+        self.waiters: Dict[str, list] = collections.defaultdict(list)
+        self.listeners: Dict[str, List[Callable[[dict], None]]] = collections.defaultdict(list)
+        self._reader: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def connect(cls, url: str) -> "Connection":
+        if websockets is None:
+            msg = "The cdp engine needs the websockets package!"
+            logger.error(msg)
+            raise WebDriverException(msg)
+
+        ws = await websockets.connect(url, max_size=None, ping_interval=None)
+        connection = cls(ws)
+        connection._reader = asyncio.ensure_future(connection._read())
+        return connection
+
+    async def send(self, method: str, **params) -> dict:
+        id_ = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[id_] = future
+        await self.ws.send(json.dumps({"id": id_, "method": method, "params": params}))
+        return await future
+
+    def wait_for(self, method: str, predicate: Callable[[dict], bool] = None) -> asyncio.Future:
+        """Future of the next event `method` (matching predicate)"""
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[method].append((predicate, future))
+        return future
+
+    def on(self, method: str, callback: Callable[[dict], None]):
+        self.listeners[method].append(callback)
+
+    async def close(self):
+        await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+
+    async def _read(self):
+        try:
+            async for raw in self.ws:
+                message = json.loads(raw)
+                if "id" in message:
+                    self._reply(message)
+                else:
+                    self._dispatch(message.get("method"), message.get("params", {}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(WebDriverException("DevTools connection closed"))
+            self.pending.clear()
+
+    def _reply(self, message: dict):
+        future = self.pending.pop(message["id"], None)
+        if future is None or future.done():
+            return
+        if "error" in message:
+            error = message["error"]
+            future.set_exception(
+                WebDriverException(f"{error.get('message')} {error.get('data', '')}".strip())
+            )
+        else:
+            future.set_result(message.get("result", {}))
+
+    def _dispatch(self, method: str, params: dict):
+        waiting = []
+        for predicate, future in self.waiters.pop(method, []):
+            if future.done():
+                continue
+            if predicate is None or predicate(params):
+                future.set_result(params)
+            else:
+                waiting.append((predicate, future))
+        if waiting:
+            self.waiters[method] = waiting
+
+        for callback in self.listeners.get(method, ()):
+            callback(params)
+
+
+class Page:
+    """Asyncio API over a page target: navigation, scripts, lookups, input"""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.frame_id: Optional[str] = None
+        # seconds, like implicit wait and script timeout of WebDriver
+        self.implicit_wait = 0.0
+        self.script_timeout = 30.0
+
+    async def start(self):
+        await self.connection.send("Page.enable")
+        tree = await self.connection.send("Page.getFrameTree")
+        self.frame_id = tree["frameTree"]["frame"]["id"]
+
+    @contextlib.asynccontextmanager
+    async def navigation(self, expected: bool = True):
+        """Wait for the load of the page after the block. If not `expected`
+        the block may as well not navigate at all (e.g. a click): it's
+        waited for only if requested by the time the block is done"""
+        is_main_frame = lambda params: params.get("frameId") == self.frame_id  # noqa: E731
+        requested = self.connection.wait_for("Page.frameRequestedNavigation", is_main_frame)
+        started = self.connection.wait_for("Page.frameStartedLoading", is_main_frame)
+        loaded = self.connection.wait_for("Page.loadEventFired")
+        try:
+            yield
+            if not expected and not (requested.done() or started.done()):
+                return
+            try:
+                await asyncio.wait_for(asyncio.shield(loaded), LOAD_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                raise TimeoutException(f"Page not loaded in {LOAD_TIMEOUT_S}s") from None
+        finally:
+            requested.cancel()
+            started.cancel()
+            loaded.cancel()
+
+    async def navigate(self, url: str):
+        async with self.navigation():
+            result = await self.connection.send("Page.navigate", url=url)
+            if result.get("errorText"):
+                raise WebDriverException(f"Cannot navigate to {url}: {result['errorText']}")
+
+    async def reload(self):
+        async with self.navigation():
+            await self.connection.send("Page.reload")
+
+    async def evaluate(self, script: str, args: list = (), is_async: bool = False, timeout=None):
+        """Run a script as a function body with arguments, as selenium does.
+        Async scripts get a callback as last argument"""
+        expression = (
+            f"{HELPER_SCRIPT}.call(function () {{\n{script}\n}},"
+            f" {json.dumps(args)}, {json.dumps(is_async)})"
+        )
+        timeout = self.script_timeout if timeout is None else timeout
+        try:
+            result = await asyncio.wait_for(
+                self.connection.send(
+                    "Runtime.evaluate",
+                    expression=expression,
+                    awaitPromise=True,
+                    returnByValue=True,
+                    userGesture=True,
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutException(f"Script did not complete in {timeout}s") from None
+
+        if "exceptionDetails" in result:
+            details = result["exceptionDetails"]
+            message = details.get("exception", {}).get("description") or details.get("text")
+            if "stale element reference" in str(message):
+                raise StaleElementReferenceException(message)
+            raise JavascriptException(message)
+        return result["result"].get("value")
+
+    async def find(self, using: str, value: str, parent=None, multiple: bool = False) -> list:
+        wait_ms = int(self.implicit_wait * 1000)
+        return await self.evaluate(
+            FIND_SCRIPT,
+            [using, value, parent, multiple, wait_ms],
+            is_async=True,
+            timeout=self.implicit_wait + self.script_timeout,
+        )
+
+    async def object_id(self, node: dict) -> str:
+        """Runtime object id of an element, for commands wanting a node"""
+        result = await self.connection.send(
+            "Runtime.evaluate",
+            expression=f"{HELPER_SCRIPT}.unwrap({json.dumps(node)})",
+        )
+        if "exceptionDetails" in result:
+            raise StaleElementReferenceException("stale element reference")
+        return result["result"]["objectId"]
+
+    async def click(self, node: dict):
+        point = await self.evaluate(ELEMENT_SCRIPTS["click_point"], [node])
+        async with self.navigation(expected=False):
+            if point is None:
+                await self.evaluate(ELEMENT_SCRIPTS["select_option"], [node])
+                return
+            x, y = point
+            send = self.connection.send
+            await send("Input.dispatchMouseEvent", type="mouseMoved", x=x, y=y)
+            for type_ in ("mousePressed", "mouseReleased"):
+                await send(
+                    "Input.dispatchMouseEvent",
+                    type=type_,
+                    x=x,
+                    y=y,
+                    button="left",
+                    clickCount=1,
+                )
+
+    async def type(self, node: dict, text: str):
+        """Type text into an element, appended to its value. Into a file
+        input, text is the path of the file to choose"""
+        is_file = await self.evaluate(ELEMENT_SCRIPTS["focus"], [node])
+        if is_file:
+            await self.set_files(node, [text])
+            return
+
+        chunk = ""
+        for char in text:
+            if char not in SPECIAL_KEYS:
+                chunk += char
+                continue
+            if chunk:
+                await self.connection.send("Input.insertText", text=chunk)
+                chunk = ""
+            await self.press(char)
+        if chunk:
+            await self.connection.send("Input.insertText", text=chunk)
+
+    async def press(self, key: str):
+        """Press a special key (selenium Keys) on the focused element"""
+        event = SPECIAL_KEYS[key]
+        # enter can submit a form
+        async with self.navigation(expected=False):
+            await self.connection.send("Input.dispatchKeyEvent", type="keyDown", **event)
+            await self.connection.send("Input.dispatchKeyEvent", type="keyUp", **event)
+
+    async def set_files(self, node: dict, paths: List[str]):
+        object_id = await self.object_id(node)
+        await self.connection.send(
+            "DOM.setFileInputFiles", files=[str(path) for path in paths], objectId=object_id
+        )
+
+    async def submit(self, node: dict):
+        async with self.navigation():
+            await self.evaluate(ELEMENT_SCRIPTS["submit"], [node])
+
+    async def cookies(self) -> List[dict]:
+        result = await self.connection.send("Network.getCookies")
+        return result["cookies"]
+
+    async def set_cookie(self, url: str, cookie: dict):
+        params = {
+            key: cookie[key]
+            for key in ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite")
+            if key in cookie
+        }
+        if "expiry" in cookie:
+            params["expires"] = cookie["expiry"]
+        await self.connection.send("Network.setCookie", url=url, **params)
+
+
+def _to_js(value):
+    """Arguments for scripts: elements become registry keys"""
+    if isinstance(value, CDPElement):
+        return value.node
+    if isinstance(value, (list, tuple)):
+        return [_to_js(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_js(item) for key, item in value.items()}
+    return value
+
+
+class _Finder:
+    """find_element_by_* helpers of selenium, over find_element(s)"""
+
+    def find_element(self, by=By.ID, value=None):
+        raise NotImplementedError
+
+    def find_elements(self, by=By.ID, value=None):
+        raise NotImplementedError
+
+    def find_element_by_id(self, id_):
+        return self.find_element(By.ID, id_)
+
+    def find_elements_by_id(self, id_):
+        return self.find_elements(By.ID, id_)
+
+    def find_element_by_name(self, name):
+        return self.find_element(By.NAME, name)
+
+    def find_elements_by_name(self, name):
+        return self.find_elements(By.NAME, name)
+
+    def find_element_by_class_name(self, name):
+        return self.find_element(By.CLASS_NAME, name)
+
+    def find_elements_by_class_name(self, name):
+        return self.find_elements(By.CLASS_NAME, name)
+
+    def find_element_by_css_selector(self, css_selector):
+        return self.find_element(By.CSS_SELECTOR, css_selector)
+
+    def find_elements_by_css_selector(self, css_selector):
+        return self.find_elements(By.CSS_SELECTOR, css_selector)
+
+    def find_element_by_tag_name(self, name):
+        return self.find_element(By.TAG_NAME, name)
+
+    def find_elements_by_tag_name(self, name):
+        return self.find_elements(By.TAG_NAME, name)
+
+    def find_element_by_xpath(self, xpath):
+        return self.find_element(By.XPATH, xpath)
+
+    def find_elements_by_xpath(self, xpath):
+        return self.find_elements(By.XPATH, xpath)
+
+    def find_element_by_link_text(self, link_text):
+        return self.find_element(By.LINK_TEXT, link_text)
+
+
+class CDPElement(_Finder):
+    """An element of the page, like a selenium WebElement"""
+
+    def __init__(self, driver: "CDPDriver", node: dict):
+        self._parent = driver
+        self.node = node
+
+    @property
+    def parent(self) -> "CDPDriver":
+        return self._parent
+
+    @property
+    def id(self) -> str:
+        return self.node["__node"]
+
+    def __eq__(self, other):
+        return isinstance(other, CDPElement) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"CDPElement({self.id})"
+
+    def _script(self, name: str, *args):
+        script = ELEMENT_SCRIPTS[name]
+        return self._parent.run(self._parent.page.evaluate(script, [self.node, *args]))
+
+    @property
+    def text(self) -> str:
+        return self._script("text")
+
+    @property
+    def tag_name(self) -> str:
+        return self._script("tag_name")
+
+    def get_attribute(self, name: str) -> Optional[str]:
+        return self._script("get_attribute", name)
+
+    def is_selected(self) -> bool:
+        return self._script("is_selected")
+
+    def click(self):
+        self._parent.run(self._parent.page.click(self.node))
+
+    def send_keys(self, *value):
+        text = "".join(str(item) for item in value)
+        self._parent.run(self._parent.page.type(self.node, text))
+
+    def clear(self):
+        self._script("clear")
+
+    def submit(self):
+        self._parent.run(self._parent.page.submit(self.node))
+
+    def find_element(self, by=By.ID, value=None):
+        return self._parent._find(by, value, parent=self)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self._parent._find(by, value, parent=self, multiple=True)
+
+
+class _SwitchTo:
+    def __init__(self, driver: "CDPDriver"):
+        self._driver = driver
+
+    @property
+    def active_element(self) -> CDPElement:
+        return self._driver.execute_script("return document.activeElement;")
+
+
+class CDPDriver(_Finder):
+    """Synchronous facade of a Page, with the WebDriver API used by model"""
+
+    def __init__(self, connection: Connection, loop: asyncio.AbstractEventLoop, process=None):
+        self.loop = loop
+        self.connection = connection
+        self.page = Page(connection)
+        # chrome process, `service.process` as for a local selenium Chrome
+        self.service = type("Service", (), {"process": process})()
+        self._user_data_dir: Optional[str] = None
+        self.switch_to = _SwitchTo(self)
+        # network events as chromedriver performance log, once enabled
+        self._performance_log: Optional[PerformanceLog] = None
+        self.run(self.page.start())
+
+    @classmethod
+    def launch(cls, config: dict = None, **kwargs) -> "CDPDriver":
+        """Start a local chrome, with the options of a selenium one"""
+        config = config or default_config()
+        arguments = [f"--{argument}" for argument in get_options(config, **kwargs).arguments]
+
+        user_data_dir = next(
+            (arg.split("=", 1)[1] for arg in arguments if arg.startswith("--user-data-dir=")),
+            None,
+        )
+        temporary = user_data_dir is None
+        if temporary:
+            user_data_dir = tempfile.mkdtemp(prefix="moodle-cdp-")
+            arguments.append(f"--user-data-dir={user_data_dir}")
+
+        # a port left by a previous run would be read before chrome writes its own
+        port_file = pathlib.Path(user_data_dir) / "DevToolsActivePort"
+        with contextlib.suppress(FileNotFoundError):
+            port_file.unlink()
+
+        process = subprocess.Popen(
+            [
+                find_chrome(config),
+                "--remote-debugging-port=0",
+                "--no-first-run",
+                "--no-default-browser-check",
+                "--window-size=1920,1080",
+                *arguments,
+                "about:blank",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            url = cls._page_url(port_file, process)
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="cdp-loop", daemon=True).start()
+            connection = asyncio.run_coroutine_threadsafe(Connection.connect(url), loop).result()
+            driver = cls(connection, loop, process)
+            if kwargs.get("performance_log"):
+                driver.enable_performance_log()
+        except BaseException:
+            process.kill()
+            raise
+
+        if temporary:
+            driver._user_data_dir = user_data_dir
+        logger.info(f"Chrome started with DevTools protocol on {url}")
+        return driver
+
+    @staticmethod
+    def _page_url(port_file: pathlib.Path, process) -> str:
+        """Websocket url of the page of a starting chrome"""
+        deadline = time.monotonic() + START_TIMEOUT_S
+        while not port_file.exists():
+            if process.poll() is not None:
+                raise WebDriverException(f"Chrome exited with code {process.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutException(f"Chrome not listening after {START_TIMEOUT_S}s")
+            time.sleep(0.05)
+
+        port = int(port_file.read_text().split()[0])
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/json/list", timeout=10) as r:
+            targets = json.load(r)
+        return next(t["webSocketDebuggerUrl"] for t in targets if t["type"] == "page")
+
+    def run(self, coroutine) -> Any:
+        """Run a coroutine of the engine, returning its result"""
+        result = asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        return self._from_js(result)
+
+    def _from_js(self, value):
+        if isinstance(value, dict):
+            if set(value) == {"__node"}:
+                return CDPElement(self, value)
+            return {key: self._from_js(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._from_js(item) for item in value]
+        return value
+
+    def _find(self, by, value, parent: CDPElement = None, multiple: bool = False):
+        found = self.run(
+            self.page.find(by, value, parent.node if parent is not None else None, multiple)
+        )
+        if multiple:
+            return found
+        if not found:
+            raise NoSuchElementException(f"Unable to locate element: {by}={value}")
+        return found[0]
+
+    def find_element(self, by=By.ID, value=None):
+        return self._find(by, value)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self._find(by, value, multiple=True)
+
+    def implicitly_wait(self, time_to_wait: float):
+        self.page.implicit_wait = time_to_wait
+
+    def set_script_timeout(self, time_to_wait: float):
+        self.page.script_timeout = time_to_wait
+
+    def maximize_window(self):
+        # window size is set when chrome starts
+        pass
+
+    def get(self, url: str):
+        self.run(self.page.navigate(url))
+
+    def refresh(self):
+        self.run(self.page.reload())
+
+    @property
+    def current_url(self) -> str:
+        return self.execute_script("return location.href;")
+
+    @property
+    def title(self) -> str:
+        return self.execute_script("return document.title;")
+
+    @property
+    def page_source(self) -> str:
+        return self.execute_script("return document.documentElement.outerHTML;")
+
+    def execute_script(self, script: str, *args):
+        return self.run(self.page.evaluate(script, _to_js(list(args))))
+
+    def execute_async_script(self, script: str, *args):
+        return self.run(self.page.evaluate(script, _to_js(list(args)), is_async=True))
+
+    def execute_cdp_cmd(self, cmd: str, cmd_args: dict) -> dict:
+        return self.run(self.connection.send(cmd, **cmd_args))
+
+    def execute(self, driver_command: str, params: dict = None) -> dict:
+        """Only DevTools commands tunnelled as chromedriver does"""
+        if driver_command == "executeCdpCommand":
+            return {"value": self.execute_cdp_cmd(params["cmd"], params.get("params", {}))}
+        raise WebDriverException(f"Command {driver_command} not supported by cdp engine")
+
+    def get_cookies(self) -> List[dict]:
+        cookies = []
+        for cookie in self.run(self.page.cookies()):
+            converted = {
+                key: cookie[key]
+                for key in ("name", "value", "domain", "path", "secure", "httpOnly")
+                if key in cookie
+            }
+            # session cookies have no expiry
+            if cookie.get("expires", -1) > 0:
+                converted["expiry"] = int(cookie["expires"])
+            cookies.append(converted)
+        return cookies
+
+    def add_cookie(self, cookie_dict: dict):
+        self.run(self.page.set_cookie(self.current_url, cookie_dict))
+
+    def enable_performance_log(self):
+        self._performance_log = log = PerformanceLog()
+        for method in PerformanceLog.METHODS:
+            self.connection.on(method, log.listener(method))
+        self.run(self.connection.send("Network.enable"))
+
+    def get_log(self, log_type: str) -> List[dict]:
+        if log_type != "performance" or self._performance_log is None:
+            raise WebDriverException(f"Log {log_type} not enabled in cdp engine")
+        return self._performance_log.drain()
+
+    def delete_all_cookies(self):
+        self.run(self.connection.send("Network.clearBrowserCookies"))
+
+    def quit(self):
+        try:
+            with contextlib.suppress(Exception):
+                asyncio.run_coroutine_threadsafe(
+                    self.connection.send("Browser.close"), self.loop
+                ).result(timeout=5)
+        finally:
+            process = self.service.process
+            if process is not None:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            with contextlib.suppress(Exception):
+                asyncio.run_coroutine_threadsafe(self.connection.close(), self.loop).result(5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            if self._user_data_dir is not None:
+                shutil.rmtree(self._user_data_dir, ignore_errors=True)
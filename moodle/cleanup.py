@@ -0,0 +1,187 @@
+"""Rollback of what a run created.
+
+Automator records every section and module it creates in a journal (one json
+object per line), with the run id of moodle.logs. Cleaner deletes them from
+the course with a single script fetching Moodle delete urls from the page
+itself, instead of a confirmation page per object, and can truncate a lesson
+from a given slide onwards, so that a failed upload can be resumed."""
+import logging
+from typing import List, Optional
+
+from moodle.journal import Journal
+from moodle.structure import module_id_of
+from moodle.sync import read_lesson
+from moodle.utility import get_course_url, get_lesson_url
+
+logger = logging.getLogger(__name__)
+
+# seconds a bulk delete can take, the whole batch is one script
+SCRIPT_TIMEOUT_S = 300
+
+# fetch every url from the page, with its session cookies; returns whether each
+# request got a successful response, which Moodle also sends with an error
+# page (e.g. sesskey expired): callers check what has gone by reading again.
+# Sequential requests wait for the previous one
+FETCH_ALL_SCRIPT = """
+var urls = arguments[0], sequential = arguments[1];
+var callback = arguments[arguments.length - 1];
+function fetchOne(url) {
+    return fetch(url, {credentials: "same-origin"})
+        .then(function (response) { return response.ok; })
+        .catch(function () { return false; });
+}
+if (sequential) {
+    var results = [];
+    urls.reduce(function (previous, url) {
+        return previous.then(function () {
+            return fetchOne(url).then(function (ok) { results.push(ok); });
+        });
+    }, Promise.resolve()).then(function () { callback(results); });
+} else {
+    Promise.all(urls.map(fetchOne)).then(callback);
+}
+"""
+
+
+class Cleaner:
+    def __init__(self, automator):
+        self.automator = automator
+        self.driver = automator.driver
+        self.config = automator.config
+
+    @property
+    def sesskey(self) -> str:
+        return self.driver.execute_script("return M.cfg.sesskey;")
+
+    def fetch_all(self, urls: List[str], sequential: bool = False) -> List[bool]:
+        """Request urls from the current page, in one WebDriver command.
+        Return whether each one got a successful response"""
+        if not urls:
+            return []
+        self.driver.set_script_timeout(SCRIPT_TIMEOUT_S)
+        return self.driver.execute_async_script(FETCH_ALL_SCRIPT, urls, sequential)
+
+    def delete_created(self, journal: Journal, run: str = None) -> int:
+        """Delete sections and modules created by a run, return how many"""
+        course = self.config["site"]["course"]
+        entries = journal.created(course, run)
+        if not entries:
+            logger.info("Nothing to clean up")
+            return 0
+
+        structure = self.automator.refresh_structure()
+        sesskey = self.sesskey
+
+        sections, modules = [], []
+        for entry in entries:
+            if entry["kind"] == "section":
+                info = structure.section(entry["dom_id"])
+                # section numbers shift when some are deleted, so check name too
+                if info is None or info.name != entry["name"] or info.section_id is None:
+                    logger.warning(f"Section {entry['name']} not found, skipped")
+                    continue
+                sections.append((entry, info))
+            else:
+                module_id = module_id_of(entry["dom_id"])
+                if structure.activity(module_id) is None:
+                    logger.warning(f"Module {entry['name']} not found, skipped")
+                    continue
+                modules.append(entry)
+
+        # modules inside a section to delete go with it
+        section_of = {
+            entry["dom_id"]: structure.activity(module_id_of(entry["dom_id"])).section.section_id
+            for entry in modules
+        }
+        section_ids = {info.section_id for _, info in sections}
+        inside = [entry for entry in modules if section_of[entry["dom_id"]] in section_ids]
+        modules = [entry for entry in modules if entry not in inside]
+
+        module_urls = [
+            get_course_url(
+                "mod.php",
+                self.config,
+                delete=module_id_of(entry["dom_id"]),
+                confirm=1,
+                sesskey=sesskey,
+            )
+            for entry in modules
+        ]
+        section_urls = [
+            get_course_url(
+                "editsection.php",
+                self.config,
+                id=info.section_id,
+                sr=0,
+                delete=1,
+                confirm=1,
+                sesskey=sesskey,
+            )
+            for _, info in sections
+        ]
+
+        # modules are independent, sections are renumbered by each delete
+        results = self.fetch_all(module_urls)
+        results += self.fetch_all(section_urls, sequential=True)
+
+        # check on the course page what has actually gone
+        self.automator.go_to_course()
+        structure = self.automator.refresh_structure()
+        deleted = [
+            entry
+            for entry in modules
+            if structure.activity(module_id_of(entry["dom_id"])) is None
+        ]
+        remaining_ids = {info.section_id for info in structure.sections}
+        deleted += [entry for entry, info in sections if info.section_id not in remaining_ids]
+        deleted += [entry for entry in inside if section_of[entry["dom_id"]] not in remaining_ids]
+        journal.mark_deleted(deleted)
+
+        failed = len(modules) + len(inside) + len(sections) - len(deleted)
+        logger.info(
+            f"Deleted {len(deleted)} objects with {len(results)} requests"
+            + (f", {failed} not deleted" if failed else "")
+        )
+        return len(deleted)
+
+    def truncate_lesson(self, module, from_slide: int) -> int:
+        """Delete pages of a lesson from the given slide onwards (questions
+        following them too), return how many"""
+        prefix = self.config["file_parameters"]["base_name_in_course"]
+        title = f"{prefix}{from_slide}"
+
+        pages = read_lesson(self.driver, module.module_id, self.config)
+        start: Optional[int] = next(
+            (i for i, page in enumerate(pages) if page.title == title), None
+        )
+        if start is None:
+            msg = f"Cannot find page '{title}' in lesson!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        sesskey = self.sesskey
+        # from the last one, each delete relinks only the page before it
+        urls = [
+            get_lesson_url(
+                "lesson.php",
+                self.config,
+                id=module.module_id,
+                action="delete",
+                pageid=page.id,
+                sesskey=sesskey,
+            )
+            for page in reversed(pages[start:])
+        ]
+        results = self.fetch_all(urls, sequential=True)
+
+        # check in lesson what has actually gone
+        remaining = {page.id for page in read_lesson(self.driver, module.module_id, self.config)}
+        deleted = sum(1 for page in pages[start:] if page.id not in remaining)
+        failed = len(urls) - deleted
+        logger.info(
+            f"Deleted {deleted}/{len(urls)} pages of {module} from '{title}'"
+            f" with {sum(results)} successful requests"
+        )
+        if failed:
+            logger.warning(f"{failed} pages of {module} not deleted")
+        return deleted
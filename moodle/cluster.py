@@ -1,9 +1,31 @@
+import bisect
 import json
+import logging
 import os
-from typing import Sequence, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # optional, faster parsing of big question banks
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # optional, needed to stream clusters from file
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+
+def load_json(json_fp: Union[str, os.PathLike]) -> dict:
+    with open(json_fp, "rb") as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data.decode("utf-8"))
 
 
 class Answer:
+    __slots__ = ("is_correct", "text", "html")
+
     def __init__(self, json_dict: dict):
         self.is_correct: bool = json_dict["is_correct"]
         self.text: str = json_dict["text"]
@@ -11,25 +33,102 @@ class Answer:
 
 
 class Question:
+    __slots__ = ("name", "number", "jump2slide", "_answers")
+
     def __init__(self, json_dict: dict):
         self.name: str = json_dict["name"]
         self.number: int = json_dict["number"]
         self.jump2slide: int = json_dict["jump2slide"]
-        self.answers: Sequence[Answer] = [Answer(obj) for obj in json_dict["answers"]]
+        self._answers = json_dict["answers"]
+
+    @property
+    def answers(self) -> Sequence[Answer]:
+        # built on first access, most answers are only read while uploading
+        if self._answers and not isinstance(self._answers[0], Answer):
+            self._answers = [Answer(obj) for obj in self._answers]
+        return self._answers
 
 
 class Cluster:
+    __slots__ = ("min_slide_in_cluster", "max_slide_in_cluster", "_questions")
+
     def __init__(self, json_dict: dict):
         self.min_slide_in_cluster: int = json_dict["min_slide_in_cluster"]
         self.max_slide_in_cluster: int = json_dict["max_slide_in_cluster"]
-        self.questions: Sequence[Question] = [
-            Question(obj) for obj in json_dict["questions"]
-        ]
+        self._questions = json_dict["questions"]
+
+    @property
+    def questions(self) -> Sequence[Question]:
+        if self._questions and not isinstance(self._questions[0], Question):
+            self._questions = [Question(obj) for obj in self._questions]
+        return self._questions
+
+    @property
+    def num_questions(self) -> int:
+        return len(self._questions)
+
+    def __contains__(self, slide_index: int) -> bool:
+        return self.min_slide_in_cluster <= slide_index <= self.max_slide_in_cluster
+
+
+def iter_clusters(json_fp: Union[str, os.PathLike]) -> Iterator[Cluster]:
+    """Yield clusters of a json file one by one. Without ijson installed
+    the whole file is parsed first"""
+    if ijson is None:
+        yield from (Cluster(obj) for obj in load_json(json_fp)["clusters"])
+        return
+
+    with open(json_fp, "rb") as f:
+        yield from (Cluster(obj) for obj in ijson.items(f, "clusters.item"))
+
+
+def count_work(json_fp: Union[str, os.PathLike]) -> Tuple[int, int]:
+    """Questions and clusters of a json file, without keeping its clusters"""
+    questions = clusters = 0
+    for cluster in iter_clusters(json_fp):
+        questions += cluster.num_questions
+        clusters += 1
+    return questions, clusters
 
 
 class ModuleCluster:
     def __init__(self, json_fp: Union[str, os.PathLike]):
-        json_dict: dict = json.load(open(json_fp, encoding="utf-8"))
-        self.clusters: Sequence[Cluster] = [
-            Cluster(obj) for obj in json_dict["clusters"]
-        ]
+        # streamed from file when ijson is installed, sorted by max slide
+        self.clusters: Sequence[Cluster] = sorted(
+            iter_clusters(json_fp), key=lambda cluster: cluster.max_slide_in_cluster
+        )
+
+        # questions of a cluster follow its max slide, so it must be unique
+        self._by_max_slide: Dict[int, Cluster] = {}
+        for cluster in self.clusters:
+            if cluster.max_slide_in_cluster in self._by_max_slide:
+                msg = (
+                    f"More than one cluster ending at slide {cluster.max_slide_in_cluster}"
+                    f" in {json_fp}!"
+                )
+                logger.error(msg)
+                raise ValueError(msg)
+            self._by_max_slide[cluster.max_slide_in_cluster] = cluster
+
+        # interval index, from slide number to cluster
+        self._ends: List[int] = [cluster.max_slide_in_cluster for cluster in self.clusters]
+
+    @property
+    def max_slides(self) -> frozenset:
+        """Max slide of every cluster, the ones followed by questions"""
+        return frozenset(self._by_max_slide)
+
+    @property
+    def num_questions(self) -> int:
+        return sum(cluster.num_questions for cluster in self.clusters)
+
+    def find(self, slide_index: int) -> Optional[Cluster]:
+        """Return the cluster containing a slide, if any"""
+        i = bisect.bisect_left(self._ends, slide_index)
+        if i < len(self.clusters) and slide_index in self.clusters[i]:
+            return self.clusters[i]
+        return None
+
+    def from_slide(self, slide_index: int) -> Sequence[Cluster]:
+        """Clusters not ending before a slide, the ones left to upload from it"""
+        return self.clusters[bisect.bisect_left(self._ends, slide_index) :]
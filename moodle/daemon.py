@@ -0,0 +1,318 @@
+"""Resident uploader, keeping logged in browsers between runs.
+
+Every run of main.py pays browser start, login and edit mode before its
+first slide. `main.py --daemon` pays them once: it keeps `--sessions` logged
+in Automators and serves jobs on a local socket (a unix socket, or a
+localhost tcp port where there are none, e.g. on Windows). While it runs,
+upload and sync actions of main.py are sent to it instead of starting a
+browser of their own.
+
+A job is a json line with the arguments of the action and the configuration
+file to read; the daemon answers with the records logged by the job, a json
+line each, and then with its outcome:
+
+    {"log": "... :: INFO :: [model.load_slide.575] :: [job=3] Slide uploaded"}
+    {"done": true, "ok": true, "run": "3f2a9c1e-3"}
+
+Jobs run on a free session, waiting for one when all are busy, and go on
+even if their client is gone. Every job has a run id of its own, the one of
+the daemon and the job number: sections and modules it creates are recorded
+in the journal with it, for `--cleanup --run` to delete those of a job."""
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from moodle.logs import FORMAT, RUN_ID, ContextFilter, log_context
+from moodle.utility import get_config
+
+logger = logging.getLogger(__name__)
+
+# port of the daemon where unix sockets are missing
+DEFAULT_PORT = 47610
+
+# seconds a client waits to reach the daemon, before running jobs itself
+CONNECT_TIMEOUT_S = 0.5
+
+# sessions idle for longer are checked (browser alive, still logged in)
+# before their next job, Moodle sessions expiring after a few hours
+RESUME_AFTER_S = 300
+
+Address = Union[str, Tuple[str, int]]
+
+
+def default_address() -> Address:
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(tempfile.gettempdir(), f"moodle-uploader-{os.getuid()}.sock")
+    return ("127.0.0.1", DEFAULT_PORT)
+
+
+def parse_address(value: Optional[str]) -> Address:
+    """Address given from command line: a port on localhost, or the path of
+    a unix socket"""
+    if not value:
+        return default_address()
+    if value.isdigit():
+        return ("127.0.0.1", int(value))
+    if not hasattr(socket, "AF_UNIX"):
+        msg = f"Unix sockets not available, daemon address must be a port: {value}"
+        logger.error(msg)
+        raise ValueError(msg)
+    return value
+
+
+def connect(address: Address, timeout: float = None) -> socket.socket:
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Client:
+    """Send jobs to a running daemon"""
+
+    def __init__(self, address: Address = None):
+        self.address = address or default_address()
+
+    def send(self, job: dict, output: Callable[[str], None] = None) -> Optional[dict]:
+        """Send a job and pass its log lines to `output` while it runs.
+        Return its outcome, or None if no daemon is listening"""
+        try:
+            sock = connect(self.address, CONNECT_TIMEOUT_S)
+        except OSError:
+            return None
+
+        with sock:
+            # jobs take as long as they take
+            sock.settimeout(None)
+            sock.sendall(json.dumps(job).encode("utf-8") + b"\n")
+            with sock.makefile("r", encoding="utf-8") as f:
+                for line in f:
+                    message = json.loads(line)
+                    if message.get("done"):
+                        return message
+                    if output is not None:
+                        output(message["log"])
+
+        msg = f"Daemon on {self.address} closed connection before job was done!"
+        logger.error(msg)
+        raise ConnectionError(msg)
+
+
+class JobLogHandler(logging.Handler):
+    """Send records logged by a job (inside its log_context) to its client"""
+
+    def __init__(self, job: int, send: Callable[[dict], None], level: int = logging.INFO):
+        super().__init__(level)
+        self.job = job
+        self.send = send
+        self.addFilter(ContextFilter())
+        self.setFormatter(logging.Formatter(FORMAT))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return bool(super().filter(record)) and record.fields.get("job") == self.job
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.send({"log": self.format(record)})
+        except Exception:
+            self.handleError(record)
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.lock = threading.Lock()
+        line = self.rfile.readline()
+        if not line.strip():
+            # client only checking that the daemon is up
+            return
+
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            self.send(dict(done=True, ok=False, error=f"Invalid job: {e}", run=RUN_ID))
+            return
+        self.server.daemon.handle(job, self.send)
+
+    def send(self, message: dict):
+        data = json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n"
+        try:
+            with self.lock:
+                self.wfile.write(data)
+        except OSError:
+            # client gone, the job goes on
+            pass
+
+
+class TCPJobServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class Daemon:
+    """Serve jobs on logged in Automators kept between them.
+
+    `runner(automator, job)` runs a job on an Automator already working on
+    the course of the job configuration, raising if it fails"""
+
+    def __init__(
+        self,
+        runner: Callable,
+        factory: Callable,
+        *,
+        address: Address = None,
+        sessions: int = 1,
+    ):
+        if sessions <= 0:
+            msg = "Number of sessions must be positive!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.runner = runner
+        self.factory = factory
+        self.address = address or default_address()
+        self.sessions = sessions
+
+        self.idle: queue.Queue = queue.Queue()
+        self.automators = []
+        # monotonic time of the last job of every session, by id
+        self.last_used: Dict[int, float] = {}
+        self.server: Optional[socketserver.BaseServer] = None
+        self.lock = threading.Lock()
+        self.jobs = 0
+
+    def start_sessions(self):
+        """Start and login every session, concurrently"""
+        with concurrent.futures.ThreadPoolExecutor(
+            self.sessions, thread_name_prefix="session"
+        ) as executor:
+            futures = [executor.submit(self.factory) for _ in range(self.sessions)]
+
+        for future in futures:
+            if future.exception() is None:
+                self.automators.append(future.result())
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+        for automator in self.automators:
+            self.last_used[id(automator)] = time.monotonic()
+            self.idle.put(automator)
+        logger.info(f"{self.sessions} sessions ready")
+
+    def bind(self) -> socketserver.BaseServer:
+        if isinstance(self.address, tuple):
+            server = TCPJobServer(self.address, JobRequestHandler)
+        else:
+            if os.path.exists(self.address):
+                try:
+                    connect(self.address, CONNECT_TIMEOUT_S).close()
+                except OSError:
+                    # left by a daemon not stopped cleanly
+                    os.unlink(self.address)
+                else:
+                    msg = f"A daemon is already running on {self.address}!"
+                    logger.error(msg)
+                    raise RuntimeError(msg)
+            server = socketserver.ThreadingUnixStreamServer(self.address, JobRequestHandler)
+            # jobs run with credentials of the daemon
+            os.chmod(self.address, 0o600)
+
+        server.daemon = self
+        return server
+
+    def serve(self):
+        """Serve jobs until stopped, by a stop job or Ctrl+C"""
+        try:
+            # a daemon already running fails before browsers are started
+            self.server = self.bind()
+            self.start_sessions()
+            logger.info(
+                f"Daemon listening on {self.address} with {self.sessions} sessions"
+                " (Ctrl+C to stop)"
+            )
+            try:
+                self.server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info("Daemon interrupted")
+        finally:
+            if self.server is not None:
+                logger.info("Daemon stopping, after running jobs")
+                # wait for jobs running
+                self.server.server_close()
+                if not isinstance(self.address, tuple):
+                    os.unlink(self.address)
+            for automator in self.automators:
+                automator.close()
+
+    def stop(self):
+        # called by a job, while serve_forever runs on another thread
+        threading.Thread(target=self.server.shutdown, name="daemon-stop").start()
+
+    def handle(self, job: dict, send: Callable[[dict], None]):
+        if job.get("action") == "stop":
+            logger.info("Daemon stop requested")
+            send(dict(done=True, ok=True, run=RUN_ID))
+            self.stop()
+            return
+
+        with self.lock:
+            self.jobs += 1
+            number = self.jobs
+        run = f"{RUN_ID}-{number}"
+
+        handler = JobLogHandler(
+            number, send, logging.DEBUG if job.get("verbose") else logging.INFO
+        )
+        logging.getLogger().addHandler(handler)
+        error = None
+        try:
+            with log_context(job=number, run=run):
+                try:
+                    logger.info(f"Job {number}: {job.get('action')} {job.get('args')}")
+                    self.run(job)
+                    logger.info(f"Job {number} done")
+                except Exception as e:
+                    logger.exception(f"Job {number} failed")
+                    error = str(e) or type(e).__name__
+        finally:
+            logging.getLogger().removeHandler(handler)
+        send(dict(done=True, ok=error is None, error=error, run=run))
+
+    def run(self, job: dict):
+        if job.get("action") != "run":
+            msg = f"Unknown job action '{job.get('action')}'!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        # read at every job, so that changes to the file are seen
+        config = get_config(job["config"])
+
+        if self.idle.empty():
+            logger.info("All sessions busy, job waiting")
+        automator = self.idle.get()
+        try:
+            if time.monotonic() - self.last_used[id(automator)] > RESUME_AFTER_S:
+                automator.resume()
+            # edit mode on course of job, course structure read again as
+            # other jobs or people may have changed it
+            automator.use_config(config)
+            self.runner(automator, job)
+            self.last_used[id(automator)] = time.monotonic()
+        except Exception:
+            # browser may be broken, check it before next job
+            self.last_used[id(automator)] = 0.0
+            raise
+        finally:
+            self.idle.put(automator)
@@ -0,0 +1,148 @@
+"""Lifecycle of the browser driven by an Automator.
+
+Chrome memory grows steadily across hundreds of lesson edit pages, so the
+browser can be recycled (quit and started again) after some pages or when its
+memory goes over a threshold. Moodle session cookies are copied to the new
+browser, so login and edit mode are kept."""
+import logging
+from typing import Callable, List, Optional
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from moodle.utility import default_config, get_driver
+
+try:
+    import psutil
+except ImportError:  # optional, memory is then read from the browser itself
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+
+class ManagedDriver:
+    """Proxy to a WebDriver that can be recycled while in use"""
+
+    _driver: WebDriver = None
+
+    def __init__(
+        self,
+        factory: Callable[[], WebDriver] = None,
+        *,
+        config: dict = None,
+        wait_s: int = 3,
+        recycle_pages: int = None,
+        max_memory_mb: int = None,
+        check_every: int = 5,
+    ):
+        self.config = config or default_config()
+        self.factory = factory or (lambda: get_driver(self.config))
+        self.wait_s = wait_s
+        self.recycle_pages = recycle_pages or None
+        self.max_memory_mb = max_memory_mb or None
+        self.check_every = max(1, check_every)
+
+        # pages completed by current browser
+        self.pages = 0
+        self.recycles = 0
+
+        # called with every new browser (e.g. to instrument it)
+        self.hooks: List[Callable[[WebDriver], None]] = []
+        self.start()
+
+    def __getattr__(self, name):
+        if self._driver is None:
+            raise WebDriverException("Driver already quitted!")
+        return getattr(self._driver, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.quit()
+
+    @property
+    def driver(self) -> WebDriver:
+        return self._driver
+
+    def start(self):
+        driver = self.factory()
+        driver.implicitly_wait(self.wait_s)
+        for hook in self.hooks:
+            hook(driver)
+        self._driver = driver
+        self.pages = 0
+
+    def quit(self):
+        if self._driver is None:
+            return
+        try:
+            self._driver.quit()
+        except WebDriverException:
+            pass
+        finally:
+            self._driver = None
+            logger.info("Selenium driver quitted")
+
+    def memory_mb(self) -> Optional[float]:
+        """Memory used by the browser, in MB. Whole process tree if psutil
+        is installed and the browser is local, JS heap size otherwise"""
+        service = getattr(self._driver, "service", None)
+        if psutil is not None and service is not None and service.process:
+            try:
+                process = psutil.Process(service.process.pid)
+                processes = [process] + process.children(recursive=True)
+                return sum(p.memory_info().rss for p in processes) / 2 ** 20
+            except psutil.Error as e:
+                logger.debug(f"Cannot read browser memory with psutil: {e}")
+
+        try:
+            response = self._driver.execute(
+                "executeCdpCommand", {"cmd": "Performance.getMetrics", "params": {}}
+            )
+            metrics = {m["name"]: m["value"] for m in response["value"]["metrics"]}
+            return metrics["JSHeapTotalSize"] / 2 ** 20
+        except (WebDriverException, KeyError, TypeError) as e:
+            logger.debug(f"Cannot read browser memory: {e}")
+            return None
+
+    def should_recycle(self) -> bool:
+        if self.recycle_pages and self.pages >= self.recycle_pages:
+            logger.info(f"Browser completed {self.pages} pages")
+            return True
+
+        if self.max_memory_mb and self.pages % self.check_every == 0:
+            memory = self.memory_mb()
+            logger.debug(f"Browser memory: {memory} MB")
+            if memory is not None and memory > self.max_memory_mb:
+                logger.info(f"Browser memory {memory:.0f} MB over threshold")
+                return True
+
+        return False
+
+    def page_done(self):
+        """Signal that a page has been completed, and recycle the browser
+        if needed. Must be called when no WebElement is held anymore"""
+        self.pages += 1
+        if self.should_recycle():
+            self.recycle()
+
+    def recycle(self):
+        """Start a new browser with the same Moodle session"""
+        cookies = self._driver.get_cookies()
+        url = self._driver.current_url
+
+        self.quit()
+        self.start()
+
+        # cookies can be set only on a page of their domain
+        self._driver.get(self.config["site"]["login"])
+        for cookie in cookies:
+            # expiry must be an int, and some drivers return it as float
+            if "expiry" in cookie:
+                cookie["expiry"] = int(cookie["expiry"])
+            self._driver.add_cookie(cookie)
+        self._driver.get(url)
+
+        self.recycles += 1
+        logger.info(f"Browser recycled ({self.recycles} times so far)")
@@ -0,0 +1,507 @@
+"""Scriptable in-memory browser, to run model code without Chrome.
+
+This is the `engine = fake` of configuration, for development only: tests,
+and profiling or counting commands of a run reproducibly, offline. It knows
+just enough of Moodle to upload a lesson, and uploads nothing.
+
+FakeDriver is a real selenium RemoteWebDriver whose command executor answers
+from memory, so Module, Select and WebElement code runs unchanged and every
+WebDriver command can be counted (see moodle.instrument). Any element looked
+up exists, unless told otherwise with `FakeBrowser.missing`; its tag and
+options are guessed from the locator, or set with `FakeBrowser.element`."""
+import contextlib
+import importlib
+import itertools
+import re
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, List, Optional, Tuple
+
+from selenium.webdriver.common.by import By
+from selenium.webdriver.remote.command import Command
+from selenium.webdriver.remote.file_detector import UselessFileDetector
+from selenium.webdriver.remote.webdriver import WebDriver
+
+# status codes of the (non W3C) json wire protocol
+SUCCESS = 0
+NO_SUCH_ELEMENT = 7
+
+# locators that return a select element
+SELECT_PATTERN = re.compile(
+    r"select|jumpto|^id_(modattempts|maxattempts|retake|usemax|completion)"
+)
+
+Locator = Tuple[str, str]
+
+# options of the jump selects of a lesson page, before the pages of lesson
+JUMP_OPTIONS = [
+    "Questa pagina",
+    "Pagina successiva",
+    "Pagina precedente",
+    "Fine della lezione",
+    "Domanda non vista in una pagina con contenuto",
+    "Domanda casuale all'interno di una pagina di contenuto",
+    "Pagina casuale con contenuto",
+]
+
+
+# modules of model code, waiting for the (real) browser with time.sleep
+WAITING_MODULES = ("moodle.automator", "moodle.model", "moodle.parallel", "moodle.sync")
+
+
+class NoWaitTime:
+    """The time module without sleep, for model code driving a fake browser"""
+
+    def __getattr__(self, name: str):
+        return getattr(time, name)
+
+    @staticmethod
+    def sleep(seconds: float):
+        pass
+
+
+@contextlib.contextmanager
+def without_waits():
+    """Skip the waits of model code for the browser, while the block runs.
+    Other code (e.g. the interval of a watch loop) keeps its own"""
+    modules = [importlib.import_module(name) for name in WAITING_MODULES]
+    previous = [module.time for module in modules]
+    for module in modules:
+        module.time = NoWaitTime()
+    try:
+        yield
+    finally:
+        for module, module_time in zip(modules, previous):
+            module.time = module_time
+
+
+class FakeElement:
+    def __init__(self, browser: "FakeBrowser", tag: str, text: str = "", **attrs):
+        self.id = str(next(browser.ids))
+        self.tag = tag
+        self.text = text
+        self.attrs = {"class": "", **{k: str(v) for k, v in attrs.items()}}
+        self.selected = False
+        self.parent: Optional[FakeElement] = None
+        self.children: Dict[Locator, List[FakeElement]] = {}
+
+    def __repr__(self):
+        return f"FakeElement({self.tag}, id={self.id})"
+
+
+class FakeBrowser:
+    """State of the fake browser: url, elements and scripted answers"""
+
+    def __init__(self, url: str = "about:blank", options: int = 10, elements: int = 3):
+        self.ids = itertools.count(1)
+        self.url = url
+        self.navigations = 0
+        # default number of options of a select, and of elements found
+        self.default_options = options
+        self.default_elements = elements
+
+        self.elements: Dict[str, FakeElement] = {}
+        self.roots: Dict[Locator, List[FakeElement]] = {}
+        self.rules: List[Tuple[re.Pattern, dict]] = []
+        self.scripts: List[Tuple[str, Callable]] = []
+        self.active = self.create("input")
+        self.cookies: List[dict] = []
+
+    def create(self, tag: str, text: str = "", options=None, **attrs) -> FakeElement:
+        """Create an element; options of a select are a number, or their texts"""
+        element = FakeElement(self, tag, text, **attrs)
+        self.elements[element.id] = element
+        if tag == "select":
+            options = self.default_options if options is None else options
+            if isinstance(options, int):
+                options = [f"Opzione {i}" for i in range(options)]
+            for i, option_text in enumerate(options):
+                option = self.create("option", option_text, index=i, value=i)
+                option.parent = element
+                element.children.setdefault((By.TAG_NAME, "option"), []).append(option)
+        return element
+
+    def element(self, pattern: str, **spec):
+        """Script elements whose locator value matches `pattern`: spec can
+        set `tag`, `text`, `count` (elements found) and attributes"""
+        self.rules.insert(0, (re.compile(pattern), spec))
+
+    def missing(self, pattern: str):
+        """Elements whose locator matches `pattern` are never found"""
+        self.element(pattern, count=0)
+
+    def script(self, pattern: str, result):
+        """Answer scripts containing `pattern` with `result` (or result(args))"""
+        func = result if callable(result) else (lambda args: result)
+        self.scripts.insert(0, (pattern, func))
+
+    def navigate(self, url: str = None):
+        self.navigations += 1
+        self.url = url if url is not None else f"{self.url.split('#')[0]}#{self.navigations}"
+        # a new page, so every element found before is gone
+        self.roots.clear()
+
+    def spec(self, value: str) -> dict:
+        for pattern, spec in self.rules:
+            if pattern.search(value):
+                return spec
+        if SELECT_PATTERN.search(value):
+            return dict(tag="select")
+        return {}
+
+    def find(
+        self, using: str, value: str, parent: FakeElement = None, multiple: bool = False
+    ) -> List[FakeElement]:
+        """Elements found by a locator, the same ones until next navigation"""
+        scope = parent.children if parent is not None else self.roots
+        if (using, value) not in scope:
+            scope[(using, value)] = self._create_found(using, value, parent, multiple)
+        return scope[(using, value)]
+
+    def _create_found(self, using, value, parent, multiple) -> List[FakeElement]:
+        if parent is not None and parent.tag == "select" and using == By.XPATH:
+            # Select.select_by_visible_text, option with the given text
+            match = re.search(r"normalize-space\(\.\) = \"(.*)\"\]", value)
+            text = match.group(1) if match else value
+            option = self.create("option", text, value=text)
+            option.parent = parent
+            return [option]
+
+        spec = dict(self.spec(value))
+        count = spec.pop("count", self.default_elements if multiple else 1)
+        tag = spec.pop("tag", "div")
+        text = spec.pop("text", "")
+        return [self.create(tag, text, **spec) for _ in range(count)]
+
+
+class FakeExecutor:
+    """Command executor answering WebDriver commands from a FakeBrowser"""
+
+    def __init__(self, browser: FakeBrowser):
+        self.browser = browser
+        self.w3c = False
+        self.log: List[Tuple[str, dict]] = []
+
+    @staticmethod
+    def ok(value=None) -> dict:
+        return {"status": SUCCESS, "value": value}
+
+    @staticmethod
+    def wrap(elements: List[FakeElement]) -> List[dict]:
+        return [{"ELEMENT": element.id} for element in elements]
+
+    def execute(self, command: str, params: dict) -> dict:
+        self.log.append((command, params))
+        browser = self.browser
+        element = browser.elements.get(params.get("id")) if params else None
+
+        if command == Command.NEW_SESSION:
+            return {"status": SUCCESS, "sessionId": "fake", "value": {}}
+
+        if command in (Command.FIND_ELEMENT, Command.FIND_CHILD_ELEMENT):
+            found = browser.find(params["using"], params["value"], element)
+            if not found:
+                message = f"no such element: {params['using']}={params['value']}"
+                return {"status": NO_SUCH_ELEMENT, "value": {"message": message}}
+            return self.ok(self.wrap(found)[0])
+
+        if command in (Command.FIND_ELEMENTS, Command.FIND_CHILD_ELEMENTS):
+            found = browser.find(params["using"], params["value"], element, multiple=True)
+            return self.ok(self.wrap(found))
+
+        if command == Command.CLICK_ELEMENT:
+            if element.tag == "option":
+                for sibling in element.parent.children.get((By.TAG_NAME, "option"), []):
+                    sibling.selected = False
+                element.selected = True
+                # moodle "add page" selects redirect as soon as an option is chosen
+                browser.navigate()
+            return self.ok()
+
+        if command == Command.SEND_KEYS_TO_ELEMENT:
+            element.attrs["value"] = element.attrs.get("value", "") + params["text"]
+            return self.ok()
+
+        if command == Command.CLEAR_ELEMENT:
+            element.attrs["value"] = ""
+            return self.ok()
+
+        if command == Command.GET_ELEMENT_ATTRIBUTE:
+            return self.ok(element.attrs.get(params["name"]))
+
+        if command == Command.GET_ELEMENT_TEXT:
+            return self.ok(element.text)
+
+        if command == Command.GET_ELEMENT_TAG_NAME:
+            return self.ok(element.tag)
+
+        if command == Command.IS_ELEMENT_SELECTED:
+            return self.ok(element.selected)
+
+        if command == Command.GET_ACTIVE_ELEMENT:
+            return self.ok(self.wrap([browser.active])[0])
+
+        if command == Command.GET:
+            browser.navigate(params["url"])
+            return self.ok()
+
+        if command in (Command.REFRESH, Command.SUBMIT_ELEMENT):
+            browser.navigate(browser.url if command == Command.REFRESH else None)
+            return self.ok()
+
+        if command == Command.GET_CURRENT_URL:
+            return self.ok(browser.url)
+
+        if command in (Command.EXECUTE_SCRIPT, Command.EXECUTE_ASYNC_SCRIPT):
+            for pattern, func in browser.scripts:
+                if pattern in params["script"]:
+                    return self.ok(func(params.get("args", [])))
+            return self.ok()
+
+        if command == Command.UPLOAD_FILE:
+            # file is "saved" on the remote node, which answers with its path
+            return self.ok(f"/tmp/upload{len(self.log)}/file")
+
+        if command == Command.GET_ALL_COOKIES:
+            return self.ok(list(browser.cookies))
+
+        if command == Command.ADD_COOKIE:
+            browser.cookies.append(params["cookie"])
+            return self.ok()
+
+        # waits, window handling, quit, cdp commands...
+        return self.ok()
+
+
+class FakeDriver(WebDriver):
+    """WebDriver running against a FakeBrowser"""
+
+    executor_class = FakeExecutor
+
+    def __init__(self, browser: FakeBrowser = None):
+        self.browser = browser or FakeBrowser()
+        super().__init__(
+            command_executor=self.executor_class(self.browser), desired_capabilities={}
+        )
+        # like a local Chrome: file paths are typed, not uploaded
+        self.file_detector = UselessFileDetector()
+
+    @property
+    def commands(self) -> List[Tuple[str, dict]]:
+        return self.command_executor.log
+
+
+class FakeMoodle:
+    """In-memory Moodle site behind fake browsers: sections and lessons of a
+    course, with lesson pages, enough to run a whole upload offline. Used by
+    `engine = fake` of configuration, e.g. to profile a run reproducibly"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # section: dom_id, name, section_id and activities (dom_id, name)
+        self.sections: List[dict] = [self._section()]
+        # pages (id, title, contents) of every lesson, by module id, with
+        # contents as read by moodle.sync (cells and images) and the form
+        # they come from (typed and jumps)
+        self.lessons: Dict[int, List[List]] = {}
+
+    def _section(self) -> dict:
+        number = next(self.ids)
+        return dict(dom_id=f"section-{number}", name="", section_id=number, activities=[])
+
+    def driver(self) -> "FakeDriver":
+        driver = FakeMoodleDriver(FakeBrowser())
+        driver.command_executor.site = self
+        self.script(driver.browser, driver.command_executor)
+        return driver
+
+    def script(self, browser: FakeBrowser, executor: "FakeMoodleExecutor"):
+        # later scripts match first: sesskey is also in page ids script
+        browser.script("M.cfg.sesskey", "sesskey")
+        browser.script("var sections = []", lambda args: self.read_course())
+        browser.script("var container = arguments[1]", lambda args: self.last(browser, *args))
+        browser.script("function pageIds", lambda args: self.page_ids(executor, *args))
+        browser.script("option.text.trim()", lambda args: self.page_exists(args[1]))
+        browser.script("fetchOne", lambda args: [self.fetch(url) for url in args[0]])
+        browser.script("table.generaltable", lambda args: self.read_lesson(browser.url))
+        browser.element(r"^id_jumpto_\d+$", tag="select", options=JUMP_OPTIONS)
+
+    def read_course(self) -> List[dict]:
+        with self.lock:
+            return [
+                dict(section, activities=[dict(a) for a in section["activities"]])
+                for section in self.sections
+            ]
+
+    def last(self, browser: FakeBrowser, selector: str, container: Optional[str]):
+        with self.lock:
+            if selector == "li.section":
+                dom_id = self.sections[-1]["dom_id"]
+            else:
+                section = next(s for s in self.sections if s["dom_id"] == container)
+                dom_id = section["activities"][-1]["dom_id"]
+        return [dom_id, FakeExecutor.wrap([browser.create("li", id=dom_id)])[0]]
+
+    def add_section(self):
+        with self.lock:
+            self.sections.append(self._section())
+
+    def add_module(self, section_dom_id: str, name: str):
+        with self.lock:
+            module_id = next(self.ids)
+            section = next(s for s in self.sections if s["dom_id"] == section_dom_id)
+            section["activities"].append(dict(dom_id=f"module-{module_id}", name=name))
+            self.lessons[module_id] = []
+
+    def add_page(self, params: Dict[str, str], title: str, contents: dict = None):
+        with self.lock:
+            pages = self.lessons.setdefault(int(params["id"]), [])
+            anchor = int(params.get("pageid", 0))
+            position = 0 if not anchor else [p[0] for p in pages].index(anchor) + 1
+            pages.insert(position, [next(self.ids), title, contents or {}])
+
+    def update_page(self, params: Dict[str, str], typed: dict, jumps: dict):
+        """Save the edit form of a page: fields left alone keep their values"""
+        with self.lock:
+            page = next(
+                page
+                for page in self.lessons[int(params["id"])]
+                if page[0] == int(params["pageid"])
+            )
+            contents = page[2]
+            typed = {**contents.get("typed", {}), **typed}
+            jumps = {**contents.get("jumps", {}), **jumps}
+            page[1:] = page_contents(typed, jumps)
+
+    def read_lesson(self, url: str) -> List[dict]:
+        """Pages of a lesson as read from its expanded edit view"""
+        with self.lock:
+            pages = self.lessons.get(int(_query(url)["id"]), [])
+            return [
+                dict(
+                    id=page_id,
+                    title=title,
+                    text="\n".join([title] + contents.get("cells", [])),
+                    cells=list(contents.get("cells", [])),
+                    images=list(contents.get("images", [])),
+                )
+                for page_id, title, contents in pages
+            ]
+
+    def page_ids(self, executor: "FakeMoodleExecutor", request: str, listing: str) -> List[int]:
+        if request:
+            # end of cluster, added without a form
+            self.add_page(_query(request), "Fine gruppo")
+        with self.lock:
+            return [page[0] for page in self.lessons.get(int(_query(listing)["id"]), [])]
+
+    def page_exists(self, title: str) -> bool:
+        with self.lock:
+            return any(page[1] == title for pages in self.lessons.values() for page in pages)
+
+    def fetch(self, url: str) -> bool:
+        params = _query(url)
+        with self.lock:
+            if "lesson.php" in url and params.get("action") == "delete":
+                pages = self.lessons.get(int(params["id"]), [])
+                pages[:] = [page for page in pages if page[0] != int(params["pageid"])]
+            elif "mod.php" in url and "delete" in params:
+                dom_id = f"module-{params['delete']}"
+                for section in self.sections:
+                    section["activities"] = [
+                        a for a in section["activities"] if a["dom_id"] != dom_id
+                    ]
+            elif "editsection.php" in url and "delete" in params:
+                self.sections = [
+                    s for s in self.sections if s["section_id"] != int(params["id"])
+                ]
+        return True
+
+
+def page_contents(typed: dict, jumps: dict) -> Tuple[str, dict]:
+    """Title and contents of a page from its form: text typed and jumps
+    selected, by locator"""
+    upload = typed.get("repo_upload_file")
+    contents = dict(
+        cells=[text for locator, text in typed.items() if locator != "id_title"]
+        + list(jumps.values()),
+        images=[re.split(r"[\\/]", upload)[-1]] if upload else [],
+        typed=dict(typed),
+        jumps=dict(jumps),
+    )
+    return typed.get("id_title", ""), contents
+
+
+def _query(url: str) -> Dict[str, str]:
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+
+
+class FakeMoodleExecutor(FakeExecutor):
+    """Executor changing a FakeMoodle as forms of the site are submitted"""
+
+    site: FakeMoodle
+
+    def __init__(self, browser: FakeBrowser):
+        super().__init__(browser)
+        # locators of elements found, by element id
+        self.locators: Dict[str, str] = {}
+        self.section: Optional[str] = None
+        # query of the page editor open, a new page or an existing one
+        self.editor: Optional[Dict[str, str]] = None
+        # text typed and jumps selected on current page, by locator
+        self.typed: Dict[str, str] = {}
+        self.jumps: Dict[str, str] = {}
+
+    def execute(self, command: str, params: dict) -> dict:
+        response = super().execute(command, params)
+        if command == Command.GET:
+            is_editor = "editpage.php" in params["url"] and "qtype" in params["url"]
+            is_editor = is_editor or "edit=1" in params["url"]
+            self.editor = _query(params["url"]) if is_editor else None
+            self.typed, self.jumps = {}, {}
+            if "lesson.php" in params["url"]:
+                self.site.fetch(params["url"])
+        elif command == Command.SEND_KEYS_TO_ELEMENT:
+            locator = self.locators.get(params["id"], "")
+            self.typed[locator] = self.typed.get(locator, "") + params["text"]
+        elif command in (Command.FIND_ELEMENT, Command.FIND_CHILD_ELEMENT):
+            if response["status"] == SUCCESS:
+                self.locators[response["value"]["ELEMENT"]] = params["value"]
+            if params["value"].startswith("section-"):
+                self.section = params["value"]
+        elif command == Command.CLICK_ELEMENT:
+            element = self.browser.elements[params["id"]]
+            locator = self.locators.get(params["id"], "")
+            if element.tag == "option" and element.parent is not None:
+                self.jumps[self.locators.get(element.parent.id, "")] = element.text
+            elif locator == "div[class=modal-footer] > button":
+                self.site.add_section()
+            elif locator == "id_submitbutton2":
+                self.site.add_module(self.section, self.typed.get("id_name", ""))
+            elif locator == "id_submitbutton" and self.editor is not None:
+                self.submit_page()
+        return response
+
+    def submit_page(self):
+        if "edit" in self.editor:
+            self.site.update_page(self.editor, self.typed, self.jumps)
+        else:
+            self.site.add_page(self.editor, *page_contents(self.typed, self.jumps))
+        self.editor = None
+
+
+class FakeMoodleDriver(FakeDriver):
+    executor_class = FakeMoodleExecutor
+
+
+_site: Optional[FakeMoodle] = None
+
+
+def fake_site() -> FakeMoodle:
+    """The site shared by fake browsers of a run"""
+    global _site
+    if _site is None:
+        _site = FakeMoodle()
+    return _site
@@ -0,0 +1,184 @@
+"""Accounting of WebDriver round trips.
+
+Every WebDriver command (find, click, send keys, ...) is a request to the
+driver, and over a remote hub each one costs tens of milliseconds. Model
+methods are marked as operations, and a CommandCounter attached to a driver
+counts commands issued inside each of them (for the cdp engine, the calls of
+its facade: each is a round trip to the browser too). Durations of operations are
+observed in the step_seconds metric, and their network timings by attached
+NetworkRecorders (see moodle.network)."""
+import collections
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+from typing import Counter, Dict
+
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from moodle.cdp import CDPDriver
+from moodle.driver import ManagedDriver
+from moodle.metrics import STEP_SECONDS
+from moodle.network import NetworkRecorder
+
+logger = logging.getLogger(__name__)
+
+# operations currently running, outermost first
+_operations: contextvars.ContextVar = contextvars.ContextVar("operations", default=())
+
+# operation name used for commands issued outside any operation
+NO_OPERATION = "-"
+
+
+class operation(contextlib.ContextDecorator):
+    """Mark a block (or a function, as decorator) as a named operation.
+    Commands are counted for every operation running, so nested ones are
+    included in the outer ones"""
+
+    def __init__(self, name: str):
+        self.name = name
+        # the same operation (a decorated method) can run in many threads
+        self._local = threading.local()
+
+    @property
+    def _tokens(self) -> list:
+        if not hasattr(self._local, "tokens"):
+            self._local.tokens = []
+        return self._local.tokens
+
+    def __enter__(self):
+        running = _operations.get()
+        self._tokens.append((_operations.set(running + (self.name,)), time.perf_counter()))
+        for counter in CommandCounter.attached:
+            counter.calls[self.name] += 1
+        for recorder in NetworkRecorder.attached:
+            recorder.operation_started()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        token, start = self._tokens.pop()
+        _operations.reset(token)
+        seconds = time.perf_counter() - start
+        STEP_SECONDS.observe(seconds, step=self.name)
+        for recorder in NetworkRecorder.attached:
+            recorder.operation_done(self.name, seconds)
+        return False
+
+
+class CommandCounter:
+    """Count WebDriver commands by type, per operation"""
+
+    # counters attached to some driver, they're notified of operation calls
+    attached = []
+
+    def __init__(self):
+        self.counts: Dict[str, Counter[str]] = collections.defaultdict(collections.Counter)
+        self.seconds: Dict[str, float] = collections.defaultdict(float)
+        self.calls: Counter[str] = collections.Counter()
+        # drivers counted, with the method wrapped and the one set on the
+        # driver before, if any
+        self._wrapped = []
+        self._managed = []
+
+    def attach(self, driver):
+        """Count commands of a driver. A ManagedDriver is counted across
+        browser recycles"""
+        if isinstance(driver, ManagedDriver):
+            driver.hooks.append(self._wrap)
+            self._managed.append(driver)
+            self._wrap(driver.driver)
+        else:
+            self._wrap(driver)
+        if self not in CommandCounter.attached:
+            CommandCounter.attached.append(self)
+        return self
+
+    def detach(self):
+        """Stop counting: unwrap drivers, and stop being notified"""
+        if self in CommandCounter.attached:
+            CommandCounter.attached.remove(self)
+        for driver in self._managed:
+            if self._wrap in driver.hooks:
+                driver.hooks.remove(self._wrap)
+        for driver, name, method in self._wrapped:
+            if method is None:
+                delattr(driver, name)
+            else:
+                setattr(driver, name, method)
+        self._managed, self._wrapped = [], []
+
+    def _wrap(self, driver: WebDriver):
+        if isinstance(driver, CDPDriver):
+            self._wrap_cdp(driver)
+            return
+
+        # WebElements send their commands through their parent execute too
+        execute = driver.execute
+
+        def counted_execute(driver_command, params=None):
+            start = time.perf_counter()
+            try:
+                return execute(driver_command, params)
+            finally:
+                self.record(driver_command, time.perf_counter() - start)
+
+        self._wrapped.append((driver, "execute", vars(driver).get("execute")))
+        driver.execute = counted_execute
+
+    def _wrap_cdp(self, driver: CDPDriver):
+        # CDPElements run their commands through their parent too, counted
+        # by coroutine of the engine (e.g. Page.click)
+        run = driver.run
+
+        def counted_run(coroutine):
+            name = getattr(coroutine, "__qualname__", type(coroutine).__name__)
+            start = time.perf_counter()
+            try:
+                return run(coroutine)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        self._wrapped.append((driver, "run", vars(driver).get("run")))
+        driver.run = counted_run
+
+    def record(self, command: str, seconds: float):
+        for name in _operations.get() or (NO_OPERATION,):
+            self.counts[name][command] += 1
+            self.seconds[name] += seconds
+
+    def reset(self):
+        self.counts.clear()
+        self.seconds.clear()
+        self.calls.clear()
+
+    def total(self, name: str = NO_OPERATION) -> int:
+        """Commands issued inside an operation (all its calls)"""
+        return sum(self.counts[name].values())
+
+    def per_call(self, name: str) -> float:
+        """Average commands issued by one call of an operation"""
+        calls = self.calls[name]
+        return self.total(name) / calls if calls else 0.0
+
+    def check_budget(self, name: str, max_commands: float):
+        """Raise AssertionError if an operation costs, on average, more than
+        `max_commands` round trips"""
+        cost = self.per_call(name)
+        if cost > max_commands:
+            commands = ", ".join(f"{c}={n}" for c, n in self.counts[name].most_common())
+            msg = f"{name} costs {cost:.1f} commands per call, budget is {max_commands}"
+            raise AssertionError(f"{msg} ({commands})")
+
+    def report(self) -> str:
+        lines = []
+        for name in sorted(self.counts, key=self.total, reverse=True):
+            calls = self.calls[name] or 1
+            lines.append(
+                f"{name}: {self.total(name)} commands in {self.calls[name]} calls"
+                f" ({self.total(name) / calls:.1f}/call,"
+                f" {self.seconds[name] / calls:.2f}s/call)"
+            )
+            for command, count in self.counts[name].most_common():
+                lines.append(f"    {command}: {count}")
+        return "\n".join(lines)
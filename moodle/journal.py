@@ -0,0 +1,70 @@
+"""Record of sections and modules created on Moodle, one json object per
+line, with the run id of moodle.logs (of the daemon job creating them, in a
+daemon). See moodle.cleanup to delete them."""
+import datetime
+import json
+import os
+import pathlib
+import threading
+from typing import List, Union
+
+from moodle.logs import current_run
+
+JOURNAL_FILENAME = ".moodle_journal.jsonl"
+
+
+class Journal:
+    """Append only record of sections and modules created"""
+
+    def __init__(self, path: Union[str, os.PathLike] = JOURNAL_FILENAME):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+
+    def _append(self, obj: dict):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+
+    def record(self, kind: str, course: str, dom_id: str, name: str):
+        self._append(
+            dict(
+                run=current_run(),
+                time=datetime.datetime.now().isoformat(timespec="seconds"),
+                action="created",
+                kind=kind,
+                course=course,
+                dom_id=dom_id,
+                name=name,
+            )
+        )
+
+    def mark_deleted(self, entries: List[dict]):
+        for entry in entries:
+            self._append({**entry, "action": "deleted"})
+
+    def entries(self) -> List[dict]:
+        if not self.path.exists():
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def created(self, course: str, run: str = None) -> List[dict]:
+        """Objects created in a course by a run (by default, the last one)
+        and not deleted yet"""
+        entries = [entry for entry in self.entries() if entry["course"] == course]
+        if run is None:
+            runs = [entry["run"] for entry in entries if entry["action"] == "created"]
+            if not runs:
+                return []
+            run = runs[-1]
+
+        # a deletion is of the last object created with its id by its run:
+        # positional ids (e.g. section-5) are used again by later objects
+        alive = {}
+        for entry in entries:
+            key = (entry["run"], entry["kind"], entry["dom_id"])
+            if entry["action"] == "created":
+                alive[key] = entry
+            elif entry["action"] == "deleted":
+                alive.pop(key, None)
+        return [entry for key, entry in alive.items() if key[0] == run]
@@ -0,0 +1,162 @@
+"""Logging setup, kept off the automation thread.
+
+Records are put on a queue by the calling thread and formatted and written
+by a QueueListener thread. Every record carries the run id and the module
+and slide being processed, set with `log_context`. A daemon job has a run id
+of its own, set with `log_context(run=...)`."""
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import uuid
+from typing import Dict, Iterable, Optional
+
+FORMAT = (
+    "%(asctime)s :: %(levelname)s :: [%(module)s.%(funcName)s.%(lineno)d]"
+    " :: %(context)s%(message)s"
+)
+
+# third party loggers logging every WebDriver command at DEBUG level
+NOISY_LOGGERS = {
+    "selenium.webdriver.remote.remote_connection": logging.INFO,
+    "urllib3.connectionpool": logging.INFO,
+}
+
+_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+RUN_ID = uuid.uuid4().hex[:8]
+
+
+@contextlib.contextmanager
+def log_context(**kwargs):
+    """Add fields (e.g. module, slide) to records logged inside the block"""
+    token = _context.set({**_context.get(), **kwargs})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current_run() -> str:
+    """Run id of the calling context: the one of a daemon job, or of the process"""
+    return _context.get().get("run", RUN_ID)
+
+
+class ContextFilter(logging.Filter):
+    """Attach run id and current context to records"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # run id is a field of its own, not part of the context
+        context = {key: value for key, value in _context.get().items() if key != "run"}
+        record.run = current_run()
+        record.fields = context
+        record.context = "".join(f"[{key}={value}] " for key, value in context.items())
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        obj = dict(
+            time=self.formatTime(record),
+            level=record.levelname,
+            logger=record.name,
+            where=f"{record.module}.{record.funcName}.{record.lineno}",
+            run=getattr(record, "run", RUN_ID),
+            message=record.getMessage(),
+        )
+        obj.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            obj["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # queue is in process, so the record is formatted by the listener
+        # thread instead of the one logging it
+        return record
+
+
+class LogListener:
+    """Own the handlers writing records, and the thread running them"""
+
+    def __init__(self, handlers: Iterable[logging.Handler]):
+        self.queue: queue.Queue = queue.Queue(-1)
+        self.handlers = list(handlers)
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *self.handlers, respect_handler_level=True
+        )
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        """Flush pending records and stop the thread"""
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def parse_levels(values: Optional[Iterable[str]]) -> Dict[str, int]:
+    """Parse `logger=LEVEL` strings, as given from command line"""
+    levels = {}
+    for value in values or ():
+        name, sep, level = value.partition("=")
+        if not sep or not name:
+            raise ValueError(f"Invalid logger level '{value}', expected logger=LEVEL")
+        levels[name] = logging.getLevelName(level.upper())
+        if not isinstance(levels[name], int):
+            raise ValueError(f"Invalid level '{level}' for logger {name}")
+    return levels
+
+
+def setup_logging(
+    *,
+    verbose: bool = False,
+    log_file: str = "main.log",
+    debug_log_file: str = "main.debug.log",
+    json_logs: bool = False,
+    max_bytes: int = 50 * 2 ** 20,
+    backup_count: int = 5,
+    levels: Dict[str, int] = None,
+) -> LogListener:
+    """Route root logger through a queue and return the started listener.
+    Call `stop` on it before exiting, to flush pending records"""
+    formatter = JsonFormatter() if json_logs else logging.Formatter(FORMAT)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.DEBUG if verbose else logging.INFO)
+    # console is for humans, even with json files
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+
+    handlers = [stream_handler]
+    for filename, level in ((log_file, logging.INFO), (debug_log_file, logging.DEBUG)):
+        if not filename:
+            continue
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        handlers.append(handler)
+
+    listener = LogListener(handlers)
+
+    queue_handler = LogQueueHandler(listener.queue)
+    queue_handler.addFilter(ContextFilter())
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+
+    for name, level in {**NOISY_LOGGERS, **(levels or {})}.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    return listener
@@ -0,0 +1,358 @@
+"""Progress and latency metrics of a run, in Prometheus text format.
+
+Module.populate reports slides and questions done, every operation (see
+moodle.instrument) its duration and Select retries are counted. Metrics can
+be written periodically to a file (for node_exporter textfile collector) and
+served on a local HTTP port."""
+import bisect
+import collections
+import contextlib
+import http.server
+import logging
+import os
+import threading
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from moodle.logs import current_run
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "moodle_"
+
+# seconds, from a select to a whole populate
+DEFAULT_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+
+# slides/minute is computed over this many seconds
+RATE_WINDOW = 600
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind: str
+
+    def __init__(self, name: str, help: str):
+        self.name = PREFIX + name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = collections.defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        with self.lock:
+            self.values[_labels(labels)] += amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_labels(labels), 0.0)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function: Callable[[], Optional[float]] = None):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+        # computed when rendered, instead of set
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[_labels(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        with self.lock:
+            key = _labels(labels)
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_labels(labels), 0.0)
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            return [] if value is None else [(self.name, (), value)]
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = sorted(buckets) + [float("inf")]
+        # per labels: count per bucket (not cumulative), sum
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = collections.defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * len(self.buckets))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+
+    def count(self, **labels) -> int:
+        return sum(self.counts.get(_labels(labels), ()))
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = (("le", _format_value(bound)),)
+                    samples.append((f"{self.name}_bucket", labels + le, cumulative))
+                samples.append((f"{self.name}_sum", labels, self.sums[labels]))
+                samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Progress:
+    """Slides and questions done over the expected ones, with throughput"""
+
+    def __init__(self, registry: Registry):
+        # runs whose whole work was set upfront
+        self.planned: Set[str] = set()
+        # daemon jobs running
+        self.jobs = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        # completion times of recent slides and questions
+        self.recent: Dict[str, Deque[float]] = {
+            "slides": collections.deque(),
+            "questions": collections.deque(),
+        }
+        # items done before current run, by kind
+        self.done_before: Dict[str, float] = {}
+
+        self.total = registry.register(
+            Gauge("items_planned", "Slides and questions to upload, by kind")
+        )
+        self.done = registry.register(
+            Counter("items_done_total", "Slides and questions uploaded, by kind")
+        )
+        rate_help = f"Slides uploaded per minute, over last {RATE_WINDOW}s"
+        registry.register(Gauge("slides_per_minute", rate_help, self.rate))
+        registry.register(Gauge("eta_seconds", "Estimated seconds to complete the run", self.eta))
+        registry.register(Gauge("uptime_seconds", "Seconds since run started", self.elapsed))
+
+    def reset(self):
+        """Start over. Items done so far stay in their counter, that never
+        goes back"""
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self.planned.clear()
+        self.started = time.monotonic()
+        for recent in self.recent.values():
+            recent.clear()
+        self.done_before = {kind: self.done.get(kind=kind) for kind in self.recent}
+        for kind in self.recent:
+            self.total.set(0, kind=kind)
+
+    @contextlib.contextmanager
+    def job(self):
+        """Progress of a daemon job: started over by the first of jobs
+        running together, the work of the others is added to theirs"""
+        with self.lock:
+            if not self.jobs:
+                self._reset()
+            self.jobs += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.jobs -= 1
+
+    def plan(self, slides: int, questions: int):
+        """Set the whole work of the run upfront, when known"""
+        self.planned.add(current_run())
+        self.total.inc(slides, kind="slides")
+        self.total.inc(questions, kind="questions")
+
+    def add_work(self, slides: int, questions: int):
+        """Add the work of a module about to be populated, unless planned"""
+        if current_run() not in self.planned:
+            self.total.inc(slides, kind="slides")
+            self.total.inc(questions, kind="questions")
+
+    def slide_done(self):
+        self._done("slides")
+
+    def question_done(self):
+        self._done("questions")
+
+    def _done(self, kind: str):
+        self.done.inc(kind=kind)
+        now = time.monotonic()
+        with self.lock:
+            recent = self.recent[kind]
+            recent.append(now)
+            while recent and recent[0] < now - RATE_WINDOW:
+                recent.popleft()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def _per_second(self, kind: str) -> Optional[float]:
+        recent = self.recent[kind]
+        if not recent:
+            return None
+        window = min(RATE_WINDOW, self.elapsed())
+        return len(recent) / window if window > 0 else None
+
+    def rate(self) -> Optional[float]:
+        per_second = self._per_second("slides")
+        return per_second * 60 if per_second is not None else 0.0
+
+    def eta(self) -> Optional[float]:
+        eta = 0.0
+        for kind in ("slides", "questions"):
+            done = self.done.get(kind=kind) - self.done_before.get(kind, 0.0)
+            remaining = self.total.get(kind=kind) - done
+            if remaining <= 0:
+                continue
+            per_second = self._per_second(kind)
+            if per_second is None:
+                return None
+            eta += remaining / per_second
+        return eta
+
+
+REGISTRY = Registry()
+
+PROGRESS = Progress(REGISTRY)
+STEP_SECONDS = REGISTRY.register(Histogram("step_seconds", "Duration of operations, by step"))
+RETRIES = REGISTRY.register(Counter("retries_total", "Retries of browser actions, by step"))
+
+
+class TextfileWriter:
+    """Thread writing metrics to a file every `interval` seconds"""
+
+    def __init__(self, path: str, interval: float = 15.0, registry: Registry = REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread, writing metrics a last time"""
+        self._stop.set()
+        self._thread.join()
+
+    def write(self):
+        # atomic, so that readers never see a partial file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.registry.render())
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning(f"Cannot write metrics to {self.path}: {e}")
+            if stopping:
+                return
+
+
+class MetricsServer:
+    """Serve metrics on a local HTTP port, from a thread"""
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY):
+        registry_ = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry_.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics-server", daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Metrics served on http://127.0.0.1:{self.port}/metrics")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
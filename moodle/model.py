@@ -2,17 +2,31 @@ import abc
 import logging
 import os
 import pathlib
-import re
 import time
-from typing import Union
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-from selenium.common.exceptions import WebDriverException, NoSuchElementException
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.remote.command import Command
 from selenium.webdriver.remote.webdriver import WebDriver, WebElement
 from selenium.webdriver.support.select import Select
 
-from moodle.cluster import Cluster, ModuleCluster
-from moodle.utility import config
+from moodle.cluster import Cluster, ModuleCluster, Question
+from moodle.driver import ManagedDriver
+from moodle.instrument import operation
+from moodle.logs import log_context
+from moodle.metrics import PROGRESS, RETRIES
+from moodle.pipeline import Pipeline, StagedFile, stage_file
+from moodle.scanner import (
+    SLIDE_PATTERN,
+    DirectoryEntry,
+    Manifest,
+    SyncState,
+    find_json,
+    slide_index,
+)
+from moodle.structure import last_element
+from moodle.utility import default_config, get_lesson_url
 
 logger = logging.getLogger(__name__)
 
@@ -26,9 +40,10 @@ class Element(abc.ABC):
 
     css_selector: str = None
 
-    def __init__(self, driver: WebDriver, name: str):
+    def __init__(self, driver: WebDriver, name: str, config: dict = None):
         self.driver = driver
         self.name = name
+        self.config = config or default_config()
 
     def _get_element(self, element: WebElement = None) -> WebElement:
         if element:
@@ -75,6 +90,7 @@ class Section(Element):
     def __repr__(self):
         return super().__repr__().replace("Element", "Section")
 
+    @operation("create_section")
     def create(self):
         time.sleep(1)
 
@@ -89,11 +105,9 @@ class Section(Element):
         time.sleep(1)
         logger.info("Section created")
 
-        # the section created is the last one, so we'll take it
-        li = self.driver.find_elements_by_css_selector(self.css_selector)[-1]
-
-        # get unique id for course
-        self.dom_id = li.get_attribute("id")
+        # the section created is the last one, so we'll take it with its
+        # unique id for course (one script, whatever the number of sections)
+        self.dom_id, li = last_element(self.driver, self.css_selector)
         time.sleep(1)
 
         # rename freshly created
@@ -104,8 +118,7 @@ class Section(Element):
 
 
 class Slide:
-    base_name = config["file_parameters"]["base_name"]
-    pattern = re.compile(r"[^\d]*(\d+)", re.I)
+    pattern = SLIDE_PATTERN
 
     def __init__(self, path: Union[str, os.PathLike]):
         self.path = pathlib.Path(path)
@@ -115,6 +128,23 @@ class Slide:
     def __repr__(self):
         return f"Slide({self.path})"
 
+    @classmethod
+    def find_all(cls, directory: Union[str, os.PathLike, DirectoryEntry]) -> list:
+        """Return Slide objects found inside directory, sorted by index.
+
+        Directory can also be an entry of a Manifest, so that it is not
+        listed again."""
+        if isinstance(directory, DirectoryEntry):
+            return [cls(directory.path / entry.name) for entry in directory.slides]
+
+        with os.scandir(directory) as it:
+            slides = [
+                cls(elem.path)
+                for elem in it
+                if elem.is_file() and slide_index(elem.name) is not None
+            ]
+        return sorted(slides, key=lambda slide: slide.index)
+
     def get_index(self):
         match = self.pattern.match(self.name)
         if not match:
@@ -124,22 +154,131 @@ class Slide:
         return int(match.group(1))
 
 
+# mod/lesson page types, used to add pages directly from url
+QTYPE_MULTICHOICE = 3
+QTYPE_BRANCHTABLE = 20
+QTYPE_ENDOFCLUSTER = 31
+
+# indexes of relative jumps in the jump select of an answer
+# 0 -> Questa pagina
+# 1 -> Pagina successiva
+# 2 -> Pagina precedente
+# 3 -> Fine della lezione
+# 4 -> Domanda non vista in una pagina con contenuto
+# 5 -> Domanda casuale all'interno di una pagina di contenuto
+# 6 -> Pagina casuale con contenuto
+JUMP_NEXT_PAGE = 1
+JUMP_PREVIOUS_PAGE = 2
+JUMP_RANDOM_CONTENT = 6
+
+# a jump: index of a relative jump, or title of a page
+JumpTo = Union[int, str]
+
+# title given by Moodle to end of cluster pages
+END_GROUP_TITLE = "Fine gruppo"
+
+# ids of lesson pages, in order, from the edit view loaded or fetched. The
+# request given is fetched first, and its response used if it is a listing
+LESSON_PAGE_IDS_SCRIPT = """
+var request = arguments[0], listing = arguments[1];
+var callback = arguments[arguments.length - 1];
+function pageIds(doc) {
+    var ids = [], root = doc.getElementById("region-main") || doc;
+    root.querySelectorAll("a[href*='pageid=']").forEach(function (link) {
+        var id = parseInt(new URL(link.href, location.href).searchParams.get("pageid"));
+        if (id && ids.indexOf(id) < 0) {
+            ids.push(id);
+        }
+    });
+    return ids;
+}
+function get(url) {
+    return fetch(url, {credentials: "same-origin"})
+        .then(function (response) { return response.text(); })
+        .then(function (html) {
+            return pageIds(new DOMParser().parseFromString(html, "text/html"));
+        });
+}
+var ids;
+if (request) {
+    ids = get(request + "&sesskey=" + M.cfg.sesskey);
+} else if (location.pathname.endsWith("/mod/lesson/edit.php")) {
+    ids = Promise.resolve(pageIds(document));
+} else {
+    ids = Promise.resolve([]);
+}
+ids.then(function (found) { return found.length ? found : get(listing); })
+    .then(callback, function () { callback(null); });
+"""
+
+
+# whether a select has an option with the given text
+JUMP_EXISTS_SCRIPT = """
+var text = arguments[1];
+return Array.prototype.some.call(arguments[0].options, function (option) {
+    return option.text.trim() === text;
+});
+"""
+
+
+class SlideStep:
+    """A slide to upload, with its buttons and the cluster following it"""
+
+    __slots__ = ("i", "slide", "kwargs", "is_last_slide", "cluster", "file")
+
+    def __init__(self, i: int, slide: Slide, kwargs: dict, is_last_slide: bool, cluster=None):
+        self.i = i
+        self.slide = slide
+        self.kwargs = kwargs
+        self.is_last_slide = is_last_slide
+        self.cluster: Optional[Cluster] = cluster
+        self.file: Optional[StagedFile] = None
+
+    def stage(self, remote: bool = False) -> "SlideStep":
+        self.file = stage_file(self.slide.path, remote=remote)
+        return self
+
+    def __repr__(self):
+        return f"SlideStep({self.slide}, cluster={self.cluster is not None})"
+
+
 class Module(Element):
     css_selector = "li.activity"
     section: Section
 
+    # slides prepared ahead of the browser, at most
+    pipeline_size = 4
+
     def __repr__(self):
         return super().__repr__().replace("Element", "Module")
 
-    def __init__(self, driver: WebDriver, name: str, section: Section = None):
-        super().__init__(driver, name)
+    def __init__(
+        self,
+        driver: WebDriver,
+        name: str,
+        section: Section = None,
+        config: dict = None,
+    ):
+        super().__init__(driver, name, config)
         self.section = section
 
+        # pages of lesson, tracked while populating it
+        self.last_page_id: Optional[int] = None
+        self.slide_page_ids: List[int] = []
+        self.known_page_ids: Set[int] = set()
+
+        # when set, jumps to pages not in the lesson yet (e.g. created by
+        # another session, see moodle.parallel) are collected here instead
+        # of failing, as (page id, select id, option text)
+        self.deferred_jumps: Optional[List[Tuple[int, str, str]]] = None
+        self._pending_jumps: List[Tuple[str, str]] = []
+
     @property
     def section_element(self) -> WebElement:
         """Returns a WebElement from the Section object"""
         return self.driver.find_element_by_id(self.section.dom_id)
 
+    @operation("create_module")
     def create(self):
         time.sleep(1)
 
@@ -217,12 +356,10 @@ class Module(Element):
         time.sleep(1.5)
 
         # then get its id from last module created in this section
-        module_element = self.section_element.find_elements_by_css_selector(
-            self.css_selector
-        )[-1]
-        self.dom_id = module_element.get_attribute("id")
+        self.dom_id, _ = last_element(self.driver, self.css_selector, self.section.dom_id)
 
-    def upload(self, file: Union[str, os.PathLike]):
+    @operation("upload")
+    def upload(self, file: Union[str, os.PathLike], staged: StagedFile = None):
         # convert path to pathlib object
         file = pathlib.Path(file)
 
@@ -241,9 +378,13 @@ class Module(Element):
         time.sleep(1)
 
         # find input and upload str-file (path)
-        self.driver.find_element_by_name("repo_upload_file").send_keys(
-            str(file.resolve())
-        )
+        file_input = self.driver.find_element_by_name("repo_upload_file")
+        if staged is not None and staged.payload is not None:
+            # already zipped and encoded for the remote browser
+            response = self.driver.execute(Command.UPLOAD_FILE, {"file": staged.payload})
+            file_input.send_keys(response["value"])
+        else:
+            file_input.send_keys(str(file.resolve()))
         time.sleep(1)
 
         # upload button
@@ -310,6 +451,7 @@ class Module(Element):
             except WebDriverException as e:
                 logger.warning(f"An exception occurred: {e}")
                 logger.warning("Getting again select element from raw...")
+                RETRIES.inc(step="select")
                 self.driver.refresh()
                 time.sleep(1)
                 select = Select(eval(raw))
@@ -321,6 +463,7 @@ class Module(Element):
                     break
                 else:
                     logger.debug("Page didn't change, retry again...")
+                    RETRIES.inc(step="select_redirect")
                     self.driver.refresh()
             else:
                 break
@@ -329,166 +472,222 @@ class Module(Element):
             msg = "Redirect after clicking select option didn't work!"
             raise RuntimeError(msg) from None
 
-    def load_slide(self, slide: pathlib.Path, i: int, start: int = None, **kwargs):
-        name = slide.stem
-
-        logger.info(f"Uploading slide no. {i + 1}: {name}")
-
-        try:
-            s = ".box.py-3.generalbox.firstpageoptions > p:nth-child(4) > a"
-            self.driver.find_element_by_css_selector(s).click()
-            logger.debug("Uploaded first module slide")
-        except (WebDriverException, NoSuchElementException):
-            # select dropdown options
-            # 0 -> placeholder
-            # 1 -> Aggiungi fine gruppo
-            # 2 -> Aggiungi gruppo
-            # 3 -> Aggiungi fine diramazione
-            # 4 -> Aggiungi pagina con contenuto
-            # 5 -> Aggiungi pagina con domanda
-
-            # prendi il penultimo select (l'ultimo è "Vai a ...")
-            select_elems = self.driver.find_elements_by_tag_name("select")
-            select = Select(select_elems[-2] if len(select_elems) > 1 else select_elems[-1])
-            raw = """self.driver.find_elements_by_tag_name("select")[-2]"""
-            self.safe_select_by_index(select, 4, raw=raw)
-
-        # sono nella pagina di inserimento Pagina con contenuto
-        name_in_course = name.replace(
-            config["file_parameters"]["base_name"],
-            config["file_parameters"]["base_name_in_course"],
+    @property
+    def module_id(self) -> int:
+        """Course module id, taken from the DOM id (module-<id>)"""
+        return int(self.dom_id.split("-")[1])
+
+    def name_in_course(self, slide: pathlib.Path) -> str:
+        """Page title used on Moodle for a slide file"""
+        return slide.stem.replace(
+            self.config["file_parameters"]["base_name"],
+            self.config["file_parameters"]["base_name_in_course"],
         )
-        self.driver.find_element_by_id("id_title").send_keys(name_in_course)
-        time.sleep(1)
 
-        # espandi tutte le sezioni (bottoni)
-        self.driver.find_element_by_css_selector(".collapseexpand").click()
+    def clear_form(self):
+        """Empty title, contents and answers of an already existing page,
+        so that it can be filled again as if it was a new one"""
+        self.driver.find_element_by_id("id_title").clear()
+        self.driver.execute_script(
+            """
+            document.querySelectorAll("[id$='editoreditable']").forEach(
+                function (el) { el.innerHTML = ""; }
+            );
+            document.querySelectorAll(
+                "input[id^='id_answer_editor_'], textarea[id^='id_answer_editor_'],"
+                + " textarea[id^='id_response_editor_'], textarea[id='id_contents_editor']"
+            ).forEach(function (el) { el.value = ""; });
+            """
+        )
         time.sleep(1)
 
-        # faccio l'upload della slide
-        self.upload(slide)
-        time.sleep(1)
+    def open_new_page(self, anchor: Optional[int], qtype: int):
+        """Open the editor of a new page of type `qtype`, to be added after
+        page `anchor` (as first page if None)"""
+        params = dict(id=self.module_id, qtype=qtype)
+        if anchor is None:
+            params.update(pageid=0, firstpage=1)
+        else:
+            params.update(pageid=anchor)
+        self.driver.get(get_lesson_url("editpage.php", self.config, **params))
+
+    def page_ids(self, request: str = None) -> List[int]:
+        """Ids of lesson pages, in lesson order. Read from the edit view
+        where a submit lands (collapsed, as set by populate) or fetched;
+        `request` is fetched first, e.g. to add a page without a form"""
+        listing = get_lesson_url("edit.php", self.config, id=self.module_id, mode="collapsed")
+        self.driver.set_script_timeout(60)
+        ids = self.driver.execute_async_script(LESSON_PAGE_IDS_SCRIPT, request, listing)
+        if ids is None:
+            msg = "Cannot read pages of lesson!"
+            logger.error(msg)
+            raise RuntimeError(msg)
+        return ids
+
+    def new_page_id(self, anchor: Optional[int], request: str = None, retries: int = 3) -> int:
+        """Id of the page just added after `anchor`"""
+        for j in range(retries):
+            ids = self.page_ids(request if j == 0 else None)
+            if anchor is None:
+                following = ids[:1]
+            else:
+                following = ids[ids.index(anchor) + 1 :][:1] if anchor in ids else []
+            if following and following[0] not in self.known_page_ids:
+                self.known_page_ids.update(ids)
+                return following[0]
+            logger.debug(f"New page after {anchor} not found yet, retry {j + 1}/{retries}")
+            RETRIES.inc(step="page_id")
+            time.sleep(1)
 
-        # e ora lavoro sui bottoni
-        first_input = "id_answer_editor_0"
-        second_input = "id_answer_editor_1"
+        msg = f"Cannot find page added after page {anchor}!"
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+    def select_jump(self, select_id: str, text: str):
+        """Select the jump with visible text `text`, or defer it if the
+        page it names does not exist yet and jumps are deferred"""
+        element = self.driver.find_element_by_id(select_id)
+        if self.deferred_jumps is not None and not self.driver.execute_script(
+            JUMP_EXISTS_SCRIPT, element, text
+        ):
+            logger.debug(f"Jump to '{text}' of {select_id} deferred")
+            self._pending_jumps.append((select_id, text))
+            return
+        Select(element).select_by_visible_text(text)
+
+    def page_saved(self, page_id: int):
+        """Record page just saved, owning the jumps deferred while filling it"""
+        if self.deferred_jumps is not None:
+            self.deferred_jumps.extend(
+                (page_id, select_id, text) for select_id, text in self._pending_jumps
+            )
+        self._pending_jumps = []
 
-        first_select = "id_jumpto_0"
-        second_select = "id_jumpto_1"
+    @operation("load_slide")
+    def load_slide(
+        self,
+        slide: pathlib.Path,
+        i: int,
+        start: int = None,
+        staged: StagedFile = None,
+        **kwargs,
+    ):
+        name = slide.stem
 
-        # select options index
-        # 0 -> Questa pagina
-        # 1 -> Pagina successiva
-        # 2 -> Pagina precedente
-        # 3 -> Fine della lezione
-        # 4 -> Domanda non vista in una pagina con contenuto
-        # 5 -> Domanda casuale all'interno di una pagina di contenuto
-        # 6 -> Pagina casuale con contenuto
+        logger.info(f"Uploading slide no. {i + 1}: {name}")
 
-        # prima pagina = solo avanti va popolato
-        # solo se però non abbiamo settato lo start
-        if i == 0 and start is None:
-            logger.debug("Prima slide = popolo solo 'avanti'")
+        # straight to the editor of a content page after the last page
+        anchor = self.last_page_id
+        self.open_new_page(anchor, QTYPE_BRANCHTABLE)
+        time.sleep(1)
 
-            self.driver.find_element_by_id(first_input).send_keys("Avanti")
-            time.sleep(1)
+        # sono nella pagina di inserimento Pagina con contenuto
+        self.fill_slide(slide, first=i == 0 and start is None, staged=staged, **kwargs)
 
-            select = self.driver.find_element_by_id(first_select)
-            Select(select).select_by_index(1)
-            time.sleep(1)
-        elif kwargs.get("jump_to_random_content"):
-            logger.debug(
-                "Slide finale del cluster: popolo indietro e casuale con contenuto"
-            )
+        # and then save slide
+        self.driver.find_element_by_id("id_submitbutton").click()
+        time.sleep(1)
 
-            self.driver.find_element_by_id(first_input).send_keys("Indietro")
-            time.sleep(1)
+        self.last_page_id = self.new_page_id(anchor)
+        self.slide_page_ids.append(self.last_page_id)
+        self.page_saved(self.last_page_id)
+        logger.info("Slide uploaded")
 
-            select = self.driver.find_element_by_id(first_select)
-            Select(select).select_by_index(2)
-            time.sleep(1)
+    def fill_slide(
+        self, slide: pathlib.Path, first: bool = False, staged: StagedFile = None, **kwargs
+    ):
+        """Fill the editor of a content page with a slide and its buttons.
 
-            self.driver.find_element_by_id(second_input).send_keys("Avanti")
-            time.sleep(1)
+        The editor must be already open; the form is not submitted."""
+        self.driver.find_element_by_id("id_title").send_keys(self.name_in_course(slide))
+        time.sleep(1)
 
-            select = self.driver.find_element_by_id(second_select)
-            Select(select).select_by_index(6)
-            time.sleep(1)
-        else:
-            logger.debug("Slide generica = popolo 'avanti' e 'indietro'")
+        # espandi tutte le sezioni (bottoni)
+        self.driver.find_element_by_css_selector(".collapseexpand").click()
+        time.sleep(1)
 
-            prefix = kwargs.get(
-                "prefix", config["file_parameters"]["base_name_in_course"]
-            )
+        # faccio l'upload della slide
+        self.upload(slide, staged=staged)
+        time.sleep(1)
 
-            self.driver.find_element_by_id(first_input).send_keys("Indietro")
+        # e ora lavoro sui bottoni
+        for i, (label, jump) in enumerate(self.slide_buttons(first, **kwargs)):
+            self.driver.find_element_by_id(f"id_answer_editor_{i}").send_keys(label)
             time.sleep(1)
 
-            select = Select(self.driver.find_element_by_id(first_select))
-            if kwargs.get("back_slide"):
-                slide_number = kwargs.get("back_slide")
-                slide = f"{prefix}{slide_number}"
-                select.select_by_visible_text(slide)
+            select_id = f"id_jumpto_{i}"
+            if isinstance(jump, int):
+                Select(self.driver.find_element_by_id(select_id)).select_by_index(jump)
             else:
-                select.select_by_index(2)
+                self.select_jump(select_id, jump)
             time.sleep(1)
 
-            self.driver.find_element_by_id(second_input).send_keys("Avanti")
-            time.sleep(1)
+    def slide_buttons(self, first: bool = False, **kwargs) -> List[Tuple[str, JumpTo]]:
+        """Buttons of a content page, as (label, jump): the jump is an index
+        of the jump select (see JUMP_*) or the title of a page"""
+        # prima pagina = solo avanti va popolato
+        # solo se però non abbiamo settato lo start
+        if first:
+            logger.debug("Prima slide = popolo solo 'avanti'")
+            return [("Avanti", JUMP_NEXT_PAGE)]
 
-            select = self.driver.find_element_by_id(second_select)
-            if kwargs.get("next_slide"):
-                slide_number = kwargs.get("next_slide")
-                slide = f"{prefix}{slide_number}"
-                select.select_by_visible_text(slide)
-            else:
-                Select(select).select_by_index(1)
-            time.sleep(1)
+        if kwargs.get("jump_to_random_content"):
+            logger.debug("Slide finale del cluster: popolo indietro e casuale con contenuto")
+            return [("Indietro", JUMP_PREVIOUS_PAGE), ("Avanti", JUMP_RANDOM_CONTENT)]
 
-        # and then save slide
-        self.driver.find_element_by_id("id_submitbutton").click()
-        time.sleep(1)
+        logger.debug("Slide generica = popolo 'avanti' e 'indietro'")
+        prefix = kwargs.get("prefix", self.config["file_parameters"]["base_name_in_course"])
 
-        logger.info("Slide uploaded")
+        back, forward = kwargs.get("back_slide"), kwargs.get("next_slide")
+        return [
+            ("Indietro", f"{prefix}{back}" if back else JUMP_PREVIOUS_PAGE),
+            ("Avanti", f"{prefix}{forward}" if forward else JUMP_NEXT_PAGE),
+        ]
 
+    @staticmethod
+    def slide_kwargs(index: int, max_slide_in_cluster_list) -> dict:
+        """Return buttons options (kwargs of load_slide) of the slide with
+        given index, from the (set of) max slide of every cluster"""
+        # massima slide nel cluster corrente
+        max_slide_in_cluster = index in max_slide_in_cluster_list
+
+        # minima slide dopo il cluster e PRIMA del fine gruppo
+        min_slide_after_cluster = index - 1 in max_slide_in_cluster_list
+
+        # minima slide dopo il cluster e DOPO del fine gruppo
+        min_slide_after_end_group = index - 2 in max_slide_in_cluster_list
+
+        kwargs = dict()
+        if max_slide_in_cluster:
+            kwargs.update(jump_to_random_content=True)
+        if min_slide_after_cluster or min_slide_after_end_group:
+            kwargs.update(back_slide=index - 1)
+        return kwargs
+
+    @operation("load_cluster")
     def load_cluster(self, cluster: Cluster, **kwargs):
         logger.info("Inside load_cluster func!")
 
-        prefix = config["file_parameters"]["base_name_in_course"]
-
         is_last_slide = kwargs.get("is_last_slide", False)
         slide_index = kwargs["index"]
         is_last_slide_in_cluster = slide_index <= cluster.max_slide_in_cluster
+        jump2correct = self.correct_jump(cluster, is_last_slide, slide_index)
 
+        # when called this function, we can have two scenarios
+        # 1) slide (end), end group, slide (after-end) -> after the slide before
+        # 2) slide (end), end group -> after the last slide
+        # 2 is possible when is last slide is True
+        anchor = self.slide_page_ids[-2] if len(self.slide_page_ids) > 1 else None
         if is_last_slide and is_last_slide_in_cluster:
-            jump2correct = "Fine gruppo"
-        else:
-            jump_to = cluster.max_slide_in_cluster + 1
-            jump2correct = f"{prefix}{jump_to}"
+            anchor = self.slide_page_ids[-1]
+        if anchor is None:
+            msg = "Cannot find the slide page followed by questions!"
+            logger.error(msg)
+            raise ValueError(msg)
 
         for i, question in enumerate(cluster.questions):
-            # when called this function, we can have two scenarios
-            # 1) slide (end), end group, slide (after-end) -> we take -3
-            # 2) slide (end), end group -> we take -2
-            # 2 is possible when is last slide is True
-            index = -3
-            if is_last_slide and is_last_slide_in_cluster:
-                index = -2
-
-            select = self.driver.find_elements_by_css_selector(
-                ".custom-select.singleselect"
-            )[index]
-
-            raw = f"""self.driver.find_elements_by_css_selector(
-                ".custom-select.singleselect"
-            )[{index}]""".strip()
-
-            # select add question from dropdown
-            self.safe_select_by_index(Select(select), 5, raw=raw)
-            time.sleep(1)
-
-            # submit
-            self.driver.find_element_by_id("id_submitbutton").click()
+            # straight to the editor of a multichoice page, after the previous
+            self.open_new_page(anchor, QTYPE_MULTICHOICE)
             time.sleep(1)
 
             # now we have to populate the question
@@ -496,116 +695,171 @@ class Module(Element):
 
             logger.info(f"Uploading question no. {i+1}: {name}")
 
-            # first we expand all sections
-            expand_all = self.driver.find_element_by_class_name("collapseexpand")
-            if "collapse-all" not in expand_all.get_attribute("class"):
-                expand_all.click()
-                time.sleep(1)
+            self.fill_question(question, jump2correct)
 
-            # then we submit the title (domanda i)
-            self.driver.find_element_by_id("id_title").send_keys(name)
+            # then save question
+            self.driver.find_element_by_id("id_submitbutton").click()
+            logger.info("Question uploaded")
+            PROGRESS.question_done()
             time.sleep(1)
 
-            # then the question itself
-            self.driver.find_element_by_id("id_contents_editoreditable").send_keys(
-                question.name
-            )
+            anchor = self.new_page_id(anchor)
+            self.page_saved(anchor)
+
+    def correct_jump(self, cluster: Cluster, is_last_slide: bool, index: int) -> str:
+        """Page a correct answer of a cluster question jumps to, the questions
+        being loaded with slide `index`"""
+        if is_last_slide and index <= cluster.max_slide_in_cluster:
+            return END_GROUP_TITLE
+        prefix = self.config["file_parameters"]["base_name_in_course"]
+        return f"{prefix}{cluster.max_slide_in_cluster + 1}"
+
+    def fill_question(self, question: Question, jump2correct: str):
+        """Fill the editor of a question page, jumping to `jump2correct`
+        on the correct answer.
+
+        The editor must be already open; the form is not submitted."""
+        prefix = self.config["file_parameters"]["base_name_in_course"]
+        name = f"Domanda {question.number}"
+
+        # first we expand all sections
+        expand_all = self.driver.find_element_by_class_name("collapseexpand")
+        if "collapse-all" not in expand_all.get_attribute("class"):
+            expand_all.click()
             time.sleep(1)
 
-            # then populate the three answers
-            index_wrong = 0
-            for answer in question.answers:
-                if answer.is_correct:
-                    # find div of first answer
-                    div = self.driver.find_elements_by_class_name(
-                        "editor_atto_toolbar"
-                    )[1]
-
-                    # expand group of buttons
-                    div.find_element_by_class_name("atto_collapse_button").click()
-                    time.sleep(1)
-
-                    # click html button
-                    div.find_element_by_class_name("atto_html_button").click()
-                    time.sleep(1)
-
-                    # make textarea html visible
-                    self.driver.execute_script(
-                        "$('#id_answer_editor_0').removeAttr('style').removeAttr('hidden')"
-                    )
-                    time.sleep(1)
-                    self.driver.find_element_by_id("id_answer_editor_0").send_keys(
-                        answer.html
-                    )
-                    time.sleep(1)
+        # then we submit the title (domanda i)
+        self.driver.find_element_by_id("id_title").send_keys(name)
+        time.sleep(1)
 
-                    # to save edits, click again html button
-                    div.find_element_by_class_name("atto_html_button").click()
-                    time.sleep(1)
+        # then the question itself
+        self.driver.find_element_by_id("id_contents_editoreditable").send_keys(
+            question.name
+        )
+        time.sleep(1)
 
-                    # select correct slide to jump
-                    select = Select(self.driver.find_element_by_id("id_jumpto_0"))
-                    select.select_by_visible_text(jump2correct)
-                    time.sleep(1)
+        # then populate the three answers
+        index_wrong = 0
+        for answer in question.answers:
+            if answer.is_correct:
+                # find div of first answer
+                div = self.driver.find_elements_by_class_name(
+                    "editor_atto_toolbar"
+                )[1]
+
+                # expand group of buttons
+                div.find_element_by_class_name("atto_collapse_button").click()
+                time.sleep(1)
 
-                    # then set response
-                    el = self.driver.find_element_by_id("id_response_editor_0editable")
-                    el.send_keys("Risposta Esatta")
-                    time.sleep(1)
+                # click html button
+                div.find_element_by_class_name("atto_html_button").click()
+                time.sleep(1)
 
-                else:
-                    index_wrong += 1
-
-                    # send answer text (plaintext)
-                    text_id = f"id_answer_editor_{index_wrong}editable"
-                    self.driver.find_element_by_id(text_id).send_keys(answer.text)
-                    time.sleep(1)
-
-                    # then jump to right slide
-                    jump_to = question.jump2slide
-                    value = f"{prefix}{jump_to}"
-                    select = Select(
-                        self.driver.find_element_by_id(f"id_jumpto_{index_wrong}")
-                    )
-                    select.select_by_visible_text(value)
-                    time.sleep(1)
+                # make textarea html visible
+                self.driver.execute_script(
+                    "$('#id_answer_editor_0').removeAttr('style').removeAttr('hidden')"
+                )
+                time.sleep(1)
+                self.driver.find_element_by_id("id_answer_editor_0").send_keys(
+                    answer.html
+                )
+                time.sleep(1)
 
-                    # then set response
-                    el = self.driver.find_element_by_id(
-                        f"id_response_editor_{index_wrong}editable"
-                    )
-                    el.send_keys("Risposta Errata")
-                    time.sleep(1)
+                # to save edits, click again html button
+                div.find_element_by_class_name("atto_html_button").click()
+                time.sleep(1)
 
-            # then save question
-            self.driver.find_element_by_id("id_submitbutton").click()
-            logger.info("Question uploaded")
-            time.sleep(1)
+                # select correct slide to jump
+                self.select_jump("id_jumpto_0", jump2correct)
+                time.sleep(1)
 
+                # then set response
+                el = self.driver.find_element_by_id("id_response_editor_0editable")
+                el.send_keys("Risposta Esatta")
+                time.sleep(1)
+
+            else:
+                index_wrong += 1
+
+                # send answer text (plaintext)
+                text_id = f"id_answer_editor_{index_wrong}editable"
+                self.driver.find_element_by_id(text_id).send_keys(answer.text)
+                time.sleep(1)
+
+                # then jump to right slide
+                jump_to = question.jump2slide
+                self.select_jump(f"id_jumpto_{index_wrong}", f"{prefix}{jump_to}")
+                time.sleep(1)
+
+                # then set response
+                el = self.driver.find_element_by_id(
+                    f"id_response_editor_{index_wrong}editable"
+                )
+                el.send_keys("Risposta Errata")
+                time.sleep(1)
+
+    @operation("add_end_group")
     def add_end_group(self):
-        select = self.driver.find_elements_by_css_selector(
-            ".custom-select.singleselect"
-        )[-1]
-        raw = """self.driver.find_elements_by_css_selector(
-            ".custom-select.singleselect"
-        )[-1]""".strip()
-        self.safe_select_by_index(Select(select), 1, raw=raw, should_redirect=False)
+        """Add an end of cluster page after the last page, without a form"""
+        url = get_lesson_url(
+            "editpage.php",
+            self.config,
+            id=self.module_id,
+            pageid=self.last_page_id or 0,
+            qtype=QTYPE_ENDOFCLUSTER,
+        )
+        self.last_page_id = self.new_page_id(self.last_page_id, request=url)
 
-    def populate(
+    def plan_steps(self, slides: list, clusters: list, max_slide_in_cluster_list) -> Iterator:
+        """Yield what to upload for every slide, with jumps already resolved"""
+        # clusters still to upload, by their max slide
+        pending = {cluster.max_slide_in_cluster: cluster for cluster in clusters}
+        for i, slide in enumerate(slides):
+            # ultima slide della lista delle slides da caricare
+            is_last_slide = i == len(slides) - 1
+
+            # minima slide dopo il cluster e PRIMA del fine gruppo
+            min_slide_after_cluster = slide.index - 1 in max_slide_in_cluster_list
+
+            kwargs = self.slide_kwargs(slide.index, max_slide_in_cluster_list)
+
+            # se ho l'ultima slides e ancora clusters (uno?) da caricare
+            # oppure se mi trovo esattamente una slide dopo la max slide del cluster passato
+            # allora carico il cluster e aggiungo fine gruppo
+            cluster = pending.pop(slide.index - 1, None) if min_slide_after_cluster else None
+            if cluster is None and is_last_slide and pending:
+                cluster = pending.pop(min(pending))
+
+            yield SlideStep(i, slide, kwargs, is_last_slide, cluster)
+
+    def open_lesson(self):
+        """Open the edit view of the lesson and read its pages"""
+        # collapsed view is kept as preference, so that every submit lands on
+        # a light page instead of one rendering every page of the lesson
+        self.driver.get(
+            get_lesson_url("edit.php", self.config, id=self.module_id, mode="collapsed")
+        )
+        time.sleep(1)
+
+        ids = self.page_ids()
+        self.known_page_ids = set(ids)
+        self.last_page_id = ids[-1] if ids else None
+        self.slide_page_ids = []
+
+    def find_work(
         self,
         directory: Union[str, os.PathLike],
         start: int = None,
         load_only_slide=False,
-    ):
-        module_id = self.dom_id.split("-")[1]
-        url = config["site"]["module"] + module_id
-        self.driver.get(url)
-        time.sleep(1)
-
+        manifest: Manifest = None,
+    ) -> tuple:
+        """Return slides and clusters to upload from a module directory,
+        with the max slide of every cluster"""
         directory = pathlib.Path(directory)
+        entry = manifest[directory] if manifest else None
 
         # take json file
-        json_fp = list(directory.glob("*.json"))
+        json_fp = entry.json_files if entry else find_json(directory)
         if not load_only_slide:
             assert len(json_fp) > 0, "No json found inside module directory!"
             assert (
@@ -616,26 +870,14 @@ class Module(Element):
             # create object of all module clusters
             module_cluster = ModuleCluster(json_fp)
 
-            # take all clusters for module as list
-            clusters = [cluster for cluster in module_cluster.clusters]
-
-            # and then take max slide in cluster (BEFORE questions)
-            max_slide_in_cluster_list = [
-                cluster.max_slide_in_cluster for cluster in clusters
-            ]
+            # and then take max slide in cluster (BEFORE questions), as a set
+            max_slide_in_cluster_list = module_cluster.max_slides
         else:
-            max_slide_in_cluster_list = []
-            clusters = []
-
-        # glob slides from directory
-        # also convert to Slide objects
-        slides = [
-            Slide(slide)
-            for slide in directory.iterdir()
-            if Slide.pattern.match(slide.name) and "json" not in slide.name
-        ]
-        # sort them by index
-        slides = sorted(slides, key=lambda slide: slide.index)
+            max_slide_in_cluster_list = frozenset()
+            module_cluster = None
+
+        # glob slides from directory, sorted by index
+        slides = Slide.find_all(entry or directory)
 
         # if start is specified, select subset of slides
         if start is not None:
@@ -648,43 +890,60 @@ class Module(Element):
         first_slide = slides[0]
 
         # take a cluster only if the first slide to upload is behind its max slide
-        clusters = [
-            cluster
-            for cluster in clusters
-            if first_slide.index <= cluster.max_slide_in_cluster
-        ]
+        clusters = list(module_cluster.from_slide(first_slide.index)) if module_cluster else []
 
         logger.info(f"Found {len(slides)} slides, that are: {slides}")
+        return slides, clusters, max_slide_in_cluster_list
 
-        for i, slide in enumerate(slides):
-            # ultima slide della lista delle slides da caricare
-            is_last_slide = i == len(slides) - 1
-
-            # massima slide nel cluster corrente
-            max_slide_in_cluster = slide.index in max_slide_in_cluster_list
-
-            # minima slide dopo il cluster e PRIMA del fine gruppo
-            min_slide_after_cluster = slide.index - 1 in max_slide_in_cluster_list
+    @operation("populate")
+    def populate(
+        self,
+        directory: Union[str, os.PathLike],
+        start: int = None,
+        load_only_slide=False,
+        manifest: Manifest = None,
+    ):
+        self.open_lesson()
 
-            # minima slide dopo il cluster e DOPO del fine gruppo
-            min_slide_after_end_group = slide.index - 2 in max_slide_in_cluster_list
+        slides, clusters, max_slide_in_cluster_list = self.find_work(
+            directory, start=start, load_only_slide=load_only_slide, manifest=manifest
+        )
+        PROGRESS.add_work(len(slides), sum(cluster.num_questions for cluster in clusters))
 
-            kwargs = dict()
-            if max_slide_in_cluster:
-                kwargs.update(jump_to_random_content=True)
-            if min_slide_after_cluster or min_slide_after_end_group:
-                kwargs.update(back_slide=slide.index - 1)
+        self.upload_steps(
+            self.plan_steps(slides, clusters, max_slide_in_cluster_list), start=start
+        )
 
-            self.load_slide(slide.path, i, start=start, **kwargs)
+    def upload_steps(self, steps: Iterable[SlideStep], start: int = None):
+        """Upload slides, and clusters following them, after the last page"""
+        remote = self.config.get("selenium", {}).get("env") == "remote"
+        pipeline = Pipeline(
+            steps,
+            {"stage": lambda step: step.stage(remote)},
+            maxsize=self.pipeline_size,
+        )
 
-            # se ho l'ultima slides e ancora clusters (uno?) da caricare
-            # oppure se mi trovo esattamente una slide dopo la max slide del cluster passato
-            # allora carico il cluster e aggiungo fine gruppo
-            if (is_last_slide and clusters) or min_slide_after_cluster:
-                # create end group
-                self.add_end_group()
+        state = None
+        for step in pipeline:
+            slide = step.slide
+            with log_context(module=self.name, slide=slide.index):
+                self.load_slide(slide.path, step.i, start=start, staged=step.file, **step.kwargs)
+                PROGRESS.slide_done()
+
+                # fingerprint of slide uploaded, so that sync knows it's current
+                state = state or SyncState(slide.path.parent)
+                state.record(self.name_in_course(slide.path), slide.path)
+                state.save()
+
+                if step.cluster is not None:
+                    # create end group
+                    self.add_end_group()
+
+                    # carica domande fra slide precedente e attuale
+                    self.load_cluster(
+                        step.cluster, is_last_slide=step.is_last_slide, index=slide.index
+                    )
 
-                # carica domande fra slide precedente e attuale
-                self.load_cluster(
-                    clusters.pop(0), is_last_slide=is_last_slide, index=slide.index
-                )
+                # browser can be recycled only between slides
+                if isinstance(self.driver, ManagedDriver):
+                    self.driver.page_done()
@@ -0,0 +1,244 @@
+"""Where the time of every step goes: Moodle, the network or this tool.
+
+The browser logs network events (the chromedriver performance log, or the
+DevTools events of the cdp engine) and a NetworkRecorder attached to a driver
+reads them when a step ends: an operation (see moodle.instrument) run on its
+own, or directly inside another one (e.g. load_slide inside populate).
+Operations nested deeper (e.g. upload inside load_slide) are part of their
+step, so that the log is read once per step and not once per operation. For
+every request of a page, form submit or script fetch it takes:
+
+- connect: from the request to its sending (queueing, dns, tcp, tls)
+- server: from the request sent to the first byte of the response
+- transfer: from the first to the last byte of the response
+
+and for every step the client idle time, when no request was in flight: the
+time spent by this tool, its waits and the browser rendering."""
+import collections
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from moodle.metrics import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+NETWORK_SECONDS = REGISTRY.register(
+    Counter("network_seconds_total", "Seconds of steps by phase (connect, server, ...)")
+)
+
+# requests of pages, form submits and scripts, not of images or styles
+RECORDED_TYPES = ("Document", "XHR", "Fetch")
+
+PHASES = ("connect", "server", "transfer", "idle")
+
+# operations nested deeper than this are part of the step running them
+STEP_DEPTH = 1
+
+# capability asking chromedriver to log network events
+LOGGING_PREFS = {"performance": "ALL"}
+PERF_LOGGING_PREFS = {"enableNetwork": True, "enablePage": False}
+
+
+def add_logging_capability(options):
+    """Enable the performance log on Chrome options"""
+    options.set_capability("goog:loggingPrefs", LOGGING_PREFS)
+    options.add_experimental_option("perfLoggingPrefs", PERF_LOGGING_PREFS)
+
+
+class Request:
+    """Timings of a request (or of a leg of a redirect), in seconds"""
+
+    __slots__ = ("type", "start", "end", "connect", "server", "headers_at")
+
+    def __init__(self, type_: str, start: float):
+        self.type = type_
+        self.start = start
+        self.end: Optional[float] = None
+        self.connect = 0.0
+        self.server = 0.0
+        # browser time of the first byte of response
+        self.headers_at: Optional[float] = None
+
+    def set_response(self, response: dict):
+        timing = response.get("timing")
+        if not timing:
+            # served from cache
+            return
+        self.connect = max(0.0, timing["sendStart"]) / 1000
+        self.server = max(0.0, timing["receiveHeadersEnd"] - timing["sendEnd"]) / 1000
+        self.headers_at = timing["requestTime"] + timing["receiveHeadersEnd"] / 1000
+
+    @property
+    def transfer(self) -> float:
+        if self.end is None or self.headers_at is None:
+            return 0.0
+        return max(0.0, self.end - self.headers_at)
+
+
+def busy_seconds(requests: List[Request]) -> float:
+    """Time with at least a request in flight"""
+    busy, until = 0.0, None
+    for request in sorted(requests, key=lambda r: r.start):
+        if until is None or request.start > until:
+            busy += request.end - request.start
+            until = request.end
+        elif request.end > until:
+            busy += request.end - until
+            until = request.end
+    return busy
+
+
+class StepTimes:
+    __slots__ = ("calls", "requests", "seconds") + PHASES
+
+    def __init__(self):
+        self.calls = 0
+        self.requests = 0
+        self.seconds = 0.0
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+
+
+class NetworkRecorder:
+    """Attribute network timings of a driver to the operations running"""
+
+    # recorders attached to some driver, notified when operations end
+    attached = []
+
+    def __init__(self):
+        self.driver = None
+        self.thread: Optional[int] = None
+        self.steps: Dict[str, StepTimes] = collections.defaultdict(StepTimes)
+        # requests started and not finished yet, by request id
+        self.open: Dict[str, Request] = {}
+        # seconds of nested steps for every step running, None for
+        # operations nested deeper, part of their step
+        self._children: List[Optional[float]] = []
+
+    def attach(self, driver):
+        """Record network of a driver, started with the performance log, for
+        the operations of the calling thread"""
+        self.driver = driver
+        self.thread = threading.get_ident()
+        if self not in NetworkRecorder.attached:
+            NetworkRecorder.attached.append(self)
+        return self
+
+    def detach(self):
+        if self in NetworkRecorder.attached:
+            NetworkRecorder.attached.remove(self)
+
+    def operation_started(self):
+        if threading.get_ident() == self.thread:
+            is_step = len(self._children) <= STEP_DEPTH
+            self._children.append(0.0 if is_step else None)
+
+    def operation_done(self, name: str, seconds: float):
+        if threading.get_ident() != self.thread or not self._children:
+            return
+        children = self._children.pop()
+        if children is None:
+            return
+        if self._children:
+            self._children[-1] += seconds
+
+        finished = self.read()
+        step = self.steps[name]
+        step.calls += 1
+        step.requests += len(finished)
+        # time of the step itself, nested steps have their own
+        own = max(0.0, seconds - children)
+        step.seconds += own
+
+        phases = dict(
+            connect=sum(r.connect for r in finished),
+            server=sum(r.server for r in finished),
+            transfer=sum(r.transfer for r in finished),
+            idle=max(0.0, own - busy_seconds(finished)),
+        )
+        for phase, value in phases.items():
+            setattr(step, phase, getattr(step, phase) + value)
+            NETWORK_SECONDS.inc(value, step=name, phase=phase)
+
+    def read(self) -> List[Request]:
+        """Requests finished since last read"""
+        try:
+            entries = self.driver.get_log("performance")
+        except Exception as e:
+            logger.debug(f"Cannot read performance log: {e}")
+            return []
+        return self.parse(entries)
+
+    def parse(self, entries: List[dict]) -> List[Request]:
+        finished = []
+        for entry in entries:
+            message = json.loads(entry["message"])["message"]
+            method, params = message.get("method"), message.get("params", {})
+            request_id = params.get("requestId")
+
+            if method == "Network.requestWillBeSent":
+                previous = self.open.pop(request_id, None)
+                if previous is not None and "redirectResponse" in params:
+                    # a redirect (e.g. after a form post) ends the previous leg
+                    previous.set_response(params["redirectResponse"])
+                    previous.end = params["timestamp"]
+                    finished.append(previous)
+                if params.get("type") in RECORDED_TYPES:
+                    self.open[request_id] = Request(params["type"], params["timestamp"])
+            elif method == "Network.responseReceived" and request_id in self.open:
+                self.open[request_id].set_response(params["response"])
+            elif method in ("Network.loadingFinished", "Network.loadingFailed"):
+                request = self.open.pop(request_id, None)
+                if request is not None:
+                    request.end = params["timestamp"]
+                    finished.append(request)
+        return finished
+
+    def report(self) -> str:
+        lines = []
+        steps: List[Tuple[str, StepTimes]] = sorted(
+            self.steps.items(), key=lambda item: item[1].seconds, reverse=True
+        )
+        for name, step in steps:
+            calls = step.calls or 1
+            shares = ", ".join(
+                f"{phase} {getattr(step, phase) / calls:.2f}s" for phase in PHASES
+            )
+            lines.append(
+                f"{name}: {step.calls} calls, {step.requests / calls:.1f} requests/call,"
+                f" {step.seconds / calls:.2f}s/call ({shares})"
+            )
+        return "\n".join(lines)
+
+
+class PerformanceLog:
+    """Network events collected as chromedriver performance log entries,
+    for drivers without one (the cdp engine)"""
+
+    METHODS = (
+        "Network.requestWillBeSent",
+        "Network.responseReceived",
+        "Network.loadingFinished",
+        "Network.loadingFailed",
+    )
+
+    def __init__(self, maxlen: int = 100000):
+        self.entries = collections.deque(maxlen=maxlen)
+
+    def listener(self, method: str):
+        def append(params: dict):
+            message = json.dumps({"message": {"method": method, "params": params}})
+            self.entries.append(
+                {"level": "INFO", "timestamp": int(time.time() * 1000), "message": message}
+            )
+
+        return append
+
+    def drain(self) -> List[dict]:
+        entries = []
+        while self.entries:
+            entries.append(self.entries.popleft())
+        return entries
@@ -5,7 +5,7 @@ from selenium.common import exceptions
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.remote.webdriver import WebDriver
 
-from moodle.utility import config
+from moodle.utility import default_config
 
 logger = logging.getLogger(__name__)
 
@@ -13,8 +13,9 @@ logger = logging.getLogger(__name__)
 class Page(ABC):
     """Abstract web page to complete"""
 
-    def __init__(self, driver: WebDriver):
+    def __init__(self, driver: WebDriver, config: dict = None):
         self.driver = driver
+        self.config = config or default_config()
 
     def complete(self):
         raise NotImplementedError
@@ -23,7 +24,7 @@ class Page(ABC):
 class ToggleEditPage(Page):
     def complete(self):
         # assure we're on course page
-        self.driver.get(config["site"]["course"])
+        self.driver.get(self.config["site"]["course"])
 
         # click settings icon - gear
         #selector = "action-menu-toggle-2"
@@ -32,6 +33,13 @@ class ToggleEditPage(Page):
         #selector = "#action-menu-2-menu > div:nth-child(2) > a"
         #self.driver.find_element_by_css_selector(selector).click()
 
+        # editing is kept in user session, so it may be already enabled
+        # (e.g. by another course visited with the same session)
+        body_class = self.driver.find_element_by_tag_name("body").get_attribute("class")
+        if "editing" in body_class.split():
+            logger.debug("Editing of course already enabled")
+            return
+
         selector = "div.singlebutton > form"
         self.driver.find_element_by_css_selector(selector).submit()
 
@@ -45,7 +53,7 @@ class LoginPage(Page):
         logger.info("Login started")
 
         # go to login page
-        self.driver.get(config["site"]["login"])
+        self.driver.get(self.config["site"]["login"])
 
         try:
             username_field = self.driver.find_element_by_id("username")
@@ -56,7 +64,7 @@ class LoginPage(Page):
             logger.error(str(e))
             raise e
         else:
-            username_field.send_keys(config["credentials"]["username"])
-            password_field.send_keys(config["credentials"]["password"])
+            username_field.send_keys(self.config["credentials"]["username"])
+            password_field.send_keys(self.config["credentials"]["password"])
             password_field.send_keys(Keys.ENTER)
             logger.info("Logged in")
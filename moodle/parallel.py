@@ -0,0 +1,220 @@
+"""Population of a single large lesson by several browsers.
+
+Slides are split into contiguous ranges, at cluster boundaries so that a
+cluster and its questions stay in one range, and every range is uploaded by
+its own logged in session. Before ranges start, an empty end of cluster page
+per range is added to the lesson as placeholder: a session adds its pages
+after its placeholder, and then after its own last page, so ranges land in
+lesson order and no two sessions relink the same page.
+
+Jumps naming a page of another range, which may not exist yet when a page is
+filled, are deferred (see `Module.select_jump`) and set in a final pass,
+which then deletes placeholders and checks the order of slides."""
+import contextvars
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from selenium.webdriver.support.select import Select
+
+from moodle.batch import CLUSTER_COST, QUESTION_COST, SLIDE_COST
+from moodle.cleanup import FETCH_ALL_SCRIPT, SCRIPT_TIMEOUT_S
+from moodle.logs import log_context
+from moodle.metrics import PROGRESS
+from moodle.model import Module, SlideStep
+from moodle.utility import get_lesson_url
+
+logger = logging.getLogger(__name__)
+
+# a range is worth a browser only with at least this many slides
+MIN_RANGE_SLIDES = 10
+
+
+def step_cost(step: SlideStep) -> float:
+    cost = SLIDE_COST
+    if step.cluster is not None:
+        cost += step.cluster.num_questions * QUESTION_COST + CLUSTER_COST
+    return cost
+
+
+def split_steps(steps: List[SlideStep], max_slides, ranges: int) -> List[List[SlideStep]]:
+    """Split steps into at most `ranges` contiguous ranges of similar cost.
+
+    A range starts only at the slide after an end of cluster (anywhere
+    without clusters), so that jumps of questions stay inside it"""
+    segments: List[List[SlideStep]] = []
+    for step in steps:
+        if not segments or not max_slides or step.slide.index - 2 in max_slides:
+            segments.append([])
+        segments[-1].append(step)
+
+    ranges = max(1, min(ranges, len(steps) // MIN_RANGE_SLIDES, len(segments)))
+    total = sum(step_cost(step) for step in steps)
+
+    result: List[List[SlideStep]] = [[]]
+    done = 0.0
+    for segment in segments:
+        # next range once previous ones have their share of the cost
+        if result[-1] and len(result) < ranges and done >= total * len(result) / ranges:
+            result.append([])
+        result[-1].extend(segment)
+        done += sum(step_cost(step) for step in segment)
+    return result
+
+
+class ParallelPopulator:
+    """Populate the lesson of a module with many sessions (Automators),
+    the first one being the session of the module"""
+
+    def __init__(self, module: Module, sessions: list):
+        if not sessions:
+            msg = "At least a session is needed to populate a lesson!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.module = module
+        self.sessions = sessions
+
+    def populate(self, directory, start: int = None, load_only_slide=False, manifest=None):
+        module = self.module
+        module.open_lesson()
+
+        slides, clusters, max_slides = module.find_work(
+            directory, start=start, load_only_slide=load_only_slide, manifest=manifest
+        )
+        PROGRESS.add_work(len(slides), sum(cluster.num_questions for cluster in clusters))
+
+        steps = list(module.plan_steps(slides, clusters, max_slides))
+        ranges = split_steps(steps, max_slides, len(self.sessions))
+        if len(ranges) == 1:
+            logger.info(f"{module} too small to split, populating with one session")
+            module.upload_steps(steps, start=start)
+            return
+
+        logger.info(
+            f"Populating {module} in {len(ranges)} ranges, starting at slides"
+            f" {[steps_[0].slide.index for steps_ in ranges]}"
+        )
+        placeholders = self.add_placeholders(len(ranges))
+
+        workers = [module] + [
+            self.range_module(session) for session in self.sessions[1 : len(ranges)]
+        ]
+        errors: List[Optional[BaseException]] = [None] * len(ranges)
+
+        def work(r: int):
+            try:
+                with log_context(range=r + 1):
+                    self.upload_range(workers[r], placeholders[r], ranges[r], start)
+            except Exception as e:
+                logger.exception(f"Range {r + 1} of {module} failed")
+                errors[r] = e
+
+        threads = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(work, r),
+                name=f"range-{r + 1}",
+                daemon=True,
+            )
+            for r in range(len(ranges))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        failed = [error for error in errors if error is not None]
+        if failed:
+            # placeholders are left, so that the lesson can be inspected
+            raise failed[0]
+
+        deferred = [jump for worker in workers for jump in worker.deferred_jumps]
+        self.set_jumps(deferred)
+        self.remove_placeholders(placeholders)
+        self.check_order([page_id for worker in workers for page_id in worker.slide_page_ids])
+
+    def range_module(self, session) -> Module:
+        """Module of this lesson driven by another session"""
+        module = Module(session.driver, self.module.name, config=self.module.config)
+        module.dom_id = self.module.dom_id
+        return module
+
+    def add_placeholders(self, count: int) -> List[int]:
+        """Add a placeholder page per range after the last page, in order"""
+        placeholders = []
+        for _ in range(count):
+            self.module.add_end_group()
+            placeholders.append(self.module.last_page_id)
+        logger.debug(f"Placeholder pages: {placeholders}")
+        return placeholders
+
+    @staticmethod
+    def upload_range(module: Module, placeholder: int, steps: List[SlideStep], start: int):
+        # pages of other sessions are read too, but only ours follow our pages
+        module.open_lesson()
+        module.last_page_id = placeholder
+        module.deferred_jumps = []
+        module.upload_steps(steps, start=start)
+        logger.info(f"Range done, {len(module.deferred_jumps)} jumps deferred")
+
+    def set_jumps(self, deferred: list):
+        """Set jumps deferred while ranges were uploaded, a page at a time"""
+        module = self.module
+        module.deferred_jumps = None
+
+        pages = {}
+        for page_id, select_id, text in deferred:
+            pages.setdefault(page_id, []).append((select_id, text))
+
+        for page_id, jumps in pages.items():
+            module.driver.get(
+                get_lesson_url(
+                    "editpage.php", module.config, id=module.module_id, pageid=page_id, edit=1
+                )
+            )
+            time.sleep(1)
+
+            for select_id, text in jumps:
+                Select(module.driver.find_element_by_id(select_id)).select_by_visible_text(text)
+                time.sleep(1)
+
+            module.driver.find_element_by_id("id_submitbutton").click()
+            time.sleep(1)
+        logger.info(f"Set {len(deferred)} jumps across ranges, on {len(pages)} pages")
+
+    def remove_placeholders(self, placeholders: List[int]):
+        driver = self.module.driver
+        sesskey = driver.execute_script("return M.cfg.sesskey;")
+        urls = [
+            get_lesson_url(
+                "lesson.php",
+                self.module.config,
+                id=self.module.module_id,
+                action="delete",
+                pageid=page_id,
+                sesskey=sesskey,
+            )
+            for page_id in placeholders
+        ]
+        driver.set_script_timeout(SCRIPT_TIMEOUT_S)
+        results = driver.execute_async_script(FETCH_ALL_SCRIPT, urls, True)
+        if not all(results):
+            logger.warning(f"Some placeholder pages of {self.module} not deleted: {placeholders}")
+
+    def check_order(self, slide_page_ids: List[int]):
+        """Check that slides of every range are in the lesson, in order"""
+        listing = get_lesson_url(
+            "edit.php", self.module.config, id=self.module.module_id, mode="collapsed"
+        )
+        self.module.driver.get(listing)
+        time.sleep(1)
+
+        position = {page_id: i for i, page_id in enumerate(self.module.page_ids())}
+        positions = [position.get(page_id) for page_id in slide_page_ids]
+        if None in positions or positions != sorted(positions):
+            msg = f"Slides of {self.module} are not in order after parallel upload!"
+            logger.error(msg)
+            raise RuntimeError(msg)
+        logger.info(f"{self.module} populated, {len(slide_page_ids)} slides in order")
@@ -0,0 +1,178 @@
+"""Preparation of uploads ahead of the browser.
+
+Work that does not need the browser (resolving jumps and titles, staging
+slide files) runs in stage threads connected by bounded queues, so that it
+is done while the browser is busy with previous slides. The browser stage is
+the consumer, iterating the pipeline on the calling thread; queue depths are
+available from `Pipeline.depths` and in the queue_depth metric: a queue
+always empty in front of the browser means the browser is waiting."""
+import base64
+import io
+import logging
+import os
+import pathlib
+import queue
+import threading
+import zipfile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+from moodle.metrics import REGISTRY, Gauge
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = REGISTRY.register(Gauge("queue_depth", "Items waiting in pipeline queues"))
+
+# end of items in a queue
+_DONE = object()
+
+
+class _Failure:
+    """Exception raised by a stage, forwarded to the consumer"""
+
+    def __init__(self, stage: str, error: BaseException):
+        self.stage = stage
+        self.error = error
+
+
+class StagedFile:
+    """A file ready to be uploaded. For a remote browser it is already
+    zipped and encoded as the WebDriver upload command wants it"""
+
+    __slots__ = ("path", "payload")
+
+    def __init__(self, path: pathlib.Path, payload: Optional[str] = None):
+        self.path = path
+        self.payload = payload
+
+    def __repr__(self):
+        return f"StagedFile({self.path}, remote={self.payload is not None})"
+
+
+def stage_file(path: Union[str, os.PathLike], remote: bool = False) -> StagedFile:
+    path = pathlib.Path(path).resolve()
+    if not path.is_file():
+        msg = f"Cannot stage {path}, file not found!"
+        logger.error(msg)
+        raise FileNotFoundError(msg)
+
+    if not remote:
+        return StagedFile(path)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zipped:
+        zipped.write(path, path.name)
+    return StagedFile(path, base64.encodebytes(buffer.getvalue()).decode("ascii"))
+
+
+class Pipeline:
+    """Items from a source go through stage functions, each in its own
+    thread, and come out in order when iterating the pipeline"""
+
+    def __init__(
+        self,
+        source: Iterable,
+        stages: Dict[str, Callable],
+        maxsize: int = 4,
+    ):
+        if maxsize <= 0:
+            msg = "Pipeline queues must be bounded!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.names: List[str] = list(stages)
+        # queue in front of each stage, and the last one in front of consumer
+        self.queues: List[queue.Queue] = [
+            queue.Queue(maxsize) for _ in range(len(stages) + 1)
+        ]
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(iter(source), self.queues[0]),
+                name="pipeline-source",
+                daemon=True,
+            )
+        ]
+        for i, (name, func) in enumerate(stages.items()):
+            thread = threading.Thread(
+                target=self._work,
+                args=(name, func, self.queues[i], self.queues[i + 1]),
+                name=f"pipeline-{name}",
+                daemon=True,
+            )
+            self._threads.append(thread)
+
+    def depths(self) -> Dict[str, int]:
+        """Items waiting in front of every stage, and of the consumer"""
+        names = self.names + ["browser"]
+        return {name: q.qsize() for name, q in zip(names, self.queues)}
+
+    def __iter__(self) -> Iterator:
+        for thread in self._threads:
+            thread.start()
+
+        output = self.queues[-1]
+        try:
+            while True:
+                self._update_metric()
+                item = output.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    logger.error(f"Pipeline stage {item.stage} failed")
+                    raise item.error
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop stage threads, e.g. when the consumer fails"""
+        self._stop.set()
+        for q in self.queues:
+            # unblock producers waiting on a full queue
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+        self._update_metric()
+
+    def _update_metric(self):
+        for name, depth in self.depths().items():
+            QUEUE_DEPTH.set(depth, stage=name)
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, source: Iterator, output: queue.Queue):
+        try:
+            for item in source:
+                if not self._put(output, item):
+                    return
+        except Exception as e:
+            self._put(output, _Failure("source", e))
+            return
+        self._put(output, _DONE)
+
+    def _work(self, name: str, func: Callable, input: queue.Queue, output: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                item = input.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE or isinstance(item, _Failure):
+                self._put(output, item)
+                return
+            try:
+                result = func(item)
+            except Exception as e:
+                self._put(output, _Failure(name, e))
+                return
+            if not self._put(output, result):
+                return
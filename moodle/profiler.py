@@ -0,0 +1,183 @@
+"""Sampling profiler of the Python side of a run.
+
+A thread samples the stacks of every other thread at a fixed interval, so
+that the overhead does not depend on how many calls are made (as it does for
+a deterministic profiler). Every sample is classified by where its thread is:
+
+- webdriver: blocked on a WebDriver command (socket reads, the cdp engine
+  loop, or the fake browser of `engine = fake` standing for them)
+- sleep: in `time.sleep`, the waits of model code (wrapped while profiling,
+  a builtin has no frame of its own)
+- wait: idle on a lock, queue or event (e.g. pipeline and exporter threads)
+- cpu: running Python code
+
+Stacks are written in the collapsed format of flamegraph.pl (and speedscope),
+with the category as root frame, and summarized by the most expensive
+functions. Threads idle for the whole run (e.g. a daemon waiting for jobs)
+are left out of the percentages."""
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Counter, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ("cpu", "webdriver", "sleep", "wait")
+
+# leaf files where a thread is blocked on the network
+BLOCKING_FILES = ("socket.py", "ssl.py", "selectors.py", "client.py", "connection.py")
+
+# leaf files where a thread is waiting for another one
+WAITING_FILES = ("threading.py", "queue.py", "_base.py", "socketserver.py")
+
+# files issuing WebDriver commands
+WEBDRIVER_FILES = (
+    os.path.join("selenium", "webdriver", "remote", "remote_connection.py"),
+    os.path.join("moodle", "cdp.py"),
+)
+
+# the fake browser, standing for the real one and the network
+FAKE_BROWSER_FILE = os.path.join("moodle", "fake.py")
+
+Stack = Tuple[str, ...]
+
+_time_sleep = time.sleep
+
+
+def sleeping(seconds: float):
+    """`time.sleep` while profiling: the frame of the call tells a sleep apart"""
+    _time_sleep(seconds)
+
+
+def frame_label(code) -> str:
+    path = code.co_filename.split(os.sep)
+    return f"{code.co_name} ({os.sep.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def classify(frame) -> str:
+    """Category of a thread from its innermost frame"""
+    leaf = frame
+    filenames = []
+    while frame is not None:
+        filenames.append(frame.f_code.co_filename)
+        frame = frame.f_back
+
+    if any(name.endswith(FAKE_BROWSER_FILE) for name in filenames):
+        return "webdriver"
+
+    in_webdriver = any(name.endswith(WEBDRIVER_FILES) for name in filenames)
+
+    leaf_file = leaf.f_code.co_filename
+    if leaf_file.endswith(BLOCKING_FILES) and in_webdriver:
+        return "webdriver"
+    if leaf_file.endswith(WAITING_FILES):
+        return "webdriver" if in_webdriver else "wait"
+    if leaf.f_code is sleeping.__code__:
+        return "sleep"
+    return "cpu"
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        if interval <= 0:
+            msg = "Sampling interval must be positive!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.interval = interval
+        self.stacks: Counter[Stack] = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._started = (0.0, 0.0)
+        self._sleep = time.sleep
+        # wall and cpu seconds of the process while profiling
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._started = (time.perf_counter(), time.process_time())
+        self._sleep, time.sleep = time.sleep, sleeping
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        time.sleep = self._sleep
+        self.wall = time.perf_counter() - self._started[0]
+        self.cpu = time.process_time() - self._started[1]
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                category = classify(frame)
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                thread = names.get(ident, str(ident))
+                self.stacks[(category, thread) + tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def write_collapsed(self, path: str):
+        """Write stacks as `frame;frame;frame count` lines, for flamegraph.pl"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def working_threads(self) -> Set[str]:
+        """Threads with a sample out of "wait", the ones doing the run"""
+        return {stack[1] for stack in self.stacks if stack[0] != "wait"}
+
+    def by_category(self, threads: Optional[Set[str]] = None) -> Dict[str, int]:
+        counts = dict.fromkeys(CATEGORIES, 0)
+        for stack, count in self.stacks.items():
+            if threads is None or stack[1] in threads:
+                counts[stack[0]] += count
+        return counts
+
+    def summary(self, top: int = 25) -> str:
+        threads = self.working_threads()
+        counts = self.by_category(threads)
+        working = sum(counts.values())
+        total = working or 1
+        lines = [
+            f"{self.samples} samples every {self.interval * 1000:.0f}ms,"
+            f" {self.wall:.1f}s wall, {self.cpu:.1f}s process cpu",
+            f"{working} samples of {len(threads)} working threads"
+            f" ({', '.join(sorted(threads))}):",
+        ]
+        lines += [f"    {category}: {count / total:.1%}" for category, count in counts.items()]
+
+        # cpu samples only: self time is the innermost frame, cumulative
+        # time every frame (once per sample, for recursive calls)
+        own: Counter[str] = collections.Counter()
+        cumulative: Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            if stack[0] != "cpu":
+                continue
+            own[stack[-1]] += count
+            for label in set(stack[2:]):
+                cumulative[label] += count
+
+        lines.append("Top functions by own cpu samples:")
+        lines += [f"    {count / total:6.1%}  {label}" for label, count in own.most_common(top)]
+        lines.append("Top functions by cumulative cpu samples:")
+        lines += [
+            f"    {count / total:6.1%}  {label}" for label, count in cumulative.most_common(top)
+        ]
+        return "\n".join(lines)
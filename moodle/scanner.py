@@ -0,0 +1,330 @@
+"""Discovery and indexing of data trees.
+
+Directories are listed with os.scandir and the result is kept in a manifest
+file at the root of the tree (paths, sizes, mtimes, slide indexes and cluster
+json of every directory). On later runs only directories whose mtime changed
+are listed again. Files are told apart by size and mtime; they're hashed
+only when verifying (see Manifest.scan), and only if their size or mtime
+changed."""
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import threading
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".moodle_manifest.json"
+MANIFEST_VERSION = 1
+
+# file inside module directory with fingerprints of uploaded slides
+STATE_FILENAME = ".moodle_sync.json"
+
+# files written by this tool inside the data tree, and their temporary copies
+STATE_FILES = frozenset(
+    name
+    for filename in (MANIFEST_FILENAME, STATE_FILENAME)
+    for name in (filename, str(pathlib.Path(filename).with_suffix(".tmp")))
+)
+
+# slide files are named <base_name><index>.<ext>
+SLIDE_PATTERN = re.compile(r"[^\d]*(\d+)", re.I)
+
+
+def file_hash(path: Union[str, os.PathLike]) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def slide_index(name: str) -> Optional[int]:
+    """Index of a slide file from its name, None if it's not a slide"""
+    if name.endswith(".json"):
+        return None
+    match = SLIDE_PATTERN.match(name)
+    return int(match.group(1)) if match else None
+
+
+def is_ignored(name: str) -> bool:
+    """True for files that are not data: state kept by this tool (e.g. the
+    manifest itself, or fingerprints of sync) and other hidden files"""
+    return name in STATE_FILES or name.startswith(".")
+
+
+def find_json(directory: Union[str, os.PathLike]) -> List[pathlib.Path]:
+    """Cluster json files inside a directory"""
+    with os.scandir(directory) as it:
+        return sorted(
+            pathlib.Path(elem.path)
+            for elem in it
+            if elem.name.endswith(".json") and not is_ignored(elem.name)
+        )
+
+
+class SyncState:
+    """Fingerprints of the slides uploaded to a lesson, by page title, kept
+    in the module directory: sync updates only slides changed since"""
+
+    # sessions populating ranges of a lesson record into the same file
+    lock = threading.Lock()
+
+    def __init__(self, directory: Union[str, os.PathLike]):
+        self.path = pathlib.Path(directory) / STATE_FILENAME
+        self.recorded: Dict[str, str] = {}
+
+    def load(self) -> Dict[str, str]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot read {self.path}, slides taken as changed: {e}")
+            return {}
+
+    def record(self, title: str, slide: Union[str, os.PathLike]):
+        self.recorded[title] = file_hash(slide)
+
+    def save(self, replace: bool = False):
+        """Write fingerprints recorded, merged with the ones in file unless
+        `replace` is set"""
+        with self.lock:
+            state = {} if replace else self.load()
+            state.update(self.recorded)
+            try:
+                tmp = self.path.with_suffix(".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(state, f, indent=2)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                # e.g. read-only data tree, next sync updates these slides again
+                logger.warning(f"Cannot write {self.path}: {e}")
+
+
+class FileEntry:
+    __slots__ = ("name", "size", "mtime", "sha1", "index")
+
+    def __init__(self, name: str, size: int, mtime: float, sha1: str = None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.sha1 = sha1
+        self.index = slide_index(name)
+
+    def to_json(self) -> list:
+        return [self.name, self.size, self.mtime, self.sha1]
+
+    def __repr__(self):
+        return f"FileEntry({self.name})"
+
+
+class DirectoryEntry:
+    def __init__(self, path: pathlib.Path, mtime: float):
+        self.path = path
+        self.mtime = mtime
+        self.files: Dict[str, FileEntry] = {}
+        self.subdirs: List[str] = []
+
+    @property
+    def slides(self) -> List[FileEntry]:
+        """Slide files, sorted by index"""
+        slides = [entry for entry in self.files.values() if entry.index is not None]
+        return sorted(slides, key=lambda entry: entry.index)
+
+    @property
+    def json_files(self) -> List[pathlib.Path]:
+        return sorted(
+            self.path / name
+            for name in self.files
+            if name.endswith(".json") and not is_ignored(name)
+        )
+
+    @property
+    def json(self) -> Optional[pathlib.Path]:
+        json_files = self.json_files
+        return json_files[0] if len(json_files) == 1 else None
+
+    @property
+    def is_module(self) -> bool:
+        return any(entry.index is not None for entry in self.files.values())
+
+    def problems(self, load_only_slide: bool = False) -> List[str]:
+        """Return what would prevent this module from being uploaded"""
+        problems = []
+        if not load_only_slide and len(self.json_files) != 1:
+            problems.append(f"expected one json, found {len(self.json_files)}")
+
+        indexes = [entry.index for entry in self.slides]
+        duplicates = sorted({index for index in indexes if indexes.count(index) > 1})
+        if duplicates:
+            problems.append(f"duplicated slide indexes {duplicates}")
+        return problems
+
+    def same_contents(self, other: "DirectoryEntry") -> bool:
+        if self.subdirs != other.subdirs or self.files.keys() != other.files.keys():
+            return False
+        return all(entry is other.files[name] for name, entry in self.files.items())
+
+    def to_json(self) -> dict:
+        return dict(
+            mtime=self.mtime,
+            subdirs=self.subdirs,
+            files=[entry.to_json() for entry in self.files.values()],
+        )
+
+    def __repr__(self):
+        return f"DirectoryEntry({self.path}, files={len(self.files)})"
+
+
+class Manifest:
+    """Persistent index of a data tree"""
+
+    def __init__(self, root: Union[str, os.PathLike], hashes: bool = False):
+        # hash every file listed, not only the ones verified
+        self.root = pathlib.Path(root)
+        self.hashes = hashes
+        self.directories: Dict[pathlib.Path, DirectoryEntry] = {}
+        self.load()
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self.root / MANIFEST_FILENAME
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                json_dict = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if json_dict.get("version") != MANIFEST_VERSION:
+            return
+
+        for relpath, obj in json_dict["directories"].items():
+            directory = DirectoryEntry(self.root / relpath, obj["mtime"])
+            directory.subdirs = obj["subdirs"]
+            for name, size, mtime, sha1 in obj["files"]:
+                directory.files[name] = FileEntry(name, size, mtime, sha1)
+            self.directories[directory.path] = directory
+
+    def save(self):
+        directories = {
+            str(path.relative_to(self.root)): directory.to_json()
+            for path, directory in self.directories.items()
+        }
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(dict(version=MANIFEST_VERSION, directories=directories), f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # e.g. read-only data tree, listed again by next run
+            logger.warning(f"Cannot write manifest {self.path}: {e}")
+            return
+
+        # writing the manifest changed root mtime, don't list it again next time
+        if self.root in self.directories:
+            self.directories[self.root].mtime = os.stat(self.root).st_mtime
+
+    def scan(self, verify: bool = False) -> List[DirectoryEntry]:
+        """Update the manifest and return directories that changed.
+
+        Directories whose mtime is unchanged are not listed again, unless
+        `verify` is set: files modified in place don't change their
+        directory mtime, so every known file is then stat-ed too, and the
+        ones whose size or mtime changed are hashed, not to take a file
+        touched (or written again as it was) as changed."""
+        changed = []
+        listed = False
+        seen = set()
+        stack = [self.root]
+
+        while stack:
+            path = stack.pop()
+            seen.add(path)
+            mtime = os.stat(path).st_mtime
+            directory = self.directories.get(path)
+
+            if directory is None or directory.mtime != mtime:
+                old, directory = directory, self._scan_directory(path, mtime, directory, verify)
+                listed = True
+                # hidden files (e.g. sync state) change mtime but not contents
+                if old is None or not directory.same_contents(old):
+                    changed.append(directory)
+            elif verify and self._verify_directory(directory):
+                changed.append(directory)
+
+            self.directories[path] = directory
+            stack += [path / name for name in directory.subdirs]
+
+        removed = set(self.directories) - seen
+        for path in removed:
+            del self.directories[path]
+
+        if changed:
+            logger.info(f"Scanned {len(changed)} changed dirs inside {self.root}")
+        if listed or removed or changed:
+            self.save()
+        return changed
+
+    def _entry(
+        self, path: pathlib.Path, stat: os.stat_result, old: FileEntry = None, verify=False
+    ) -> FileEntry:
+        if old is not None and (old.size, old.mtime) == (stat.st_size, stat.st_mtime):
+            return old
+        sha1 = file_hash(path) if self.hashes or verify else None
+        if old is not None and sha1 is not None and sha1 == old.sha1:
+            # same contents, only touched
+            old.mtime = stat.st_mtime
+            return old
+        return FileEntry(path.name, stat.st_size, stat.st_mtime, sha1)
+
+    def _scan_directory(self, path, mtime, old: DirectoryEntry = None, verify=False):
+        directory = DirectoryEntry(path, mtime)
+        old_files = old.files if old else {}
+
+        with os.scandir(path) as it:
+            for elem in it:
+                if is_ignored(elem.name):
+                    continue
+                if elem.is_dir():
+                    directory.subdirs.append(elem.name)
+                elif elem.is_file():
+                    entry = self._entry(
+                        pathlib.Path(elem.path), elem.stat(), old_files.get(elem.name), verify
+                    )
+                    directory.files[elem.name] = entry
+
+        directory.subdirs.sort()
+        return directory
+
+    def _verify_directory(self, directory: DirectoryEntry) -> bool:
+        modified = False
+        for name, old in list(directory.files.items()):
+            path = directory.path / name
+            try:
+                entry = self._entry(path, path.stat(), old, verify=True)
+            except FileNotFoundError:
+                # removed after last scan, next one will list directory again
+                continue
+            if entry is not old:
+                directory.files[name] = entry
+                modified = True
+        return modified
+
+    def __getitem__(self, path: Union[str, os.PathLike]) -> DirectoryEntry:
+        return self.directories[pathlib.Path(path)]
+
+    def children(self, path: Union[str, os.PathLike]) -> List[DirectoryEntry]:
+        directory = self[path]
+        return [self.directories[directory.path / name] for name in directory.subdirs]
+
+    def modules(self) -> List[DirectoryEntry]:
+        """Module directories, sorted by path"""
+        modules = [entry for entry in self.directories.values() if entry.is_module]
+        return sorted(modules, key=lambda entry: entry.path)
@@ -0,0 +1,156 @@
+"""Sections and activities of a course, read with a single script.
+
+Locating a section or a module element by element costs a WebDriver round
+trip for every lookup and attribute, growing with the size of the course.
+The course page is instead read once, in one script call, and the snapshot
+is then kept updated with sections and modules created by the Automator."""
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+READ_COURSE_SCRIPT = """
+var sections = [];
+document.querySelectorAll(arguments[0]).forEach(function (li) {
+    var head = li.querySelector("div.content > h3");
+    var activities = [];
+    li.querySelectorAll(arguments[1]).forEach(function (activity) {
+        var instance = activity.querySelector(".instancename");
+        activities.push({
+            dom_id: activity.id,
+            name: instance && instance.firstChild ? instance.firstChild.textContent.trim() : "",
+        });
+    });
+    var edit = li.querySelector("a[href*='editsection.php?id=']");
+    sections.push({
+        dom_id: li.id,
+        name: head ? head.innerText.trim() : "",
+        section_id: edit ? parseInt(new URL(edit.href).searchParams.get("id")) : null,
+        activities: activities,
+    });
+});
+return sections;
+"""
+
+# last element matching a selector inside an (optional) container, with its id
+LAST_ELEMENT_SCRIPT = """
+var container = arguments[1] ? document.getElementById(arguments[1]) : document;
+var elements = container.querySelectorAll(arguments[0]);
+var last = elements[elements.length - 1];
+return last ? [last.id, last] : null;
+"""
+
+SECTION_SELECTOR = "li.section"
+ACTIVITY_SELECTOR = "li.activity"
+
+
+def module_id_of(dom_id: str) -> Optional[int]:
+    """Module id from a dom id like module-123"""
+    prefix, _, number = dom_id.rpartition("-")
+    return int(number) if prefix == "module" and number.isdigit() else None
+
+
+class ActivityInfo:
+    __slots__ = ("dom_id", "name", "section")
+
+    def __init__(self, dom_id: str, name: str, section: "SectionInfo"):
+        self.dom_id = dom_id
+        self.name = name
+        self.section = section
+
+    @property
+    def module_id(self) -> Optional[int]:
+        return module_id_of(self.dom_id)
+
+    def __repr__(self):
+        return f"ActivityInfo(dom_id={self.dom_id}, name={self.name})"
+
+
+class SectionInfo:
+    __slots__ = ("dom_id", "name", "section_id", "activities")
+
+    def __init__(self, dom_id: str, name: str, section_id: int = None):
+        self.dom_id = dom_id
+        self.name = name
+        # id in database (dom id has the section number, changing on deletes)
+        self.section_id = section_id
+        self.activities: List[ActivityInfo] = []
+
+    def __repr__(self):
+        return f"SectionInfo(dom_id={self.dom_id}, name={self.name})"
+
+
+class CourseStructure:
+    """Snapshot of sections and activities of a course page, in page order"""
+
+    def __init__(self, sections: List[dict] = ()):
+        self.sections: List[SectionInfo] = []
+        self._sections: Dict[str, SectionInfo] = {}
+        self._activities: Dict[str, ActivityInfo] = {}
+
+        for obj in sections:
+            section = self.add_section(obj["dom_id"], obj["name"], obj.get("section_id"))
+            for activity in obj["activities"]:
+                self.add_activity(section.dom_id, activity["dom_id"], activity["name"])
+
+    @classmethod
+    def read(cls, driver) -> "CourseStructure":
+        """Read the course page currently loaded"""
+        sections = driver.execute_script(
+            READ_COURSE_SCRIPT, SECTION_SELECTOR, ACTIVITY_SELECTOR
+        )
+        structure = cls(sections or [])
+        logger.debug(
+            f"Read course structure: {len(structure.sections)} sections,"
+            f" {len(structure._activities)} activities"
+        )
+        return structure
+
+    @property
+    def last_section(self) -> Optional[SectionInfo]:
+        return self.sections[-1] if self.sections else None
+
+    def section(self, dom_id: str) -> Optional[SectionInfo]:
+        return self._sections.get(dom_id)
+
+    def activity(self, module_id: int) -> Optional[ActivityInfo]:
+        return self._activities.get(f"module-{module_id}")
+
+    def find_activity(self, name: str) -> Optional[ActivityInfo]:
+        """First activity with a name, in page order"""
+        for section in self.sections:
+            for activity in section.activities:
+                if activity.name == name:
+                    return activity
+        return None
+
+    def add_section(self, dom_id: str, name: str, section_id: int = None) -> SectionInfo:
+        """Index a section, appended as the last one"""
+        section = self._sections.get(dom_id)
+        if section is None:
+            section = self._sections[dom_id] = SectionInfo(dom_id, name, section_id)
+            self.sections.append(section)
+        section.name = name
+        section.section_id = section_id or section.section_id
+        return section
+
+    def add_activity(self, section_dom_id: str, dom_id: str, name: str) -> ActivityInfo:
+        """Index an activity, appended as the last one of its section"""
+        section = self._sections[section_dom_id]
+        activity = self._activities.get(dom_id)
+        if activity is None:
+            activity = self._activities[dom_id] = ActivityInfo(dom_id, name, section)
+            section.activities.append(activity)
+        activity.name = name
+        return activity
+
+
+def last_element(driver, selector: str, container_dom_id: str = None):
+    """Return dom id and WebElement of the last element matching a selector,
+    with one round trip however many there are"""
+    result = driver.execute_script(LAST_ELEMENT_SCRIPT, selector, container_dom_id)
+    if not result:
+        msg = f"No element found matching '{selector}'!"
+        logger.error(msg)
+        raise ValueError(msg)
+    return result[0], result[1]
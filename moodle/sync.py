@@ -0,0 +1,421 @@
+"""Incremental synchronisation of a lesson with its module directory.
+
+The live lesson is read with a single request (the expanded edit view, which
+renders every page with its contents and jumps) and compared with the pages
+populate would create from the slides and the cluster json found locally:
+titles, images, buttons and their jumps, and fingerprints of slide files
+recorded when they were uploaded (see SyncState). Only pages missing, changed
+or no longer present locally are created, updated or deleted."""
+import logging
+import os
+import pathlib
+import re
+import time
+from typing import Dict, List, Optional, Union
+
+from moodle.cluster import ModuleCluster, Question
+from moodle.driver import ManagedDriver
+from moodle.logs import log_context
+from moodle.model import (
+    END_GROUP_TITLE,
+    JUMP_NEXT_PAGE,
+    JUMP_PREVIOUS_PAGE,
+    JUMP_RANDOM_CONTENT,
+    QTYPE_BRANCHTABLE,
+    QTYPE_ENDOFCLUSTER,
+    QTYPE_MULTICHOICE,
+    JumpTo,
+    Module,
+    Slide,
+)
+from moodle.scanner import SyncState, file_hash, find_json
+from moodle.utility import default_config, get_lesson_url
+
+logger = logging.getLogger(__name__)
+
+# names of relative jumps shown by the edit view, as in the jump select
+JUMP_NAMES = {
+    JUMP_NEXT_PAGE: ("Pagina successiva", "Next page"),
+    JUMP_PREVIOUS_PAGE: ("Pagina precedente", "Previous page"),
+    JUMP_RANDOM_CONTENT: ("Pagina casuale con contenuto", "Random content page"),
+}
+
+READ_LESSON_SCRIPT = """
+var pages = [];
+document.querySelectorAll("table.generaltable").forEach(function (table) {
+    var link = table.querySelector("a[href*='editpage.php'][href*='pageid=']");
+    if (!link) {
+        return;
+    }
+    var head = table.querySelector("th");
+    pages.push({
+        id: parseInt(new URL(link.href).searchParams.get("pageid")),
+        title: head ? head.innerText.trim() : "",
+        text: table.innerText,
+        cells: Array.from(table.querySelectorAll("td")).map(function (cell) {
+            return cell.innerText;
+        }),
+        images: Array.from(table.querySelectorAll("img[src*='pluginfile.php']")).map(
+            function (img) {
+                return decodeURIComponent(img.src.split("?")[0].split("/").pop());
+            }
+        ),
+    });
+});
+return pages;
+"""
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+class RemotePage:
+    """Page of a lesson, as found on Moodle"""
+
+    def __init__(self, json_dict: dict):
+        self.id: int = json_dict["id"]
+        self.title: str = json_dict["title"]
+        self.text: str = normalize(json_dict["text"])
+        self.images: List[str] = json_dict["images"]
+        # cells of contents, answers and jumps
+        self.cells = {normalize(cell) for cell in json_dict.get("cells", ())}
+
+    def shows_jump(self, jump: JumpTo) -> bool:
+        names = JUMP_NAMES[jump] if isinstance(jump, int) else (jump,)
+        return any(name in self.cells for name in names)
+
+    def __repr__(self):
+        return f"RemotePage(id={self.id}, title={self.title})"
+
+
+class LocalPage:
+    """Page of a lesson, as expected from the module directory"""
+
+    kind: str
+    title: str
+    # page that must precede this one, None for the first page
+    anchor: Optional["LocalPage"] = None
+    # id on Moodle, once matched or created
+    page_id: Optional[int] = None
+
+    def matches(self, page: RemotePage, state: dict) -> bool:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}(title={self.title})"
+
+
+class SlidePage(LocalPage):
+    kind = "slide"
+
+    def __init__(self, slide: Slide, title: str, buttons: list, first: bool = False, **kwargs):
+        self.slide = slide
+        self.title = title
+        # (label, jump) of every button, see Module.slide_buttons
+        self.buttons = buttons
+        self.first = first
+        self.kwargs = kwargs
+
+    def matches(self, page: RemotePage, state: dict) -> bool:
+        if self.slide.name not in page.images:
+            return False
+        for label, jump in self.buttons:
+            if label not in page.cells or not page.shows_jump(jump):
+                logger.debug(f"Button '{label}' of {page} differs")
+                return False
+
+        # same file name, so check if its content changed since uploaded
+        known = state.get(self.title)
+        if known is None:
+            logger.debug(f"No fingerprint of {self.slide.name}, taken as changed")
+            return False
+        return known == file_hash(self.slide.path)
+
+
+class QuestionPage(LocalPage):
+    kind = "question"
+
+    def __init__(self, question: Question, jump2correct: str, prefix: str):
+        self.question = question
+        self.title = f"Domanda {question.number}"
+        self.jump2correct = jump2correct
+        self.prefix = prefix
+
+    def matches(self, page: RemotePage, state: dict) -> bool:
+        expected = [self.question.name] + [answer.text for answer in self.question.answers]
+        if not all(normalize(text) in page.text for text in expected):
+            return False
+
+        jumps = [self.jump2correct]
+        if any(not answer.is_correct for answer in self.question.answers):
+            jumps.append(f"{self.prefix}{self.question.jump2slide}")
+        return all(page.shows_jump(jump) for jump in jumps)
+
+
+class EndGroupPage(LocalPage):
+    """End of cluster page, after the questions of a cluster"""
+
+    kind = "end_group"
+    title = END_GROUP_TITLE
+
+    def matches(self, page: RemotePage, state: dict) -> bool:
+        return True
+
+
+class SyncPlan:
+    """Operations needed to bring a lesson in line with local files"""
+
+    def __init__(self, pages: List[LocalPage] = None):
+        # every page expected in lesson, in order
+        self.pages = pages or []
+        self.creates: List[LocalPage] = []
+        self.updates: List[tuple] = []
+        self.deletes: List[RemotePage] = []
+
+    def __bool__(self):
+        return bool(self.creates or self.updates or self.deletes)
+
+    def __repr__(self):
+        return (
+            f"SyncPlan(creates={len(self.creates)}, updates={len(self.updates)},"
+            f" deletes={len(self.deletes)})"
+        )
+
+
+def read_lesson(driver, module_id: int, config: dict = None) -> List[RemotePage]:
+    """Read every page of a lesson with one request to its expanded edit view"""
+    driver.get(get_lesson_url("edit.php", config, id=module_id, mode="full"))
+    pages = [RemotePage(obj) for obj in driver.execute_script(READ_LESSON_SCRIPT)]
+    logger.debug(f"Read {len(pages)} pages from lesson {module_id}")
+    return pages
+
+
+def local_pages(
+    directory: Union[str, os.PathLike],
+    module: Module,
+    load_only_slide: bool = False,
+) -> List[LocalPage]:
+    """Return the pages expected in lesson from a module directory, in the
+    order populate adds them (see Module.upload_steps): questions of a
+    cluster after its max slide, its end of cluster after the next slide"""
+    directory = pathlib.Path(directory)
+    prefix = module.config["file_parameters"]["base_name_in_course"]
+
+    module_cluster: Optional[ModuleCluster] = None
+    if not load_only_slide:
+        json_fp = find_json(directory)
+        assert len(json_fp) == 1, "Expected exactly one json inside module directory!"
+        module_cluster = ModuleCluster(json_fp[0])
+
+    slides = Slide.find_all(directory)
+    clusters = module_cluster.clusters if module_cluster else []
+    max_slides = module_cluster.max_slides if module_cluster else frozenset()
+
+    pages: List[LocalPage] = []
+    for step in module.plan_steps(slides, clusters, max_slides):
+        first = step.i == 0
+        buttons = module.slide_buttons(first, **step.kwargs)
+        title = module.name_in_course(step.slide.path)
+        slide_page = SlidePage(step.slide, title, buttons, first=first, **step.kwargs)
+
+        cluster = step.cluster
+        if cluster is None:
+            pages.append(slide_page)
+            continue
+
+        jump2correct = module.correct_jump(cluster, step.is_last_slide, step.slide.index)
+        questions = [QuestionPage(q, jump2correct, prefix) for q in cluster.questions]
+        if step.is_last_slide and step.slide.index <= cluster.max_slide_in_cluster:
+            pages += [slide_page] + questions
+        else:
+            # questions follow the previous slide, the max one of cluster
+            pages += questions + [slide_page]
+        pages.append(EndGroupPage())
+
+    for previous, page in zip(pages, pages[1:]):
+        page.anchor = previous
+    return pages
+
+
+def is_managed(title: str, config: dict = None) -> bool:
+    """True if a remote page was created by this tool (slide, question or
+    end of cluster), so that other pages are never deleted"""
+    config = config or default_config()
+    prefix = re.escape(config["file_parameters"]["base_name_in_course"])
+    end_group = re.escape(END_GROUP_TITLE)
+    return bool(re.fullmatch(rf"({prefix}|Domanda )\d+|{end_group}", title))
+
+
+def diff_lesson(
+    remote: List[RemotePage],
+    local: List[LocalPage],
+    state: dict,
+    config: dict = None,
+) -> SyncPlan:
+    plan = SyncPlan(local)
+
+    remote_by_title: Dict[str, List[RemotePage]] = {}
+    for page in remote:
+        remote_by_title.setdefault(page.title, []).append(page)
+
+    # page following every remote page
+    following = {a.id: b for a, b in zip(remote, remote[1:])}
+
+    for page in local:
+        candidates = remote_by_title.get(page.title, [])
+        if isinstance(page, EndGroupPage):
+            # all alike, so the one in lesson is right after the page before
+            if page.anchor is None:
+                after = remote[0] if remote else None
+            else:
+                after = following.get(page.anchor.page_id)
+            candidates = [after] if after in candidates else []
+        if not candidates:
+            plan.creates.append(page)
+            continue
+        remote_page = candidates[0]
+        remote_by_title[page.title].remove(remote_page)
+        page.page_id = remote_page.id
+        if not page.matches(remote_page, state):
+            plan.updates.append((page, remote_page))
+
+    # every remote page left is a duplicate or was removed locally
+    plan.deletes = [
+        page
+        for pages in remote_by_title.values()
+        for page in pages
+        if is_managed(page.title, config)
+    ]
+    return plan
+
+
+class LessonSync:
+    """Synchronise an existing Module with a local directory"""
+
+    def __init__(self, module: Module):
+        self.module = module
+        self.driver = module.driver
+        self.config = module.config
+
+    @property
+    def sesskey(self) -> str:
+        return self.driver.execute_script("return M.cfg.sesskey;")
+
+    @staticmethod
+    def save_state(directory: pathlib.Path, pages: List[LocalPage]):
+        """Record fingerprints of every slide, now all current in lesson"""
+        state = SyncState(directory)
+        for page in pages:
+            if isinstance(page, SlidePage):
+                state.record(page.title, page.slide.path)
+        state.save(replace=True)
+
+    def plan(self, directory: Union[str, os.PathLike], load_only_slide=False):
+        directory = pathlib.Path(directory)
+        remote = read_lesson(self.driver, self.module.module_id, self.config)
+        local = local_pages(directory, self.module, load_only_slide=load_only_slide)
+        return diff_lesson(remote, local, SyncState(directory).load(), self.config)
+
+    def run(self, directory: Union[str, os.PathLike], load_only_slide=False) -> SyncPlan:
+        with log_context(module=self.module.name):
+            return self._run(pathlib.Path(directory), load_only_slide)
+
+    def _run(self, directory: pathlib.Path, load_only_slide: bool) -> SyncPlan:
+        plan = self.plan(directory, load_only_slide=load_only_slide)
+        logger.info(f"Sync of {self.module}: {plan}")
+
+        if plan.deletes:
+            sesskey = self.sesskey
+            for page in plan.deletes:
+                self.delete_page(page, sesskey)
+                self.page_done()
+
+        if plan.updates or plan.creates:
+            # pages left and collapsed view, where submits land: ids of pages
+            # created are then read from it (see Module.new_page_id)
+            self.module.open_lesson()
+
+        for local_page, remote_page in plan.updates:
+            self.update_page(local_page, remote_page)
+            self.page_done()
+
+        for page in plan.creates:
+            self.create_page(page)
+            self.page_done()
+
+        self.save_state(directory, plan.pages)
+        logger.info("Sync completed")
+        return plan
+
+    def page_done(self):
+        # browser can be recycled only between pages
+        if isinstance(self.driver, ManagedDriver):
+            self.driver.page_done()
+
+    def delete_page(self, page: RemotePage, sesskey: str):
+        url = get_lesson_url(
+            "lesson.php",
+            self.config,
+            id=self.module.module_id,
+            action="delete",
+            pageid=page.id,
+            sesskey=sesskey,
+        )
+        self.driver.get(url)
+        time.sleep(1)
+        logger.info(f"Deleted page {page}")
+
+    def fill_and_submit(self, page: LocalPage):
+        if isinstance(page, SlidePage):
+            self.module.fill_slide(page.slide.path, first=page.first, **page.kwargs)
+        else:
+            self.module.fill_question(page.question, page.jump2correct)
+
+        self.driver.find_element_by_id("id_submitbutton").click()
+        time.sleep(1)
+
+    def update_page(self, local_page: LocalPage, remote_page: RemotePage):
+        url = get_lesson_url(
+            "editpage.php",
+            self.config,
+            id=self.module.module_id,
+            pageid=remote_page.id,
+            edit=1,
+        )
+        self.driver.get(url)
+        time.sleep(1)
+
+        self.module.clear_form()
+        self.fill_and_submit(local_page)
+        logger.info(f"Updated page {remote_page}")
+
+    def create_page(self, page: LocalPage):
+        """Add a page after its anchor, already in lesson as pages are
+        created in lesson order"""
+        anchor = None
+        if page.anchor is not None:
+            anchor = page.anchor.page_id
+            if anchor is None:
+                msg = f"Page before {page} not in lesson, cannot add it!"
+                logger.error(msg)
+                raise RuntimeError(msg)
+
+        if isinstance(page, EndGroupPage):
+            # added without a form, as populate does
+            url = get_lesson_url(
+                "editpage.php",
+                self.config,
+                id=self.module.module_id,
+                pageid=anchor or 0,
+                qtype=QTYPE_ENDOFCLUSTER,
+            )
+            page.page_id = self.module.new_page_id(anchor, request=url)
+        else:
+            qtype = QTYPE_BRANCHTABLE if isinstance(page, SlidePage) else QTYPE_MULTICHOICE
+            self.module.open_new_page(anchor, qtype)
+            time.sleep(1)
+
+            self.fill_and_submit(page)
+            page.page_id = self.module.new_page_id(anchor)
+        logger.info(f"Created page {page}")
@@ -1,21 +1,24 @@
 import configparser
+import itertools
 import logging
 import os
 import pathlib
 import sys
+import threading
+import time
 from typing import Union
+from urllib.parse import urlencode
 
-from selenium.webdriver import Chrome, Remote
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.remote_connection import ChromeRemoteConnection
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+# selenium is imported only when a driver is needed, so that offline tools
+# (dry-run, validation) start fast and work without it
 
 logger = logging.getLogger(__name__)
 
 
 def get_directories(root: Union[str, os.PathLike]):
     root = pathlib.Path(root)
-    directories = [elem for elem in root.iterdir() if elem.is_dir()]
+    with os.scandir(root) as it:
+        directories = [root / elem.name for elem in it if elem.is_dir()]
 
     if not directories:
         logger.warning(f"No directory found inside {root}")
@@ -25,8 +28,36 @@ def get_directories(root: Union[str, os.PathLike]):
     return directories
 
 
-def get_options(**kwargs):
-    global config
+# profile slots handed out recently, while their browser is starting
+_claimed_profiles: dict = {}
+_profiles_lock = threading.Lock()
+
+# seconds a browser may take to lock its profile
+PROFILE_CLAIM_S = 60
+
+
+def claim_profile(profile_dir: Union[str, os.PathLike]) -> str:
+    """Return a user data directory inside profile_dir not used by any
+    running browser, since Chrome allows only one per profile"""
+    root = pathlib.Path(profile_dir).absolute()
+    now = time.monotonic()
+    with _profiles_lock:
+        for i in itertools.count():
+            slot = root / f"profile-{i}"
+            # chrome holds this link while running
+            if os.path.lexists(slot / "SingletonLock"):
+                continue
+            if now - _claimed_profiles.get(slot, -PROFILE_CLAIM_S) < PROFILE_CLAIM_S:
+                continue
+            _claimed_profiles[slot] = now
+            slot.mkdir(parents=True, exist_ok=True)
+            return str(slot)
+
+
+def get_options(config: dict = None, **kwargs):
+    from selenium.webdriver.chrome.options import Options
+
+    config = config or default_config()
 
     options = Options()
     options.add_argument("no-sandbox")
@@ -38,6 +69,17 @@ def get_options(**kwargs):
     if ua:
         options.add_argument(f"user-agent={ua}")
 
+    # a kept profile (cache, compiled shaders...) makes browser start faster
+    profile_dir = kwargs.get("profile_dir", config["selenium"].get("profile_dir"))
+    if profile_dir and config["selenium"]["env"] == "local":
+        options.add_argument(f"user-data-dir={claim_profile(profile_dir)}")
+
+    # network events, for moodle.network
+    if kwargs.get("performance_log"):
+        from moodle.network import add_logging_capability
+
+        add_logging_capability(options)
+
     headless = kwargs.get("headless", config["selenium"]["headless"])
     if headless:
         options.add_argument("headless")
@@ -63,6 +105,25 @@ def get_config(cfg_fp="moodle.cfg"):
     ).lower()
     headless = parser.getboolean("selenium", "headless", fallback=True)
 
+    # browser recycling, 0 means never
+    recycle_pages = parser.getint("selenium", "recycle_pages", fallback=0)
+    max_memory_mb = parser.getint("selenium", "max_memory_mb", fallback=0)
+
+    # http connections to remote hub
+    keep_alive = parser.getboolean("selenium", "keep_alive", fallback=True)
+    pool_maxsize = parser.getint("selenium", "pool_maxsize", fallback=4)
+    connect_timeout = parser.getfloat("selenium", "connect_timeout", fallback=10.0)
+    read_timeout = parser.getfloat("selenium", "read_timeout", fallback=120.0)
+    direct_to_node = parser.getboolean("selenium", "direct_to_node", fallback=False)
+
+    # chrome user data kept between runs, only used when env is local
+    profile_dir = parser.get("selenium", "profile_dir", fallback="") or None
+
+    # chromedriver, chrome driven directly over devtools protocol, or an
+    # in-memory site (moodle.fake) to run offline, for development only
+    engine = parser.get("selenium", "engine", fallback="chromedriver").lower()
+    chrome = parser.get("selenium", "chrome", fallback="") or None
+
     # get moodle options
     # credentials section
     username = parser.get("moodle:credentials", "username")
@@ -86,26 +147,79 @@ def get_config(cfg_fp="moodle.cfg"):
         logger.error(err)
         raise ValueError(err)
 
+    if engine not in ("chromedriver", "cdp", "fake"):
+        err = "Invalid selenium engine provided!"
+        logger.error(err)
+        raise ValueError(err)
+
+    if engine == "cdp" and env != "local":
+        err = "The cdp engine drives a local chrome only!"
+        logger.error(err)
+        raise ValueError(err)
+
     return {
         "credentials": dict(username=username, password=password),
         "site": dict(login=login, course=course, module=module),
-        "selenium": dict(env=env, path=path, url=url, headless=headless),
+        "selenium": dict(
+            env=env,
+            path=path,
+            url=url,
+            headless=headless,
+            recycle_pages=recycle_pages,
+            max_memory_mb=max_memory_mb,
+            keep_alive=keep_alive,
+            pool_maxsize=pool_maxsize,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            direct_to_node=direct_to_node,
+            profile_dir=profile_dir,
+            engine=engine,
+            chrome=chrome,
+        ),
         "file_parameters": dict(
             base_name_in_course=base_name_in_course, base_name=base_name
         ),
     }
 
 
-# read one time and then use it
-config = get_config()
+_config: dict = None
+
+
+def default_config() -> dict:
+    """Configuration from moodle.cfg, read on first use and then cached"""
+    global _config
+
+    if _config is None:
+        _config = get_config()
+    return _config
+
+
+def __getattr__(name):
+    # `config` is still available as module attribute, but read lazily
+    if name == "config":
+        return default_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-def get_driver(**kwargs):
+def get_driver(config: dict = None, **kwargs):
     """Get a Selenium Chromedriver. Options can be passed
     as kwargs, or in the configuration file"""
-    global config
+    from selenium.webdriver import Chrome, Remote
+    from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 
-    options = get_options(**kwargs)
+    config = config or default_config()
+
+    if config["selenium"].get("engine") == "cdp":
+        from moodle.cdp import CDPDriver
+
+        return CDPDriver.launch(config, **kwargs)
+
+    if config["selenium"].get("engine") == "fake":
+        from moodle.fake import fake_site
+
+        return fake_site().driver()
+
+    options = get_options(config, **kwargs)
     path = kwargs.get("path", config["selenium"]["path"])
     url = kwargs.get("url", config["selenium"]["url"])
 
@@ -115,10 +229,12 @@ def get_driver(**kwargs):
         driver = Chrome(executable_path=path, options=options)
     elif env == "remote":
         driver = Remote(
-            command_executor=ChromeRemoteConnection(remote_server_addr=url),
+            command_executor=get_remote_connection(url, config),
             desired_capabilities=DesiredCapabilities.CHROME,
             options=options,
         )
+        if config["selenium"].get("direct_to_node"):
+            route_to_node(driver, url)
     else:
         # cannot enter this branch
         raise AssertionError
@@ -127,6 +243,81 @@ def get_driver(**kwargs):
     return driver
 
 
+def get_remote_connection(url: str, config: dict = None):
+    """Command executor for a remote hub. With keep_alive, commands reuse
+    pooled connections instead of opening a new one each"""
+    import urllib3
+    from selenium.webdriver.chrome.remote_connection import ChromeRemoteConnection
+
+    config = config or default_config()
+    options = config["selenium"]
+
+    keep_alive = options.get("keep_alive", True)
+    connection = ChromeRemoteConnection(remote_server_addr=url, keep_alive=keep_alive)
+    if keep_alive:
+        connection._conn = urllib3.PoolManager(
+            maxsize=options.get("pool_maxsize", 4),
+            block=False,
+            timeout=urllib3.Timeout(
+                connect=options.get("connect_timeout", 10.0),
+                read=options.get("read_timeout", 120.0),
+            ),
+        )
+    return connection
+
+
+def route_to_node(driver, hub_url: str) -> bool:
+    """Send commands of a remote driver straight to the grid node running its
+    session, skipping the hub. Needs a Selenium Grid 3 hub, whose api tells the
+    node of a session; the hub is kept if the node cannot be reached"""
+    import json
+    from urllib.parse import urlsplit
+
+    import urllib3
+
+    hub = urlsplit(hub_url)
+    api_url = f"{hub.scheme}://{hub.netloc}/grid/api/testsession?session={driver.session_id}"
+    executor = driver.command_executor
+    http = getattr(executor, "_conn", None) or urllib3.PoolManager()
+    try:
+        response = http.request("GET", api_url, timeout=5.0)
+        node = json.loads(response.data.decode("utf-8"))["proxyId"]
+    except (urllib3.exceptions.HTTPError, ValueError, KeyError) as e:
+        logger.warning(f"Cannot find grid node of session, using hub: {e}")
+        return False
+
+    hub_executor_url = executor._url
+    executor._url = f"{node.rstrip('/')}{hub.path}"
+    try:
+        # cheap command, to check that node is reachable from here
+        driver.current_url
+    except Exception as e:
+        logger.warning(f"Cannot reach grid node {node}, using hub: {e}")
+        executor._url = hub_executor_url
+        return False
+
+    logger.info(f"Commands routed directly to grid node {node}")
+    return True
+
+
+def get_lesson_url(page: str, config: dict = None, **params) -> str:
+    """Build the url of a mod/lesson page (e.g. editpage.php) with given
+    query parameters, starting from module url in configuration file"""
+    config = config or default_config()
+
+    base = config["site"]["module"].rsplit("/", 1)[0]
+    return f"{base}/{page}?{urlencode(params)}"
+
+
+def get_course_url(page: str, config: dict = None, **params) -> str:
+    """Build the url of a course/ page (e.g. mod.php) with given query
+    parameters, starting from course url in configuration file"""
+    config = config or default_config()
+
+    base = config["site"]["course"].split("?", 1)[0].rsplit("/", 1)[0]
+    return f"{base}/{page}?{urlencode(params)}"
+
+
 def change_user_agent(driver, new_user_agent: str):
     """Dinamically change chromedriver user-agent, and then
     assert that the change occurred.
@@ -142,14 +333,3 @@ def change_user_agent(driver, new_user_agent: str):
     assert actual_user_agent == new_user_agent, "Cannot set user-agent!"
     logger.info(f"Changed user-agent to {new_user_agent}")
 
-
-def test_environment(**kwargs):
-    """Determine if current environment is correctly set"""
-
-    try:
-        get_driver(**kwargs).quit()
-    except Exception as err:
-        logger.error(str(err))
-        raise err
-    else:
-        logger.info("Selenium driver found!")
@@ -0,0 +1,97 @@
+"""Continuous synchronisation of a data tree with the course.
+
+Files inside module directories are polled for changes through the tree
+Manifest; once a burst of changes is over (no more changes for `debounce`
+seconds) every touched module is synced through the same, already logged in,
+Automator."""
+import logging
+import os
+import pathlib
+import time
+from typing import Dict, Set, Union
+
+from moodle.automator import Automator
+from moodle.driver import ManagedDriver
+from moodle.model import Module
+from moodle.scanner import Manifest
+from moodle.sync import LessonSync
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+    def __init__(
+        self,
+        automator: Automator,
+        root: Union[str, os.PathLike],
+        *,
+        module: Module = None,
+        interval: float = 2.0,
+        debounce: float = 5.0,
+        load_only_slide: bool = False,
+    ):
+        if interval <= 0 or debounce < 0:
+            msg = "Poll interval must be positive and debounce not negative!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.automator = automator
+        self.root = pathlib.Path(root)
+        self.interval = interval
+        self.debounce = debounce
+        self.load_only_slide = load_only_slide
+        self.manifest = Manifest(self.root)
+
+        # modules already found on course page, by directory
+        self.modules: Dict[pathlib.Path, Module] = {}
+        if module is not None:
+            self.modules[self.root] = module
+
+    def changed_directories(self) -> Set[pathlib.Path]:
+        """Module directories with files added, removed or modified"""
+        changed = self.manifest.scan(verify=True)
+        return {entry.path for entry in changed if entry.is_module}
+
+    def get_module(self, directory: pathlib.Path) -> Module:
+        if directory not in self.modules:
+            self.modules[directory] = self.automator.find_module(directory.name)
+        return self.modules[directory]
+
+    def sync(self, directory: pathlib.Path):
+        try:
+            module = self.get_module(directory)
+            LessonSync(module).run(directory, load_only_slide=self.load_only_slide)
+        except Exception as e:
+            # keep watching, next change will try again
+            logger.exception(f"Cannot sync {directory}: {e}")
+
+    def run(self):
+        logger.info(f"Watching {self.root} for changes (Ctrl+C to stop)")
+
+        self.manifest.scan()
+        pending: Set[pathlib.Path] = set()
+        last_change = 0.0
+
+        try:
+            while True:
+                time.sleep(self.interval)
+
+                changed = self.changed_directories()
+                if changed:
+                    logger.debug(f"Changes detected in {sorted(changed)}")
+                    pending |= changed
+                    last_change = time.monotonic()
+                    continue
+
+                # wait for the end of a burst of changes before syncing
+                if pending and time.monotonic() - last_change >= self.debounce:
+                    for directory in sorted(pending):
+                        logger.info(f"Syncing changed module {directory}")
+                        self.sync(directory)
+                    pending.clear()
+
+                    # pages of course and lessons seen by this cycle
+                    if isinstance(self.automator.driver, ManagedDriver):
+                        self.automator.driver.page_done()
+        except KeyboardInterrupt:
+            logger.info("Watch stopped")
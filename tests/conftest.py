@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from moodle.instrument import CommandCounter
+from moodle.model import Module
+from moodle.fake import FakeMoodle, without_waits
+
+QUESTION = {
+    "name": "Quanto fa 2 + 2?",
+    "number": 1,
+    "jump2slide": 1,
+    "answers": [
+        {"is_correct": True, "text": "4", "html": "<p>4</p>"},
+        {"is_correct": False, "text": "5", "html": "<p>5</p>"},
+        {"is_correct": False, "text": "3", "html": "<p>3</p>"},
+    ],
+}
+
+
+def titles(site, module) -> list:
+    """Titles of the pages of a lesson of the fake site, in order"""
+    return [page[1] for page in site.lessons[module.module_id]]
+
+
+@pytest.fixture(autouse=True)
+def no_waits():
+    with without_waits():
+        yield
+
+
+@pytest.fixture
+def config() -> dict:
+    return {
+        "credentials": dict(username="user", password="password"),
+        "site": dict(
+            login="http://fake/login/index.php",
+            course="http://fake/course/view.php?id=1",
+            module="http://fake/mod/lesson/edit.php?id=",
+        ),
+        "selenium": dict(
+            env="local", engine="fake", headless=True, recycle_pages=0, max_memory_mb=0
+        ),
+        "file_parameters": dict(base_name="Slide", base_name_in_course="Slide"),
+    }
+
+
+CONFIG_FILE = """\
+[moodle:credentials]
+username = user
+password = password
+
+[moodle:urls]
+login = http://fake/login/index.php
+course = http://fake/course/view.php?id={course}
+module = http://fake/mod/lesson/edit.php?id=
+
+[selenium]
+engine = fake
+
+[upload:file_parameters]
+base_name = Slide
+base_name_in_course = Slide
+"""
+
+
+def write_config(path, course: int = 1):
+    """Configuration file of a course of the fake site"""
+    path.write_text(CONFIG_FILE.format(course=course))
+    return path
+
+
+@pytest.fixture
+def site() -> FakeMoodle:
+    return FakeMoodle()
+
+
+@pytest.fixture
+def driver(site):
+    driver = site.driver()
+    yield driver
+    driver.quit()
+
+
+@pytest.fixture
+def module(site, driver, config) -> Module:
+    """A lesson already in the course, its edit view open"""
+    site.add_module(site.sections[0]["dom_id"], "Lesson")
+    module = Module(driver, "Lesson", config=config)
+    module.dom_id = site.sections[0]["activities"][-1]["dom_id"]
+    module.open_lesson()
+    return module
+
+
+@pytest.fixture
+def counter(driver):
+    counter = CommandCounter().attach(driver)
+    yield counter
+    counter.detach()
+
+
+@pytest.fixture
+def slides(tmp_path):
+    """A module directory: six slides, in two clusters"""
+    for i in range(1, 7):
+        (tmp_path / f"Slide{i}.png").write_bytes(f"slide {i}".encode())
+    questions = [dict(QUESTION, number=n, jump2slide=n) for n in (1, 2, 3)]
+    clusters = [
+        dict(min_slide_in_cluster=1, max_slide_in_cluster=3, questions=questions[:2]),
+        dict(min_slide_in_cluster=4, max_slide_in_cluster=6, questions=questions[2:]),
+    ]
+    (tmp_path / "clusters.json").write_text(json.dumps({"clusters": clusters}))
+    return tmp_path
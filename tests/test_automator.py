@@ -0,0 +1,35 @@
+import copy
+
+import pytest
+
+from moodle.automator import Automator
+
+
+@pytest.fixture
+def automator(config):
+    automator = Automator(config=config)
+    yield automator
+    automator.close()
+
+
+def test_use_config_of_another_course(automator, config):
+    other = copy.deepcopy(config)
+    other["site"]["course"] = "http://fake/course/view.php?id=2"
+
+    automator.use_config(other)
+
+    assert automator.config is other
+
+
+@pytest.mark.parametrize(
+    "section, key, value",
+    [("site", "login", "http://other/login/index.php"), ("credentials", "username", "other")],
+)
+def test_use_config_of_another_session(automator, config, section, key, value):
+    other = copy.deepcopy(config)
+    other[section][key] = value
+
+    with pytest.raises(ValueError, match="Cannot switch session"):
+        automator.use_config(other)
+
+    assert automator.config is config
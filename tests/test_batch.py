@@ -0,0 +1,126 @@
+import copy
+import json
+import shutil
+import types
+
+import pytest
+
+from conftest import titles
+from moodle import fake
+from moodle.automator import Automator
+from moodle.batch import BatchRunner, Job, SessionPool, course_config
+from moodle.metrics import PROGRESS
+
+
+@pytest.fixture
+def fake_site(site, monkeypatch):
+    """Site of the browsers of the fake engine"""
+    monkeypatch.setattr(fake, "_site", site)
+    return site
+
+
+@pytest.fixture
+def pool(fake_site):
+    factory_calls = []
+
+    def factory(config: dict) -> Automator:
+        factory_calls.append(config["site"]["course"])
+        return Automator(config=config)
+
+    pool = SessionPool(factory)
+    pool.factory_calls = factory_calls
+    return pool
+
+
+def data_root(tmp_path, slides, name: str, modules: dict):
+    """Data root with a uf directory, and modules of the given number of slides"""
+    root = tmp_path / name
+    for module, count in modules.items():
+        directory = root / "UF1" / module
+        directory.mkdir(parents=True)
+        for i in range(1, count + 1):
+            shutil.copy(slides / f"Slide{i}.png", directory)
+        clusters = json.loads((slides / "clusters.json").read_text())
+        clusters["clusters"] = [
+            cluster
+            for cluster in clusters["clusters"]
+            if cluster["max_slide_in_cluster"] <= count
+        ]
+        (directory / "clusters.json").write_text(json.dumps(clusters))
+    return root
+
+
+def lesson_titles(site, name: str) -> list:
+    """Titles of the pages of the lesson of a module, by its name"""
+    activity = next(
+        activity
+        for section in site.sections
+        for activity in section["activities"]
+        if activity["name"] == name
+    )
+    return titles(site, types.SimpleNamespace(module_id=int(activity["dom_id"].split("-")[1])))
+
+
+def test_longest_module_first(fake_site, pool, config, slides, tmp_path, monkeypatch):
+    root = data_root(tmp_path, slides, "course", dict(Small=3, Big=6))
+    job = Job(1, root, config)
+    runner = BatchRunner([job], workers=1, pool=pool)
+    populated = []
+    populate = runner._populate
+
+    def record(automator, task):
+        populated.append(task.name)
+        populate(automator, task)
+
+    monkeypatch.setattr(runner, "_populate", record)
+
+    assert runner.run()
+
+    assert populated == ["Big", "Small"]
+    assert len(lesson_titles(fake_site, "Big")) == 11
+    assert lesson_titles(fake_site, "Small") == [
+        "Slide1",
+        "Slide2",
+        "Slide3",
+        "Domanda 1",
+        "Domanda 2",
+        "Fine gruppo",
+    ]
+
+
+def test_session_shared_by_jobs_of_site(fake_site, pool, config, slides, tmp_path):
+    jobs = [
+        Job(1, data_root(tmp_path, slides, "course-1", dict(A=3)), config),
+        Job(2, data_root(tmp_path, slides, "course-2", dict(B=3)), course_config(config, 2)),
+    ]
+
+    assert BatchRunner(jobs, workers=1, pool=pool).run()
+
+    assert pool.factory_calls == [config["site"]["course"]]
+    assert [s["activities"][0]["name"] for s in fake_site.sections[1:]] == ["A", "B"]
+
+
+def test_slides_outside_modules_skipped(fake_site, pool, config, slides, tmp_path, caplog):
+    root = data_root(tmp_path, slides, "course", dict(A=3))
+    shutil.copytree(root / "UF1" / "A", root / "Loose")
+    runner = BatchRunner([Job(1, root, copy.deepcopy(config))], workers=1, pool=pool)
+    PROGRESS.reset()
+
+    assert runner.run()
+
+    assert [task.name for task in runner._tasks] == ["A"]
+    assert PROGRESS.total.get(kind="slides") == 3
+    assert "Slides of" in caplog.text and "Loose" in caplog.text
+
+
+def test_session_of_another_user(fake_site, pool, config, slides, tmp_path):
+    other = course_config(config, 2)
+    other["credentials"]["username"] = "other"
+    jobs = [
+        Job(1, data_root(tmp_path, slides, "course-1", dict(A=3)), config),
+        Job(2, data_root(tmp_path, slides, "course-2", dict(B=3)), other),
+    ]
+
+    assert BatchRunner(jobs, workers=1, pool=pool).run()
+
+    assert pool.factory_calls == [config["site"]["course"], other["site"]["course"]]
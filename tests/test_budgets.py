@@ -0,0 +1,69 @@
+"""WebDriver round trips of model operations, against the fake site.
+
+Budgets are the commands issued today plus a small margin: a change making
+an operation chattier fails here, before it slows down remote runs."""
+import pytest
+
+from conftest import QUESTION, titles
+from moodle.cluster import Cluster
+from moodle.instrument import CommandCounter
+
+
+def test_load_slide(site, module, counter, slides):
+    for i in range(3):
+        module.load_slide(slides / f"Slide{i + 1}.png", i)
+
+    assert titles(site, module) == ["Slide1", "Slide2", "Slide3"]
+    assert counter.calls["load_slide"] == 3
+    counter.check_budget("load_slide", 55)
+    counter.check_budget("upload", 24)
+
+
+def test_load_cluster(site, module, counter, slides):
+    module.load_slide(slides / "Slide1.png", 0)
+    module.load_slide(slides / "Slide2.png", 1, jump_to_random_content=True)
+    counter.reset()
+
+    cluster = Cluster(dict(min_slide_in_cluster=1, max_slide_in_cluster=2, questions=[QUESTION]))
+    module.load_cluster(cluster, is_last_slide=True, index=2)
+
+    assert titles(site, module) == ["Slide1", "Slide2", "Domanda 1"]
+    counter.check_budget("load_cluster", 55)
+
+
+def test_populate(site, module, counter, slides):
+    module.populate(slides)
+
+    assert titles(site, module) == [
+        "Slide1",
+        "Slide2",
+        "Slide3",
+        "Domanda 1",
+        "Domanda 2",
+        "Slide4",
+        "Fine gruppo",
+        "Slide5",
+        "Slide6",
+        "Domanda 3",
+        "Fine gruppo",
+    ]
+    counter.check_budget("populate", 500)
+    counter.check_budget("load_slide", 55)
+    counter.check_budget("load_cluster", 80)
+    counter.check_budget("add_end_group", 2)
+    counter.check_budget("upload", 24)
+
+
+def test_check_budget_fails(module, counter, slides):
+    module.load_slide(slides / "Slide1.png", 0)
+
+    with pytest.raises(AssertionError, match="load_slide costs"):
+        counter.check_budget("load_slide", 1)
+
+
+def test_detach(driver, counter):
+    counter.detach()
+    driver.execute_script("return 1")
+
+    assert counter not in CommandCounter.attached
+    assert counter.total() == 0
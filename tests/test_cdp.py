@@ -0,0 +1,144 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from selenium.common.exceptions import TimeoutException
+
+from moodle import cdp
+from moodle.cdp import CDPDriver, CDPElement, Connection, _to_js
+from moodle.instrument import CommandCounter, operation
+
+
+class FakeWebSocket:
+    """DevTools target answering every command, after the events scripted
+    for its method"""
+
+    def __init__(self):
+        self.sent = []
+        self.incoming = asyncio.Queue()
+        self.events = {}
+        self.results = {
+            "Page.getFrameTree": {"frameTree": {"frame": {"id": "main"}}},
+            "Runtime.evaluate": {"result": {"value": [10, 20]}},
+        }
+
+    async def send(self, raw: str):
+        message = json.loads(raw)
+        self.sent.append(message["method"])
+        for method, params in self.events.get(message["method"], ()):
+            await self.incoming.put({"method": method, "params": params})
+        result = self.results.get(message["method"], {})
+        await self.incoming.put({"id": message["id"], "result": result})
+
+    async def close(self):
+        await self.incoming.put(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return json.dumps(message)
+
+
+@pytest.fixture
+def ws():
+    return FakeWebSocket()
+
+
+@pytest.fixture
+def driver(ws):
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def connect():
+        connection = Connection(ws)
+        connection._reader = asyncio.ensure_future(connection._read())
+        return connection
+
+    connection = asyncio.run_coroutine_threadsafe(connect(), loop).result()
+    driver = CDPDriver(connection, loop)
+    yield driver
+    driver.quit()
+
+
+def test_to_js(driver):
+    element = CDPElement(driver, {"__node": "token:1"})
+
+    assert _to_js([element, {"a": (element, 2)}, "text"]) == [
+        {"__node": "token:1"},
+        {"a": [{"__node": "token:1"}, 2]},
+        "text",
+    ]
+
+
+def test_from_js(driver):
+    value = driver._from_js({"found": [{"__node": "token:1"}], "node": {"__node": "token:2"}})
+
+    assert value["found"] == [CDPElement(driver, {"__node": "token:1"})]
+    assert isinstance(value["node"], CDPElement) and value["node"].id == "token:2"
+    # a dict with more keys is only data
+    assert driver._from_js({"__node": "token:1", "x": 1}) == {"__node": "token:1", "x": 1}
+
+
+def test_dispatch():
+    async def dispatch():
+        connection = Connection(None)
+        main = connection.wait_for("Page.frameStartedLoading", lambda p: p["frameId"] == "main")
+        other = connection.wait_for("Page.loadEventFired")
+        seen = []
+        connection.on("Page.frameStartedLoading", seen.append)
+
+        connection._dispatch("Page.frameStartedLoading", {"frameId": "child"})
+        assert not main.done()
+        connection._dispatch("Page.frameStartedLoading", {"frameId": "main"})
+        assert main.result() == {"frameId": "main"}
+        assert not other.done()
+        assert seen == [{"frameId": "child"}, {"frameId": "main"}]
+        assert "Page.frameStartedLoading" not in connection.waiters
+
+    asyncio.run(dispatch())
+
+
+def test_click_without_navigation(driver, ws):
+    element = CDPElement(driver, {"__node": "token:1"})
+
+    start = time.perf_counter()
+    element.click()
+
+    assert time.perf_counter() - start < 0.1
+    assert ws.sent.count("Input.dispatchMouseEvent") == 3
+
+
+def test_click_waits_for_navigation(driver, ws, monkeypatch):
+    element = CDPElement(driver, {"__node": "token:1"})
+    ws.events["Input.dispatchMouseEvent"] = [
+        ("Page.frameRequestedNavigation", {"frameId": "main"}),
+    ]
+    monkeypatch.setattr(cdp, "LOAD_TIMEOUT_S", 0.05)
+
+    with pytest.raises(TimeoutException):
+        element.click()
+
+    ws.events["Input.dispatchMouseEvent"].append(("Page.loadEventFired", {}))
+    element.click()
+
+
+def test_commands_counted(driver, ws):
+    element = CDPElement(driver, {"__node": "token:1"})
+    counter = CommandCounter().attach(driver)
+    try:
+        with operation("load_slide"):
+            element.click()
+            driver.execute_script("return 1;")
+    finally:
+        counter.detach()
+    driver.execute_script("return 1;")
+
+    assert counter.counts["load_slide"] == {"Page.click": 1, "Page.evaluate": 1}
+    assert counter.total() == 0
+    assert "run" not in vars(driver)
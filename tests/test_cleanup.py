@@ -0,0 +1,32 @@
+import types
+
+from conftest import titles
+from moodle.cleanup import Cleaner
+
+
+def cleaner(driver, config) -> Cleaner:
+    return Cleaner(types.SimpleNamespace(driver=driver, config=config))
+
+
+def test_truncate_lesson(site, driver, config, module, slides):
+    module.populate(slides)
+
+    assert cleaner(driver, config).truncate_lesson(module, 5) == 4
+    assert titles(site, module) == [
+        "Slide1",
+        "Slide2",
+        "Slide3",
+        "Domanda 1",
+        "Domanda 2",
+        "Slide4",
+        "Fine gruppo",
+    ]
+
+
+def test_truncate_lesson_counts_pages_gone(site, driver, config, module, slides, monkeypatch):
+    module.populate(slides)
+    # requests answered, but pages left there (e.g. sesskey expired)
+    monkeypatch.setattr(site, "fetch", lambda url: True)
+
+    assert cleaner(driver, config).truncate_lesson(module, 5) == 0
+    assert len(titles(site, module)) == 11
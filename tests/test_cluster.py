@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from conftest import QUESTION
+from moodle.cluster import ModuleCluster, count_work
+from moodle.model import Slide
+
+
+def test_count_work(slides):
+    assert count_work(slides / "clusters.json") == (3, 2)
+
+
+def test_clusters_ending_at_same_slide(tmp_path):
+    clusters = [
+        dict(min_slide_in_cluster=1, max_slide_in_cluster=3, questions=[QUESTION]),
+        dict(min_slide_in_cluster=2, max_slide_in_cluster=3, questions=[QUESTION]),
+    ]
+    (tmp_path / "clusters.json").write_text(json.dumps({"clusters": clusters}))
+
+    with pytest.raises(ValueError, match="ending at slide 3"):
+        ModuleCluster(tmp_path / "clusters.json")
+
+
+def test_plan_steps(module, slides):
+    module_cluster = ModuleCluster(slides / "clusters.json")
+    slides_ = Slide.find_all(slides)
+
+    steps = module.plan_steps(slides_, module_cluster.clusters, module_cluster.max_slides)
+    clusters = {step.slide.index: step.cluster for step in steps if step.cluster}
+
+    assert {index: c.max_slide_in_cluster for index, c in clusters.items()} == {4: 3, 6: 6}
+
+
+def test_plan_steps_from_slide_after_cluster(module, slides):
+    # first cluster already uploaded, with the slides up to its max slide
+    slides_, clusters, max_slides = module.find_work(slides, start=4)
+
+    steps = list(module.plan_steps(slides_, clusters, max_slides))
+
+    clusters = [step.cluster and step.cluster.max_slide_in_cluster for step in steps]
+    assert clusters == [None, None, 6]
+
+
+def test_find(slides):
+    module_cluster = ModuleCluster(slides / "clusters.json")
+
+    assert [module_cluster.find(i).max_slide_in_cluster for i in (1, 3, 4, 6)] == [3, 3, 6, 6]
+    assert module_cluster.find(7) is None
+
+
+def test_from_slide(slides):
+    module_cluster = ModuleCluster(slides / "clusters.json")
+
+    def ends(index: int) -> list:
+        return [cluster.max_slide_in_cluster for cluster in module_cluster.from_slide(index)]
+
+    assert ends(1) == ends(3) == [3, 6]
+    assert ends(4) == ends(6) == [6]
+    assert ends(7) == []
@@ -0,0 +1,67 @@
+import socket
+
+import pytest
+
+from conftest import write_config
+from moodle.daemon import Daemon
+from moodle.journal import Journal
+from moodle.logs import RUN_ID
+
+
+def test_running_daemon_fails_before_sessions(tmp_path):
+    address = str(tmp_path / "daemon.sock")
+    running = socket.socket(socket.AF_UNIX)
+    running.bind(address)
+    running.listen()
+    started = []
+    daemon = Daemon(None, lambda: started.append(1), address=address)
+
+    try:
+        with pytest.raises(RuntimeError, match="already running"):
+            daemon.serve()
+    finally:
+        running.close()
+
+    assert not started
+
+
+def test_socket_removed_when_sessions_fail(tmp_path):
+    address = str(tmp_path / "daemon.sock")
+
+    def factory():
+        assert (tmp_path / "daemon.sock").exists()
+        raise RuntimeError("login failed")
+
+    with pytest.raises(RuntimeError, match="login failed"):
+        Daemon(None, factory, address=address).serve()
+
+    assert not (tmp_path / "daemon.sock").exists()
+
+
+class Session:
+    def resume(self):
+        pass
+
+    def use_config(self, config: dict):
+        self.config = config
+
+
+def test_jobs_have_runs_of_their_own(tmp_path):
+    course = "http://fake/course/view.php?id=1"
+    journal = Journal(tmp_path / "journal.jsonl")
+    daemon = Daemon(
+        lambda automator, job: journal.record("section", course, "section-5", "UF1"),
+        Session,
+        address=str(tmp_path / "daemon.sock"),
+    )
+    daemon.start_sessions()
+    config = write_config(tmp_path / "moodle.cfg")
+    outcomes = []
+
+    for _ in range(2):
+        daemon.handle(dict(action="run", config=str(config), args={}), outcomes.append)
+
+    runs = [outcome["run"] for outcome in outcomes]
+    assert runs == [f"{RUN_ID}-1", f"{RUN_ID}-2"]
+    assert [entry["run"] for entry in journal.entries()] == runs
+    assert journal.created(course, run=runs[0])[0]["dom_id"] == "section-5"
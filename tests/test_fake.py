@@ -0,0 +1,23 @@
+import time
+
+from moodle import model, watch
+from moodle.fake import without_waits
+
+
+def test_waits_of_model_code_only():
+    # tests run inside without_waits, see conftest
+    assert model.time.sleep is not time.sleep
+    assert watch.time is time
+
+    start = time.perf_counter()
+    model.time.sleep(10)
+    assert time.perf_counter() - start < 1
+    assert model.time.monotonic() > 0
+
+
+def test_waits_restored():
+    outer = model.time
+    with without_waits():
+        assert model.time is not outer
+
+    assert model.time is outer
@@ -0,0 +1,36 @@
+from moodle.journal import Journal
+from moodle.logs import log_context
+
+COURSE = "http://fake/course/view.php?id=1"
+
+
+def record(journal: Journal, run: str, *objects):
+    with log_context(run=run):
+        for kind, dom_id in objects:
+            journal.record(kind, COURSE, dom_id, f"{kind} of {run}")
+
+
+def test_dom_id_used_again_by_another_run(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    record(journal, "a", ("section", "section-5"), ("module", "module-10"))
+    journal.mark_deleted(journal.created(COURSE))
+
+    record(journal, "b", ("section", "section-5"), ("module", "module-11"))
+
+    created = journal.created(COURSE)
+    assert [(entry["kind"], entry["dom_id"]) for entry in created] == [
+        ("section", "section-5"),
+        ("module", "module-11"),
+    ]
+    assert not journal.created(COURSE, run="a")
+
+
+def test_deleted_by_its_run_only(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    record(journal, "a", ("section", "section-5"))
+    record(journal, "b", ("section", "section-6"))
+
+    journal.mark_deleted(journal.created(COURSE, run="a"))
+
+    assert not journal.created(COURSE, run="a")
+    assert [entry["dom_id"] for entry in journal.created(COURSE)] == ["section-6"]
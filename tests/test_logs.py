@@ -0,0 +1,102 @@
+import json
+import logging
+import threading
+
+import pytest
+
+from moodle.logs import (
+    RUN_ID,
+    ContextFilter,
+    LogListener,
+    LogQueueHandler,
+    log_context,
+    parse_levels,
+    setup_logging,
+)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+        self.threads.add(threading.current_thread().name)
+
+
+@pytest.fixture
+def root():
+    """Root logger, restored after setup_logging changed it"""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_records_handled_off_the_calling_thread():
+    handler = RecordingHandler()
+    listener = LogListener([handler])
+    queue_handler = LogQueueHandler(listener.queue)
+    queue_handler.addFilter(ContextFilter())
+    logger = logging.getLogger("tests.logs")
+    logger.addHandler(queue_handler)
+    listener.start()
+    try:
+        with log_context(module="M1"):
+            with log_context(slide=3):
+                logger.warning("slide uploaded")
+            with log_context(run="job-1"):
+                logger.warning("job done")
+        logger.warning("no context")
+    finally:
+        listener.stop()
+        logger.removeHandler(queue_handler)
+
+    assert threading.current_thread().name not in handler.threads
+    slide, job, plain = handler.records
+    assert slide.context == "[module=M1] [slide=3] "
+    assert slide.fields == dict(module="M1", slide=3)
+    assert (slide.run, job.run) == (RUN_ID, "job-1")
+    assert job.context == "[module=M1] "
+    assert plain.context == "" and plain.run == RUN_ID
+
+
+def test_json_log_files(root, tmp_path):
+    log_file, debug_log_file = tmp_path / "main.log", tmp_path / "main.debug.log"
+    listener = setup_logging(
+        log_file=str(log_file),
+        debug_log_file=str(debug_log_file),
+        json_logs=True,
+        levels=dict(noisy=logging.WARNING),
+    )
+    try:
+        with log_context(module="M1"):
+            logging.getLogger("tests.logs").info("slide uploaded")
+            logging.getLogger("tests.logs").debug("details")
+            logging.getLogger("noisy").info("not written")
+    finally:
+        listener.stop()
+
+    (record,) = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert record["message"] == "slide uploaded"
+    assert (record["module"], record["run"], record["level"]) == ("M1", RUN_ID, "INFO")
+    messages = [json.loads(line)["message"] for line in debug_log_file.read_text().splitlines()]
+    assert messages == ["slide uploaded", "details"]
+
+
+def test_parse_levels():
+    assert parse_levels(["selenium=debug", "urllib3=WARNING"]) == {
+        "selenium": logging.DEBUG,
+        "urllib3": logging.WARNING,
+    }
+    assert parse_levels(None) == {}
+    with pytest.raises(ValueError, match="expected logger=LEVEL"):
+        parse_levels(["selenium"])
+    with pytest.raises(ValueError, match="Invalid level"):
+        parse_levels(["selenium=LOUD"])
@@ -0,0 +1,40 @@
+from moodle.logs import log_context
+from moodle.metrics import Progress, Registry
+
+
+def test_progress_reset():
+    registry = Registry()
+    progress = Progress(registry)
+    progress.plan(2, 1)
+    progress.slide_done()
+    progress.slide_done()
+
+    progress.reset()
+    progress.add_work(3, 0)
+    progress.slide_done()
+
+    text = registry.render()
+    assert 'moodle_items_planned{kind="slides"} 3' in text
+    assert 'moodle_items_done_total{kind="slides"} 3' in text
+    assert "# TYPE moodle_items_planned gauge" in text
+    assert progress.eta() is not None and progress.eta() > 0
+
+
+def test_progress_of_jobs_running_together():
+    registry = Registry()
+    progress = Progress(registry)
+
+    with log_context(run="a"), progress.job():
+        progress.plan(2, 0)
+        progress.slide_done()
+        with log_context(run="b"), progress.job():
+            # work of a job started while another runs adds to its own
+            progress.add_work(3, 1)
+            progress.add_work(1, 0)
+            assert progress.total.get(kind="slides") == 6
+            assert progress.total.get(kind="questions") == 1
+        assert progress.total.get(kind="slides") == 6
+
+    with progress.job():
+        assert progress.total.get(kind="slides") == 0
+        assert not progress.planned
@@ -0,0 +1,94 @@
+import pytest
+
+from moodle.instrument import operation
+from moodle.network import NetworkRecorder, PerformanceLog, Request, busy_seconds
+
+
+def timing(request_time: float, send_end: float, headers_end: float) -> dict:
+    return dict(
+        requestTime=request_time,
+        sendStart=send_end - 1,
+        sendEnd=send_end,
+        receiveHeadersEnd=headers_end,
+    )
+
+
+def events(*messages) -> list:
+    log = PerformanceLog()
+    for method, params in messages:
+        log.listener(method)(params)
+    return log.drain()
+
+
+def request(start: float, end: float) -> Request:
+    request = Request("Document", start)
+    request.end = end
+    return request
+
+
+def test_busy_seconds():
+    requests = [request(0, 1), request(0.5, 2), request(3, 4), request(3.2, 3.5)]
+
+    assert busy_seconds(requests) == 3
+    assert busy_seconds([]) == 0
+
+
+def test_parse():
+    recorder = NetworkRecorder()
+    entries = events(
+        ("Network.requestWillBeSent", dict(requestId="1", type="Document", timestamp=10.0)),
+        ("Network.requestWillBeSent", dict(requestId="2", type="Image", timestamp=10.1)),
+        # form post redirected to the page to show
+        (
+            "Network.requestWillBeSent",
+            dict(
+                requestId="1",
+                type="Document",
+                timestamp=10.5,
+                redirectResponse=dict(timing=timing(10.0, 100, 400)),
+            ),
+        ),
+        (
+            "Network.responseReceived",
+            dict(requestId="1", response=dict(timing=timing(10.5, 50, 250))),
+        ),
+        ("Network.loadingFinished", dict(requestId="1", timestamp=11.0)),
+        ("Network.loadingFinished", dict(requestId="2", timestamp=11.0)),
+    )
+
+    post, page = recorder.parse(entries)
+
+    assert (post.start, post.end) == (10.0, 10.5)
+    assert post.server == pytest.approx(0.3)
+    assert post.transfer == pytest.approx(0.1)
+    assert (page.start, page.end) == (10.5, 11.0)
+    assert page.connect == pytest.approx(0.049)
+    assert page.server == pytest.approx(0.2)
+    assert page.transfer == pytest.approx(0.25)
+    assert not recorder.open
+
+
+class LogDriver:
+    def __init__(self):
+        self.reads = 0
+
+    def get_log(self, log_type: str) -> list:
+        self.reads += 1
+        return []
+
+
+def test_log_read_once_per_step():
+    driver = LogDriver()
+    recorder = NetworkRecorder().attach(driver)
+    try:
+        with operation("populate"):
+            for _ in range(3):
+                with operation("load_slide"):
+                    with operation("upload"):
+                        pass
+    finally:
+        recorder.detach()
+
+    assert driver.reads == 4
+    assert set(recorder.steps) == {"populate", "load_slide"}
+    assert recorder.steps["load_slide"].calls == 3
@@ -0,0 +1,107 @@
+import json
+import types
+
+import pytest
+
+from conftest import QUESTION, titles
+from moodle import parallel
+from moodle.model import Module
+from moodle.parallel import ParallelPopulator, split_steps
+
+SLIDES = 12
+
+
+@pytest.fixture
+def lesson(tmp_path):
+    """A module directory: twelve slides, in four clusters of three"""
+    for i in range(1, SLIDES + 1):
+        (tmp_path / f"Slide{i}.png").write_bytes(f"slide {i}".encode())
+    clusters = [
+        dict(
+            min_slide_in_cluster=first,
+            max_slide_in_cluster=first + 2,
+            questions=[dict(QUESTION, number=first, jump2slide=first)],
+        )
+        for first in range(1, SLIDES + 1, 3)
+    ]
+    (tmp_path / "clusters.json").write_text(json.dumps({"clusters": clusters}))
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def small_ranges(monkeypatch):
+    monkeypatch.setattr(parallel, "MIN_RANGE_SLIDES", 2)
+
+
+def test_split_at_cluster_boundaries(module, lesson):
+    slides, clusters, max_slides = module.find_work(lesson)
+    steps = list(module.plan_steps(slides, clusters, max_slides))
+
+    ranges = split_steps(steps, max_slides, 3)
+
+    assert len(ranges) == 3
+    assert [step for steps_ in ranges for step in steps_] == steps
+    # a range starts after the end of cluster that follows a slide
+    for steps_ in ranges[1:]:
+        assert steps_[0].slide.index - 2 in max_slides
+        assert steps[steps.index(steps_[0]) - 1].cluster is not None
+
+
+def test_split_without_clusters(module, lesson):
+    slides, _, _ = module.find_work(lesson, load_only_slide=True)
+    steps = list(module.plan_steps(slides, [], frozenset()))
+
+    ranges = split_steps(steps, frozenset(), 4)
+
+    assert [len(steps_) for steps_ in ranges] == [3, 3, 3, 3]
+
+
+def test_too_small_to_split(module, lesson, monkeypatch):
+    monkeypatch.setattr(parallel, "MIN_RANGE_SLIDES", SLIDES)
+    slides, clusters, max_slides = module.find_work(lesson)
+    steps = list(module.plan_steps(slides, clusters, max_slides))
+
+    assert split_steps(steps, max_slides, 3) == [steps]
+
+
+def test_parallel_populate(site, module, config, lesson, monkeypatch):
+    sessions = [None] + [types.SimpleNamespace(driver=site.driver()) for _ in range(2)]
+    populator = ParallelPopulator(module, sessions)
+    deferred = []
+    set_jumps = populator.set_jumps
+
+    def record(jumps: list):
+        deferred.extend(jumps)
+        set_jumps(jumps)
+
+    monkeypatch.setattr(populator, "set_jumps", record)
+
+    populator.populate(lesson)
+
+    # same lesson as populated by a single session, without placeholders
+    site.add_module(site.sections[0]["dom_id"], "Serial")
+    serial = Module(site.driver(), "Serial", config=config)
+    serial.dom_id = site.sections[0]["activities"][-1]["dom_id"]
+    serial.populate(lesson)
+    assert titles(site, module) == titles(site, serial)
+
+    # jumps to pages of later ranges, set on the pages that have them
+    assert deferred
+    pages = {page[0]: page for page in site.lessons[module.module_id]}
+    for page_id, _, text in deferred:
+        assert text in pages[page_id][2]["cells"]
+    for session in sessions[1:]:
+        session.driver.quit()
+    serial.driver.quit()
+
+
+def test_check_order(site, module, lesson):
+    module.populate(lesson)
+    populator = ParallelPopulator(module, [None])
+    slide_ids = [page[0] for page in site.lessons[module.module_id] if page[1].startswith("Slide")]
+
+    populator.check_order(slide_ids)
+    with pytest.raises(RuntimeError, match="not in order"):
+        populator.check_order(slide_ids[::-1])
+    with pytest.raises(RuntimeError, match="not in order"):
+        populator.check_order(slide_ids + [0])
@@ -0,0 +1,87 @@
+import base64
+import io
+import time
+import zipfile
+
+import pytest
+
+from moodle.pipeline import Pipeline, stage_file
+
+
+def slow_for_even(item: int) -> int:
+    # later items overtake earlier ones, were stages not ordered
+    time.sleep(0.01 if item % 2 == 0 else 0)
+    return item
+
+
+def assert_stopped(pipeline: Pipeline):
+    for thread in pipeline._threads:
+        thread.join(timeout=1)
+    assert not any(thread.is_alive() for thread in pipeline._threads)
+
+
+def test_items_in_order():
+    pipeline = Pipeline(range(20), dict(wait=slow_for_even, double=lambda x: x * 2), maxsize=2)
+
+    assert list(pipeline) == [i * 2 for i in range(20)]
+    assert set(pipeline.depths()) == {"wait", "double", "browser"}
+
+
+def test_stage_error_raised_to_consumer():
+    done = []
+
+    def fail_at_three(item: int) -> int:
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+
+    pipeline = Pipeline(range(100), dict(check=fail_at_three, done=done.append), maxsize=2)
+
+    with pytest.raises(ValueError, match="bad item"):
+        for _ in pipeline:
+            pass
+
+    # items before the failure went through, stage threads stop
+    assert done[:3] == [0, 1, 2]
+    assert_stopped(pipeline)
+
+
+def test_source_error_raised_to_consumer():
+    def source():
+        yield 1
+        raise OSError("cannot read")
+
+    items = []
+    with pytest.raises(OSError, match="cannot read"):
+        for item in Pipeline(source(), dict(same=lambda x: x)):
+            items.append(item)
+
+    assert items == [1]
+
+
+def test_consumer_error_stops_stages():
+    pipeline = Pipeline(range(1000), dict(same=lambda x: x), maxsize=2)
+
+    with pytest.raises(RuntimeError):
+        for item in pipeline:
+            if item == 5:
+                raise RuntimeError("browser failed")
+
+    assert_stopped(pipeline)
+
+
+def test_unbounded_queues_rejected():
+    with pytest.raises(ValueError, match="bounded"):
+        Pipeline([], {}, maxsize=0)
+
+
+def test_stage_file(tmp_path):
+    slide = tmp_path / "Slide1.png"
+    slide.write_bytes(b"slide 1")
+
+    assert stage_file(slide).payload is None
+    staged = stage_file(slide, remote=True)
+    with zipfile.ZipFile(io.BytesIO(base64.decodebytes(staged.payload.encode()))) as zipped:
+        assert zipped.read("Slide1.png") == b"slide 1"
+    with pytest.raises(FileNotFoundError):
+        stage_file(tmp_path / "Slide2.png")
@@ -0,0 +1,39 @@
+import threading
+import time
+
+from moodle.profiler import SamplingProfiler
+
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_categories_of_working_threads():
+    idle = threading.Event()
+    threading.Thread(target=idle.wait, name="idle", daemon=True).start()
+    profiler = SamplingProfiler(0.002)
+
+    with profiler:
+        sleeper = threading.Thread(target=time.sleep, args=(0.2,), name="sleeper")
+        sleeper.start()
+        busy(0.2)
+        sleeper.join()
+    idle.set()
+
+    threads = profiler.working_threads()
+    assert "idle" not in threads and {"sleeper", "MainThread"} <= threads
+    counts = profiler.by_category(threads)
+    assert counts["sleep"] and counts["cpu"]
+    assert profiler.by_category()["wait"] > counts["wait"]
+    assert "working threads (MainThread, sleeper)" in profiler.summary()
+
+
+def test_sleep_restored():
+    sleep = time.sleep
+
+    with SamplingProfiler():
+        assert time.sleep is not sleep
+
+    assert time.sleep is sleep
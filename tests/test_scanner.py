@@ -0,0 +1,55 @@
+import os
+
+from moodle.scanner import STATE_FILENAME, Manifest, SyncState, find_json
+from moodle.watch import Watcher
+
+
+def test_state_file_is_not_a_cluster_json(slides):
+    SyncState(slides).save()
+
+    assert find_json(slides) == [slides / "clusters.json"]
+    manifest = Manifest(slides)
+    manifest.scan()
+    assert STATE_FILENAME not in manifest[slides].files
+    assert manifest[slides].json_files == [slides / "clusters.json"]
+
+
+def test_state_file_is_not_a_change(slides):
+    watcher = Watcher(None, slides)
+    watcher.manifest.scan()
+
+    state = SyncState(slides)
+    state.record("Slide1", slides / "Slide1.png")
+    state.save()
+    assert not watcher.changed_directories()
+
+    (slides / "Slide1.png").write_bytes(b"slide 1, fixed")
+    assert watcher.changed_directories() == {slides}
+
+
+def test_files_hashed_only_when_verified(slides):
+    manifest = Manifest(slides)
+    manifest.scan()
+    assert all(entry.sha1 is None for entry in manifest[slides].files.values())
+
+    # first time modified it's hashed, nothing to compare with
+    slide = slides / "Slide1.png"
+    stat = slide.stat()
+    os.utime(slide, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert manifest.scan(verify=True) == [manifest[slides]]
+    assert manifest[slides].files["Slide1.png"].sha1 is not None
+
+    # then touched, or written again as it was, is not a change
+    slide.write_bytes(slide.read_bytes())
+    os.utime(slide, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert manifest.scan(verify=True) == []
+
+
+def test_manifest_of_read_only_tree(slides, caplog):
+    # manifest cannot be written
+    (slides / ".moodle_manifest.tmp").mkdir()
+
+    manifest = Manifest(slides)
+    assert manifest.scan() == [manifest[slides]]
+    assert "Cannot write manifest" in caplog.text
+    assert not manifest.path.exists()
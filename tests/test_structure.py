@@ -0,0 +1,78 @@
+from moodle.structure import CourseStructure, last_element, module_id_of
+
+SECTIONS = [
+    dict(dom_id="section-0", name="", section_id=10, activities=[]),
+    dict(
+        dom_id="section-1",
+        name="UF1",
+        section_id=11,
+        activities=[
+            dict(dom_id="module-5", name="Lesson"),
+            dict(dom_id="module-7", name="Quiz"),
+        ],
+    ),
+    dict(dom_id="section-2", name="UF2", activities=[dict(dom_id="module-9", name="Lesson")]),
+]
+
+
+def test_module_id_of():
+    assert module_id_of("module-123") == 123
+    assert module_id_of("section-1") is None
+    assert module_id_of("module-x") is None
+
+
+def test_index():
+    structure = CourseStructure(SECTIONS)
+
+    assert [section.dom_id for section in structure.sections] == [
+        "section-0",
+        "section-1",
+        "section-2",
+    ]
+    assert structure.last_section.name == "UF2"
+    assert structure.section("section-1").section_id == 11
+    assert structure.section("section-3") is None
+    assert structure.activity(7).name == "Quiz"
+    assert structure.activity(7).section is structure.section("section-1")
+    assert structure.activity(8) is None
+    # first one, in page order
+    assert structure.find_activity("Lesson").module_id == 5
+    assert structure.find_activity("Forum") is None
+
+
+def test_add_section_and_activity():
+    structure = CourseStructure(SECTIONS)
+
+    section = structure.add_section("section-3", "UF3", 13)
+    activity = structure.add_activity("section-3", "module-11", "Lesson 3")
+
+    assert structure.last_section is section
+    assert section.activities == [activity]
+    assert structure.activity(11) is activity
+
+    # known ones are updated in place, not added again
+    assert structure.add_section("section-1", "UF1 renamed") is structure.section("section-1")
+    assert structure.section("section-1").section_id == 11
+    assert structure.section("section-1").name == "UF1 renamed"
+    structure.add_activity("section-1", "module-5", "Lesson renamed")
+    assert [a.name for a in structure.section("section-1").activities] == [
+        "Lesson renamed",
+        "Quiz",
+    ]
+    assert len(structure.sections) == 4
+
+
+def test_read(site, driver, counter):
+    site.add_section()
+    site.add_module(site.sections[1]["dom_id"], "Lesson")
+
+    structure = CourseStructure.read(driver)
+
+    assert [section.dom_id for section in structure.sections] == [
+        s["dom_id"] for s in site.sections
+    ]
+    assert structure.find_activity("Lesson").section is structure.last_section
+    dom_id, _ = last_element(driver, "li.section", None)
+    assert dom_id == site.sections[-1]["dom_id"]
+    # one script each
+    assert counter.total() == 2
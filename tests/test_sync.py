@@ -0,0 +1,133 @@
+import json
+
+from conftest import titles
+from moodle.driver import ManagedDriver
+from moodle.model import Module
+from moodle.scanner import STATE_FILENAME
+from moodle.sync import LessonSync
+
+POPULATED = [
+    "Slide1",
+    "Slide2",
+    "Slide3",
+    "Domanda 1",
+    "Domanda 2",
+    "Slide4",
+    "Fine gruppo",
+    "Slide5",
+    "Slide6",
+    "Domanda 3",
+    "Fine gruppo",
+]
+
+
+def page(site, module, title: str, n: int = 0) -> list:
+    return [page for page in site.lessons[module.module_id] if page[1] == title][n]
+
+
+def full_reads(driver) -> int:
+    """Reads of the expanded edit view, the one of read_lesson"""
+    return sum(
+        1 for command, params in driver.commands if "mode=full" in params.get("url", "")
+    )
+
+
+def test_populated_lesson_is_current(module, slides):
+    module.populate(slides)
+
+    assert not LessonSync(module).plan(slides)
+
+
+def test_sync_empty_lesson(site, module, driver, slides):
+    plan = LessonSync(module).run(slides)
+
+    assert len(plan.creates) == len(POPULATED)
+    assert titles(site, module) == POPULATED
+    assert full_reads(driver) == 1
+    assert not LessonSync(module).plan(slides)
+
+
+def test_changed_slide_is_updated(site, module, slides):
+    module.populate(slides)
+    (slides / "Slide2.png").write_bytes(b"slide 2, fixed")
+
+    plan = LessonSync(module).run(slides)
+
+    assert [local.title for local, _ in plan.updates] == ["Slide2"]
+    assert not plan.creates and not plan.deletes
+    assert not LessonSync(module).plan(slides)
+
+
+def test_slide_without_fingerprint_is_updated(module, slides):
+    module.populate(slides)
+    state = json.loads((slides / STATE_FILENAME).read_text())
+    del state["Slide5"]
+    (slides / STATE_FILENAME).write_text(json.dumps(state))
+
+    plan = LessonSync(module).plan(slides)
+
+    assert [local.title for local, _ in plan.updates] == ["Slide5"]
+
+
+def test_changed_jump_is_updated(site, module, slides):
+    module.populate(slides)
+    # jump of the correct answer of first question changed on Moodle
+    contents = page(site, module, "Domanda 1")[2]
+    contents["cells"] = [cell for cell in contents["cells"] if cell != "Slide4"]
+    # and the back button of slide 5 jumping to previous page
+    contents = page(site, module, "Slide5")[2]
+    contents["cells"] = ["Pagina precedente" if c == "Slide4" else c for c in contents["cells"]]
+
+    plan = LessonSync(module).run(slides)
+
+    assert [remote.id for _, remote in plan.updates] == [
+        page(site, module, "Domanda 1")[0],
+        page(site, module, "Slide5")[0],
+    ]
+    assert not LessonSync(module).plan(slides)
+
+
+def test_missing_end_group_is_created_in_place(site, module, slides):
+    module.populate(slides)
+    pages = site.lessons[module.module_id]
+    pages.remove(page(site, module, "Fine gruppo"))
+
+    plan = LessonSync(module).run(slides)
+
+    assert [page.title for page in plan.creates] == ["Fine gruppo"]
+    assert not plan.deletes
+    assert titles(site, module) == POPULATED
+
+
+def test_added_slides_and_removed_question(site, module, driver, slides):
+    module.populate(slides)
+    (slides / "Slide7.png").write_bytes(b"slide 7")
+    clusters = json.loads((slides / "clusters.json").read_text())
+    clusters["clusters"][0]["questions"].pop()
+    (slides / "clusters.json").write_text(json.dumps(clusters))
+    driver.command_executor.log.clear()
+
+    plan = LessonSync(module).run(slides)
+
+    # end of last cluster follows the new slide now
+    assert [page.title for page in plan.creates] == ["Slide7", "Fine gruppo"]
+    assert [page.title for page in plan.deletes] == ["Domanda 2", "Fine gruppo"]
+    # correct answer of last cluster jumps to the new slide, no longer to its end
+    assert [local.title for local, _ in plan.updates] == ["Domanda 3"]
+    assert full_reads(driver) == 1
+    expected = POPULATED[:4] + POPULATED[5:-1] + ["Slide7", "Fine gruppo"]
+    assert titles(site, module) == expected
+    assert not LessonSync(module).plan(slides)
+
+
+def test_browser_recycled_between_pages(site, config, slides):
+    driver = ManagedDriver(site.driver, config=config, recycle_pages=4)
+    site.add_module(site.sections[0]["dom_id"], "Lesson")
+    module = Module(driver, "Lesson", config=config)
+    module.dom_id = site.sections[0]["activities"][-1]["dom_id"]
+
+    LessonSync(module).run(slides)
+
+    assert driver.recycles == len(POPULATED) // 4
+    assert titles(site, module) == POPULATED
+    driver.quit()
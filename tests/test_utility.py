@@ -0,0 +1,104 @@
+import json
+
+import pytest
+import urllib3
+
+from moodle.utility import get_remote_connection, route_to_node
+
+HUB = "http://127.0.0.1:4444/wd/hub"
+
+
+def test_pooled_connection(config):
+    config["selenium"].update(pool_maxsize=8, connect_timeout=2.0, read_timeout=30.0)
+
+    connection = get_remote_connection(HUB, config)
+
+    assert isinstance(connection._conn, urllib3.PoolManager)
+    assert connection._conn.connection_pool_kw["maxsize"] == 8
+    timeout = connection._conn.connection_pool_kw["timeout"]
+    assert (timeout.connect_timeout, timeout.read_timeout) == (2.0, 30.0)
+
+
+def test_connection_without_keep_alive(config):
+    config["selenium"].update(keep_alive=False)
+
+    connection = get_remote_connection(HUB, config)
+
+    assert not connection.keep_alive
+    assert not hasattr(connection, "_conn")
+
+
+class Response:
+    def __init__(self, obj):
+        self.data = json.dumps(obj).encode("utf-8")
+
+
+class Http:
+    """Pool of the executor, answering the grid api"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.urls = []
+
+    def request(self, method: str, url: str, **kwargs):
+        self.urls.append(url)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return Response(self.answer)
+
+
+class Executor:
+    def __init__(self, http: Http):
+        self._conn = http
+        self._url = HUB
+
+
+class Driver:
+    session_id = "abc"
+
+    def __init__(self, http: Http, reachable: bool = True):
+        self.command_executor = Executor(http)
+        self.reachable = reachable
+        # executor url of commands sent
+        self.urls = []
+
+    @property
+    def current_url(self) -> str:
+        self.urls.append(self.command_executor._url)
+        if not self.reachable:
+            raise urllib3.exceptions.MaxRetryError(None, self.command_executor._url)
+        return "about:blank"
+
+
+def test_route_to_node():
+    driver = Driver(Http({"proxyId": "http://10.0.0.2:5555/"}))
+
+    assert route_to_node(driver, HUB)
+
+    assert driver.command_executor._conn.urls == [
+        "http://127.0.0.1:4444/grid/api/testsession?session=abc"
+    ]
+    assert driver.command_executor._url == "http://10.0.0.2:5555/wd/hub"
+    assert driver.urls == ["http://10.0.0.2:5555/wd/hub"]
+
+
+@pytest.mark.parametrize(
+    "answer", [urllib3.exceptions.HTTPError("down"), {"msg": "no session"}]
+)
+def test_route_to_node_without_grid_api(answer, caplog):
+    driver = Driver(Http(answer))
+
+    assert not route_to_node(driver, HUB)
+
+    assert driver.command_executor._url == HUB
+    assert "using hub" in caplog.text
+
+
+def test_route_to_unreachable_node(caplog):
+    driver = Driver(Http({"proxyId": "http://10.0.0.2:5555"}), reachable=False)
+
+    assert not route_to_node(driver, HUB)
+
+    assert driver.urls == ["http://10.0.0.2:5555/wd/hub"]
+    assert driver.command_executor._url == HUB
+    assert "Cannot reach grid node" in caplog.text